@@ -1,5 +1,15 @@
 from .cv2_ import CV2
 from .dataset_define import *
+from .annotation_index import VOCAnnotationIndex
+from .image_shard import ImageShardWriter, ImageShard, build_voc_image_shard, get_voc_image_shard_path
+from .image_cache import SharedImageCache
+from .batch_augmentation import BatchAugmentation
+from .padded_labels import PaddedLabels
+from .prefetcher import DevicePrefetcher
+from .metrics import TrainMetrics
+from .distributed import init_distributed, launch_distributed, cleanup_distributed, wrap_ddp, unwrap_model, \
+    convert_sync_batch_norm, is_main_process, get_rank, get_world_size, barrier, all_reduce_mean, \
+    shard_indexes, gather_to_main, broadcast_from_main
 from .evaluator import BaseEvaluator
 from .predictor import BasePredictor
 from .tools import BaseTools
@@ -0,0 +1,266 @@
+'''
+Pre-parsed VOC annotations.
+All xml files of one .../Annotations/ folder are parsed once and saved as flat numpy arrays
+(memory-mapped when loaded), so datasets/evaluators do not re-parse xml every epoch.
+The index is rebuilt automatically when xml files are added/removed/modified.
+'''
+import os
+import sys
+import hashlib
+import uuid
+import numpy as np
+from typing import List
+
+if sys.version_info[0] == 2:
+    import xml.etree.cElementTree as ET
+else:
+    import xml.etree.ElementTree as ET
+
+
+class VOCAnnotationIndex:
+    '''
+    root_path --> .../VOC/year/trainval(or test)/ , xml files are in root_path/Annotations/
+    objects of image i are rows offsets[i]:offsets[i+1] of boxes/kind_ids/difficult/truncated/pose_ids
+    '''
+    ARRAY_NAMES = [
+        'stems',  # (N, )  xml file name without '.xml'
+        'file_names',  # (N, )  <filename>
+        'sizes',  # (N, 3)  width, height, depth
+        'offsets',  # (N+1, )
+        'boxes',  # (M, 4)  xmin, ymin, xmax, ymax
+        'kind_ids',  # (M, ) --> vocabulary
+        'difficult',  # (M, )
+        'truncated',  # (M, )
+        'pose_ids',  # (M, ) --> vocabulary
+        'vocabulary',  # (V, )  kind names and poses
+    ]
+
+    def __init__(
+            self,
+            root_path: str,
+            index_dir: str = None,
+    ):
+        '''
+
+        Args:
+            root_path: folder containing Annotations/
+            index_dir: where to save the index, default root_path/annotations_index/
+        '''
+        self.root_path = root_path
+        self.annotations_path = os.path.join(root_path, 'Annotations')
+        if index_dir is None:
+            index_dir = os.path.join(root_path, 'annotations_index')
+        self.index_dir = index_dir
+
+        self.arrays = None  # type: dict
+        self.stem_to_index = None  # type: dict
+        self.vocabulary = None  # type: List[str]
+        self.kind_id_maps = {}  # tuple(kinds_name) --> (V, ) vocabulary id --> kind id
+        self.__load()
+
+    def __load(self):
+        self.arrays = self.__load_or_build()
+        self.stem_to_index = {stem: i for i, stem in enumerate(self.arrays['stems'].tolist())}
+        self.vocabulary = self.arrays['vocabulary'].tolist()
+        self.kind_id_maps = {}
+
+    def __getstate__(self):
+        # do not pickle arrays (e.g. to DataLoader workers), re-map them in __setstate__
+        return {'root_path': self.root_path, 'annotations_path': self.annotations_path, 'index_dir': self.index_dir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__load()
+
+    def __len__(self):
+        return len(self.stem_to_index)
+
+    def __get_stamp(
+            self
+    ) -> np.ndarray:
+        # names/sizes/modify times of all xml files, much cheaper than parsing them
+        entries = sorted(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in os.scandir(self.annotations_path) if entry.name.endswith('.xml')
+        )
+        digest = hashlib.sha1(repr(entries).encode('utf-8')).digest()
+        return np.frombuffer(digest, dtype=np.uint8)
+
+    def __load_or_build(
+            self
+    ) -> dict:
+        stamp = self.__get_stamp()
+        stamp_file = os.path.join(self.index_dir, 'stamp.npy')
+        if os.path.isfile(stamp_file) and np.array_equal(np.load(stamp_file), stamp):
+            return {
+                name: np.load(os.path.join(self.index_dir, name + '.npy'), mmap_mode='r')
+                for name in self.ARRAY_NAMES
+            }
+
+        arrays = self.build_arrays(self.annotations_path)
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            # stamp is saved at last, so a half-written index is never used
+            for name, array in [*((name, arrays[name]) for name in self.ARRAY_NAMES), ('stamp', stamp)]:
+                self.__save_array(os.path.join(self.index_dir, name + '.npy'), array)
+        except OSError:
+            print('Can not save annotations index to {}, just keep it in memory.'.format(self.index_dir))
+        return arrays
+
+    def __save_array(
+            self,
+            file_name: str,
+            array: np.ndarray
+    ):
+        # write a new file then rename, files memory-mapped by other processes stay valid.
+        # the temp file is unique, processes building the index at the same time (DDP ranks, datasets)
+        # never write into one file, every rename publishes a complete file (same content for the same stamp)
+        tmp_file_name = '{}.{}.{}.tmp'.format(file_name, os.getpid(), uuid.uuid4().hex)
+        try:
+            with open(tmp_file_name, 'xb') as f:
+                np.save(f, array)
+            os.replace(tmp_file_name, file_name)
+        except BaseException:
+            if os.path.exists(tmp_file_name):
+                os.remove(tmp_file_name)
+            raise
+
+    @staticmethod
+    def build_arrays(
+            annotations_path: str
+    ) -> dict:
+        xml_file_names = sorted(name for name in os.listdir(annotations_path) if name.endswith('.xml'))
+
+        vocabulary = {}
+        stems, file_names, sizes, offsets = [], [], [], [0]
+        boxes, kind_ids, difficult, truncated, pose_ids = [], [], [], [], []
+
+        def text_of(node, tag, default):
+            child = node.find(tag)
+            if child is None or child.text is None:
+                return default
+            return child.text.strip()
+
+        for xml_file_name in xml_file_names:
+            root = ET.parse(os.path.join(annotations_path, xml_file_name)).getroot()
+            stems.append(xml_file_name[:-4])
+            file_names.append(text_of(root, 'filename', ''))
+
+            size = root.find('size')
+            if size is None:
+                sizes.append([0.0, 0.0, 0.0])
+            else:
+                sizes.append([float(text_of(size, key, 0)) for key in ['width', 'height', 'depth']])
+
+            for obj in root.iter('object'):
+                bbox = obj.find('bndbox')
+                boxes.append([float(bbox.find(key).text.strip()) for key in ['xmin', 'ymin', 'xmax', 'ymax']])
+                kind_ids.append(vocabulary.setdefault(text_of(obj, 'name', ''), len(vocabulary)))
+                pose_ids.append(vocabulary.setdefault(text_of(obj, 'pose', ''), len(vocabulary)))
+                difficult.append(int(text_of(obj, 'difficult', 0)))
+                truncated.append(int(text_of(obj, 'truncated', 0)))
+            offsets.append(len(boxes))
+
+        return {
+            'stems': np.array(stems, dtype=np.str_),
+            'file_names': np.array(file_names, dtype=np.str_),
+            'sizes': np.array(sizes, dtype=np.float64).reshape(-1, 3),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'boxes': np.array(boxes, dtype=np.float64).reshape(-1, 4),
+            'kind_ids': np.array(kind_ids, dtype=np.int32),
+            'difficult': np.array(difficult, dtype=np.int8),
+            'truncated': np.array(truncated, dtype=np.int8),
+            'pose_ids': np.array(pose_ids, dtype=np.int32),
+            'vocabulary': np.array(list(vocabulary.keys()), dtype=np.str_),
+        }
+
+    def index_of(
+            self,
+            stem: str
+    ) -> int:
+        '''
+        stem: xml file name without '.xml' (e.g. '000001'), '000001.xml' is also ok
+        '''
+        if stem.endswith('.xml'):
+            stem = stem[:-4]
+        return self.stem_to_index[stem]
+
+    def __rows(
+            self,
+            i: int
+    ) -> slice:
+        offsets = self.arrays['offsets']
+        return slice(int(offsets[i]), int(offsets[i + 1]))
+
+    def image_file_name_of(
+            self,
+            i: int
+    ) -> str:
+        return str(self.arrays['file_names'][i])
+
+    def image_size_of(
+            self,
+            i: int
+    ) -> tuple:
+        '''
+        Returns:
+            (width, height, depth)
+        '''
+        w, h, c = self.arrays['sizes'][i].tolist()
+        return w, h, int(c)
+
+    def boxes_of(
+            self,
+            i: int
+    ) -> np.ndarray:
+        '''
+        Returns:
+            (k, 4) float64, xmin ymin xmax ymax (same values as float(xml text))
+        '''
+        return np.array(self.arrays['boxes'][self.__rows(i)])
+
+    def kinds_name_of(
+            self,
+            i: int
+    ) -> List[str]:
+        return [self.vocabulary[k] for k in self.arrays['kind_ids'][self.__rows(i)].tolist()]
+
+    def kind_ids_of(
+            self,
+            i: int,
+            kinds_name: list,
+    ) -> np.ndarray:
+        '''
+        same as [kinds_name.index(kind) for kind in kinds_name_of(i)]
+        Returns:
+            (k, ) int64
+        '''
+        key = tuple(kinds_name)
+        if key not in self.kind_id_maps:
+            # vocabulary also has poses, they are -1
+            self.kind_id_maps[key] = np.array(
+                [kinds_name.index(kind) if kind in kinds_name else -1 for kind in self.vocabulary], dtype=np.int64
+            )
+        kind_ids = self.kind_id_maps[key][self.arrays['kind_ids'][self.__rows(i)]]
+        if (kind_ids < 0).any():
+            kind = self.kinds_name_of(i)[int(np.argmin(kind_ids))]
+            raise ValueError('{} is not in kinds_name'.format(kind))
+        return kind_ids
+
+    def poses_of(
+            self,
+            i: int
+    ) -> List[str]:
+        return [self.vocabulary[k] for k in self.arrays['pose_ids'][self.__rows(i)].tolist()]
+
+    def difficult_of(
+            self,
+            i: int
+    ) -> np.ndarray:
+        return np.array(self.arrays['difficult'][self.__rows(i)])
+
+    def truncated_of(
+            self,
+            i: int
+    ) -> np.ndarray:
+        return np.array(self.arrays['truncated'][self.__rows(i)])
@@ -0,0 +1,306 @@
+'''
+Batch augmentation on device (GPU, or CPU for test).
+DataLoader workers just resize images (see ResizeUInt8), then BatchAugmentation applies
+photometric distort + expand + crop + mirror + resize + Normalize to the whole batch with tensor ops:
+    colour --> one batched 3x4 matrix (einsum)
+    geometry --> one affine_grid + grid_sample (masks use the same grid, nearest)
+random parameters are sampled per image with the same distribution as FusedSSDAugmentation.
+'''
+import torch
+import torch.nn.functional as F
+import numpy as np
+from typing import List, Union
+from .dataaugmentation import FusedSSDAugmentation
+from .padded_labels import PaddedLabels
+
+
+class BatchAugmentation:
+    def __init__(
+            self,
+            size: int = 416,
+            mean=(0.406, 0.456, 0.485),
+            std=(0.225, 0.224, 0.229),
+            photometric: bool = True,
+            geometric: bool = True,
+    ):
+        '''
+
+        Args:
+            size: output size
+            mean:
+            std:
+            photometric: use photometric distort
+            geometric: use expand/crop/mirror (resize is always used)
+        '''
+        self.size = size
+        self.photometric = photometric
+        self.geometric = geometric
+        self.fused = FusedSSDAugmentation(size, mean, std)
+
+    def __resize_affine_matrix(self, height, width, boxes):
+        # same as Resize (pixel center aligned, as cv2)
+        scale_x, scale_y = self.size / width, self.size / height
+        boxes = boxes.copy()
+        boxes[:, [0, 2]] *= scale_x
+        boxes[:, [1, 3]] *= scale_y
+        boxes = np.clip(boxes, a_min=0, a_max=self.size - 1)
+        affine_matrix = np.array([
+            [scale_x, 0.0, 0.5 * scale_x - 0.5],
+            [0.0, scale_y, 0.5 * scale_y - 0.5],
+        ])
+        return affine_matrix, boxes
+
+    def sample(
+            self,
+            height: int,
+            width: int,
+            boxes: np.ndarray,
+            valid: np.ndarray,
+    ):
+        '''
+        sample random parameters of every image (on cpu, just boxes are used)
+        Args:
+            height: of input images
+            width:
+            boxes: (N, M, 4)
+            valid: (N, M)
+
+        Returns:
+            colour_matrix (N, 3, 4) --> normalized RGB
+            theta (N, 2, 3) for affine_grid
+            new_boxes (N, M, 4)
+            index (N, M) new box i of image n is old box index[n, i], -1 --> padding
+        '''
+        N, M, _ = boxes.shape
+        colour_matrix = np.zeros(shape=(N, 3, 4))
+        theta = np.zeros(shape=(N, 2, 3))
+        new_boxes = np.zeros(shape=(N, M, 4), dtype=np.float32)
+        index = np.full(shape=(N, M), fill_value=-1, dtype=np.int64)
+
+        identity = np.concatenate((np.eye(3), np.zeros(shape=(3, 1))), axis=1)
+        for n in range(N):
+            old_index = np.flatnonzero(valid[n])
+            now_boxes = boxes[n, old_index].astype(np.float32)
+
+            colour = self.fused.sample_colour_matrix() if self.photometric else identity
+            # + Normalize
+            matrix = self.fused.normalize_scale[:, None] * (self.fused.to_rgb @ colour)
+            matrix[:, 3] += self.fused.normalize_offset
+            colour_matrix[n] = matrix
+
+            if self.geometric:
+                affine_matrix, now_boxes, kept = self.fused.sample_affine_matrix(
+                    height, width, now_boxes, np.arange(old_index.shape[0])
+                )
+            else:
+                affine_matrix, now_boxes = self.__resize_affine_matrix(height, width, now_boxes)
+                kept = np.arange(old_index.shape[0])
+
+            new_boxes[n, :kept.shape[0]] = now_boxes
+            index[n, :kept.shape[0]] = old_index[kept]
+
+            # input pixel --> output pixel  ==>  output normalized --> input normalized (align_corners=False)
+            for axis, in_size in enumerate([width, height]):
+                a, c = affine_matrix[axis, axis], affine_matrix[axis, 2]
+                theta[n, axis, axis] = self.size / (in_size * a)
+                theta[n, axis, 2] = (self.size - 1 - 2 * c) / (in_size * a) + 1.0 / in_size - 1
+
+        return colour_matrix, theta, new_boxes, index
+
+    def __call__(
+            self,
+            images: torch.Tensor,
+            boxes: torch.Tensor,
+            classes: torch.Tensor,
+            valid: torch.Tensor,
+            masks: torch.Tensor = None,
+    ):
+        '''
+
+        Args:
+            images: (N, 3, H, W) BGR in [0, 255] (uint8 or float)
+            boxes: (N, M, 4) x y x y (absolute)
+            classes: (N, M) long
+            valid: (N, M) bool, False --> padding
+            masks: (N, K, H, W) or None
+
+        Returns:
+            images (N, 3, size, size) normalized RGB, boxes (N, M, 4), classes (N, M), valid (N, M), masks
+        '''
+        N, _, H, W = images.shape
+        device = images.device
+        colour_matrix, theta, new_boxes, index = self.sample(
+            H, W, boxes.detach().cpu().numpy(), valid.detach().cpu().numpy()
+        )
+        colour_matrix = torch.tensor(colour_matrix, dtype=torch.float32, device=device)
+        theta = torch.tensor(theta, dtype=torch.float32, device=device)
+
+        # colour + Normalize
+        x = torch.einsum('nij,njhw->nihw', colour_matrix[:, :, :3], images.float())
+        x = x + colour_matrix[:, :, 3, None, None]  # (N, 3, H, W)
+
+        # expand + crop + mirror + resize, pixels out of image --> Expand's fill value
+        grid = F.affine_grid(theta, [N, 3, self.size, self.size], align_corners=False)
+        fill_value = torch.tensor(self.fused.fill_value, dtype=torch.float32, device=device)[None, :, None, None]
+        x = F.grid_sample(x - fill_value, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        x = x + fill_value
+
+        if masks is not None:
+            masks = F.grid_sample(masks.float(), grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+        index = torch.tensor(index, device=device)
+        new_valid = index >= 0
+        new_classes = torch.gather(classes.to(device), 1, index.clamp(min=0))
+        new_classes[~new_valid] = 0
+        return x, torch.tensor(new_boxes, device=device), new_classes, new_valid, masks
+
+    @staticmethod
+    def labels_to_tensors(
+            labels: List[List],
+            kinds_name: list,
+            kind_first: bool = True,
+    ):
+        '''
+
+        Args:
+            labels: [[(kind_name, x, y, x, y), ...], ...] (kind_first) or [[[x, y, x, y, kind_name], ...], ...]
+            kinds_name:
+            kind_first:
+
+        Returns:
+            boxes (N, M, 4), classes (N, M), valid (N, M)
+        '''
+        N = len(labels)
+        M = max([len(label) for label in labels] + [1])
+        boxes = torch.zeros(size=(N, M, 4))
+        classes = torch.zeros(size=(N, M), dtype=torch.long)
+        valid = torch.zeros(size=(N, M), dtype=torch.bool)
+        for n, label in enumerate(labels):
+            for m, obj in enumerate(label):
+                kind, box = (obj[0], obj[1:5]) if kind_first else (obj[4], obj[0:4])
+                boxes[n, m] = torch.tensor(box)
+                classes[n, m] = kinds_name.index(kind)
+                valid[n, m] = True
+        return boxes, classes, valid
+
+    @staticmethod
+    def tensors_to_labels(
+            boxes: torch.Tensor,
+            classes: torch.Tensor,
+            valid: torch.Tensor,
+            kinds_name: list,
+            kind_first: bool = True,
+    ) -> List[List]:
+        boxes, classes, valid = boxes.cpu().tolist(), classes.cpu().tolist(), valid.cpu().tolist()
+        labels = []
+        for n in range(len(boxes)):
+            label = []
+            for m in range(len(boxes[n])):
+                if not valid[n][m]:
+                    continue
+                kind = kinds_name[classes[n][m]]
+                label.append((kind, *boxes[n][m]) if kind_first else [*boxes[n][m], kind])
+            labels.append(label)
+        return labels
+
+    @staticmethod
+    def tensors_to_padded_labels(
+            boxes: torch.Tensor,
+            classes: torch.Tensor,
+            valid: torch.Tensor,
+    ) -> PaddedLabels:
+        # kept boxes are always at the front (see sample)
+        return PaddedLabels(
+            torch.cat((classes.to(boxes.dtype).unsqueeze(-1), boxes), dim=-1),
+            valid.sum(dim=1)
+        )
+
+    def augment_labels(
+            self,
+            images: torch.Tensor,
+            labels: Union[List[List], PaddedLabels],
+            kinds_name: list,
+    ):
+        '''
+        for VOCDataSet/StrongerVOCDataSet batches, labels --> [[(kind_name, x, y, x, y), ...], ...] or PaddedLabels
+        '''
+        if isinstance(labels, PaddedLabels):
+            images, boxes, classes, valid, _ = self(
+                images, labels.objects[..., 1:5], labels.objects[..., 0].long(), labels.valid
+            )
+            return images, self.tensors_to_padded_labels(boxes, classes, valid)
+
+        boxes, classes, valid = self.labels_to_tensors(labels, kinds_name)
+        images, boxes, classes, valid, _ = self(images, boxes, classes, valid)
+        return images, self.tensors_to_labels(boxes, classes, valid, kinds_name)
+
+    def augment_objects_and_masks(
+            self,
+            images: torch.Tensor,
+            objects: Union[List[List], PaddedLabels],
+            masks: Union[List[List[np.ndarray]], torch.Tensor],
+            kinds_name: list,
+    ):
+        '''
+        for VocDataSetForAllTasks batches, objects --> [[[x, y, x, y, kind_name], ...], ...] or PaddedLabels
+        masks --> [[mask(H, W), ...], ...] (same number for every image), returned as np.ndarray (N, K, size, size)
+              or (N, H, W) uint8 index maps (mask_as_index_map), returned as (N, size, size) uint8 tensor on device
+        '''
+        if isinstance(objects, PaddedLabels):
+            boxes, classes, valid = objects.objects[..., 1:5], objects.objects[..., 0].long(), objects.valid
+        else:
+            boxes, classes, valid = self.labels_to_tensors(objects, kinds_name, kind_first=False)
+        N = images.shape[0]
+        if isinstance(masks, torch.Tensor):
+            # shift by 1 so that pixels out of image (0 after grid_sample) come back as 255 (ignored)
+            index_maps = (masks.to(images.device).float() + 1).unsqueeze(1)  # (N, 1, H, W)
+            images, boxes, classes, valid, index_maps = self(images, boxes, classes, valid, index_maps)
+            masks = ((index_maps.squeeze(1).long() - 1) % 256).to(torch.uint8)
+            if isinstance(objects, PaddedLabels):
+                objects = self.tensors_to_padded_labels(boxes, classes, valid)
+            else:
+                objects = self.tensors_to_labels(boxes, classes, valid, kinds_name, kind_first=False)
+            return images, objects, masks
+
+        masks = torch.from_numpy(np.array(masks, dtype=np.float32)).to(images.device) if len(masks[0]) else None
+        images, boxes, classes, valid, masks = self(images, boxes, classes, valid, masks)
+        if isinstance(objects, PaddedLabels):
+            objects = self.tensors_to_padded_labels(boxes, classes, valid)
+        else:
+            objects = self.tensors_to_labels(boxes, classes, valid, kinds_name, kind_first=False)
+        masks = masks.cpu().numpy() if masks is not None else [[] for _ in range(N)]
+        return images, objects, masks
+
+
+def debug_batch_augmentation_speed(
+        batch_size: int = 32,
+        size: int = 416,
+        times: int = 10,
+        device: str = 'cpu',
+):
+    import time
+    images = np.random.randint(0, 256, size=(batch_size, size, size, 3)).astype(np.uint8)
+    labels = [[('a', 10.0, 20.0, 200.0, 300.0), ('b', 100.0, 50.0, 400.0, 400.0)] for _ in range(batch_size)]
+
+    fused = FusedSSDAugmentation(size)
+    boxes, classes = np.array([label[1:] for label in labels[0]], dtype=np.float32), np.array(['a', 'b'])
+    start = time.time()
+    for _ in range(times):
+        for image in images:
+            fused(image, boxes, classes)
+    print('FusedSSDAugmentation (per image, cpu): {:.1f} img/s'.format(times * batch_size / (time.time() - start)))
+
+    batch_augmentation = BatchAugmentation(size)
+    x = torch.from_numpy(images).permute(0, 3, 1, 2).to(device)
+    start = time.time()
+    for _ in range(times):
+        batch_augmentation.augment_labels(x, labels, ['a', 'b'])
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    print('BatchAugmentation ({}): {:.1f} img/s'.format(device, times * batch_size / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    debug_batch_augmentation_speed()
+    if torch.cuda.is_available():
+        debug_batch_augmentation_speed(device='cuda')
@@ -9,13 +9,15 @@ import numpy as np
 class CV2:
     COLOR_BGR2HSV = cv2.COLOR_BGR2HSV
     COLOR_HSV2BGR = cv2.COLOR_HSV2BGR
+    IMREAD_COLOR = cv2.IMREAD_COLOR
+    IMREAD_GRAYSCALE = cv2.IMREAD_GRAYSCALE
 
     def __init__(self):
         pass
 
     @staticmethod
-    def imread(file: str) -> np.ndarray:
-        return cv2.imread(file)
+    def imread(file: str, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+        return cv2.imread(file, flags)
 
     @staticmethod
     def imshow(window_name: str, img: np.ndarray):
@@ -29,6 +31,18 @@ class CV2:
     def resize(img: np.ndarray, new_size: tuple) -> np.ndarray:
         return cv2.resize(img, new_size)
 
+    @staticmethod
+    def warpAffine(img: np.ndarray, matrix: np.ndarray, new_size: tuple) -> np.ndarray:
+        return cv2.warpAffine(img, matrix, new_size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    @staticmethod
+    def transform(img: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+        return cv2.transform(img, matrix)
+
+    @staticmethod
+    def addWeighted(img1: np.ndarray, alpha: float, img2: np.ndarray, beta: float, gamma: float = 0.0) -> np.ndarray:
+        return cv2.addWeighted(img1, alpha, img2, beta, gamma)
+
     @staticmethod
     def cvtColorToRGB(img: np.ndarray) -> np.ndarray:
         return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -220,11 +220,23 @@ class RandomSampleCrop(object):
 
     def __call__(self, image, boxes=None, labels=None):
         height, width, _ = image.shape
+        rect, boxes, labels = self.sample(height, width, boxes, labels)
+        if rect is None:
+            return image, boxes, labels
+        # cut the crop from the image
+        return image[rect[1]:rect[3], rect[0]:rect[2], :], boxes, labels
+
+    def sample(self, height, width, boxes, labels):
+        '''
+        sample crop rect (just boxes are used, so FusedSSDAugmentation could share it)
+        Returns:
+            rect (None --> using entire image), boxes(adjusted to rect), labels
+        '''
         while True:
             # randomly choose a mode
             mode = random.choice(self.sample_options)
             if mode is None:
-                return image, boxes, labels
+                return None, boxes, labels
 
             min_iou, max_iou = mode
             if min_iou is None:
@@ -234,8 +246,6 @@ class RandomSampleCrop(object):
 
             # max trails (50)
             for _ in range(50):
-                current_image = image
-
                 w = np.random.uniform(0.3 * width, width)
                 h = np.random.uniform(0.3 * height, height)
 
@@ -256,10 +266,6 @@ class RandomSampleCrop(object):
                 if overlap.min() < min_iou and max_iou < overlap.max():
                     continue
 
-                # cut the crop from the image
-                current_image = current_image[rect[1]:rect[3], rect[0]:rect[2],
-                                              :]
-
                 # keep overlap with gt box IF center in sampled patch
                 centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
 
@@ -293,7 +299,7 @@ class RandomSampleCrop(object):
                 # adjust to crop (by substracting crop's left,top)
                 current_boxes[:, 2:] -= rect[:2]
 
-                return current_image, current_boxes, current_labels
+                return rect, current_boxes, current_labels
 
 
 class Expand(object):
@@ -301,28 +307,40 @@ class Expand(object):
         self.mean = mean
 
     def __call__(self, image, boxes, labels):
-        if np.random.randint(2):
-            return image, boxes, labels
-
         height, width, depth = image.shape
-        ratio = np.random.uniform(1, 4)
-        left = np.random.uniform(0, width*ratio - width)
-        top = np.random.uniform(0, height*ratio - height)
+        expand_info = self.sample(height, width)
+        if expand_info is None:
+            return image, boxes, labels
 
+        left, top, expand_w, expand_h = expand_info
         expand_image = np.zeros(
-            (int(height*ratio), int(width*ratio), depth),
+            (expand_h, expand_w, depth),
             dtype=image.dtype)
         expand_image[:, :, :] = self.mean
-        expand_image[int(top):int(top + height),
-                     int(left):int(left + width)] = image
+        expand_image[top:top + height,
+                     left:left + width] = image
         image = expand_image
 
         boxes = boxes.copy()
-        boxes[:, :2] += (int(left), int(top))
-        boxes[:, 2:] += (int(left), int(top))
+        boxes[:, :2] += (left, top)
+        boxes[:, 2:] += (left, top)
 
         return image, boxes, labels
 
+    @staticmethod
+    def sample(height, width):
+        '''
+        Returns:
+            None(do not expand) or (left, top, expanded width, expanded height)
+        '''
+        if np.random.randint(2):
+            return None
+
+        ratio = np.random.uniform(1, 4)
+        left = np.random.uniform(0, width*ratio - width)
+        top = np.random.uniform(0, height*ratio - height)
+        return int(left), int(top), int(width*ratio), int(height*ratio)
+
 
 class RandomMirror(object):
     def __call__(self, image, boxes, classes):
@@ -400,18 +418,205 @@ class Resize(object):
         return image, boxes, labels
 
 
+class FusedSSDAugmentation(object):
+    '''
+    same random distribution as SSDAugmentation(ConvertFromInts, PhotometricDistort, Expand, RandomSampleCrop,
+    RandomMirror, Resize, Normalize), but all random parameters are sampled first, then
+        expand + crop + mirror + resize --> one warpAffine (on uint8 input image, output is size x size)
+        photometric distort + Normalize(BGR --> RGB, /255, -mean, /std) --> one 3x4 colour matrix
+    so every image is just touched a few times (no float copy of input, no HSV, no expanded canvas).
+    saturation/hue are done in BGR space (scale around luma / rotate around gray axis) instead of HSV,
+    statistically equivalent (not same pixels).
+    '''
+    # luma weights of B, G, R
+    LUMA = np.array([0.114, 0.587, 0.299])
+
+    def __init__(
+            self,
+            size: int = 416,
+            mean=(0.406, 0.456, 0.485),
+            std=(0.225, 0.224, 0.229),
+            contrast_range: tuple = (0.5, 1.5),
+            saturation_range: tuple = (0.5, 1.5),
+            hue_delta: float = 18.0,
+            brightness_delta: float = 32,
+    ):
+        self.size = size
+        self.mean = mean
+        self.std = std
+        self.contrast_range = contrast_range
+        self.saturation_range = saturation_range
+        self.hue_delta = hue_delta
+        self.brightness_delta = brightness_delta
+        self.crop = RandomSampleCrop()
+
+        # Normalize (on BGR values in [0, 255]) --> RGB, (x/255 - mean) / std
+        self.to_rgb = np.eye(3)[::-1]
+        self.normalize_scale = 1.0 / (255.0 * np.array(std))
+        self.normalize_offset = - np.array(mean) / np.array(std)
+        # Expand fills canvas with mean(BGR) before Normalize
+        self.fill_value = (np.array(mean)[::-1] / 255.0 - np.array(mean)) / np.array(std)  # RGB
+
+    def __sample_contrast(self) -> float:
+        if np.random.randint(2):
+            return np.random.uniform(*self.contrast_range)
+        return 1.0
+
+    def __sample_saturation(self) -> float:
+        if np.random.randint(2):
+            return np.random.uniform(*self.saturation_range)
+        return 1.0
+
+    def __sample_hue(self) -> float:
+        if np.random.randint(2):
+            return np.random.uniform(-self.hue_delta, self.hue_delta)
+        return 0.0
+
+    def sample_colour_matrix(self) -> np.ndarray:
+        '''
+        same random calls as PhotometricDistort
+        Returns:
+            (3, 4), BGR --> distorted BGR
+        '''
+        brightness = np.random.uniform(-self.brightness_delta, self.brightness_delta) if np.random.randint(2) else 0.0
+        if np.random.randint(2):
+            contrast = self.__sample_contrast()
+            saturation = self.__sample_saturation()
+            hue = self.__sample_hue()
+        else:
+            saturation = self.__sample_saturation()
+            hue = self.__sample_hue()
+            contrast = self.__sample_contrast()
+
+        # saturation, scale chroma around luma
+        saturation_matrix = saturation * np.eye(3) + (1 - saturation) * np.ones((3, 1)) @ self.LUMA[None]
+        # hue, rotate around gray axis, +hue means R --> G --> B (as HSV)
+        theta = np.deg2rad(hue)
+        u = np.ones(3) / np.sqrt(3)
+        cross = np.array([
+            [0, -u[2], u[1]],
+            [u[2], 0, -u[0]],
+            [-u[1], u[0], 0],
+        ])
+        hue_matrix_rgb = np.cos(theta) * np.eye(3) + np.sin(theta) * cross + (1 - np.cos(theta)) * np.outer(u, u)
+        hue_matrix = self.to_rgb @ hue_matrix_rgb @ self.to_rgb
+
+        # gray is kept by saturation/hue, so contrast * hue * saturation * (x + brightness) is:
+        matrix = contrast * hue_matrix @ saturation_matrix
+        offset = contrast * brightness * np.ones(3)
+        return np.concatenate((matrix, offset[:, None]), axis=1)
+
+    def sample_affine_matrix(self, height, width, boxes, labels):
+        '''
+        same random calls as Expand, RandomSampleCrop, RandomMirror
+        Returns:
+            (2, 3) input pixel --> output pixel, boxes, labels (both same as Resize output)
+        '''
+        left, top, expand_w, expand_h = 0, 0, width, height
+        expand_info = Expand.sample(height, width)
+        if expand_info is not None:
+            left, top, expand_w, expand_h = expand_info
+            boxes = boxes.copy()
+            boxes[:, :2] += (left, top)
+            boxes[:, 2:] += (left, top)
+
+        rect = None
+        if boxes.shape[0] != 0:
+            # crop is sampled by IoU with boxes
+            rect, boxes, labels = self.crop.sample(expand_h, expand_w, boxes, labels)
+        if rect is None:
+            rect = np.array([0, 0, expand_w, expand_h])
+        crop_w, crop_h = int(rect[2] - rect[0]), int(rect[3] - rect[1])
+
+        mirror = np.random.randint(2)
+        if mirror:
+            boxes = boxes.copy()
+            boxes[:, 0::2] = crop_w - boxes[:, 2::-2]
+
+        # same as Resize
+        boxes = boxes.copy()
+        boxes[:, [0, 2]] /= (crop_w / self.size)
+        boxes[:, [1, 3]] /= (crop_h / self.size)
+        boxes = np.clip(boxes, a_min=0, a_max=self.size - 1)
+
+        # pixel x --> x + left - rect[0] --> (mirror) crop_w - 1 - x --> resize (pixel center aligned, as cv2)
+        scale_x, scale_y = self.size / crop_w, self.size / crop_h
+        shift_x, shift_y = left - rect[0], top - rect[1]
+        if mirror:
+            row_x = [-scale_x, 0.0, (crop_w - 0.5 - shift_x) * scale_x - 0.5]
+        else:
+            row_x = [scale_x, 0.0, (shift_x + 0.5) * scale_x - 0.5]
+        row_y = [0.0, scale_y, (shift_y + 0.5) * scale_y - 0.5]
+        return np.array([row_x, row_y]), boxes, labels
+
+    def __call__(self, img, boxes, labels):
+        height, width, _ = img.shape
+        colour_matrix = self.sample_colour_matrix()
+        affine_matrix, boxes, labels = self.sample_affine_matrix(height, width, boxes, labels)
+
+        # geometry, one warp
+        image = CV2.warpAffine(img, affine_matrix, (self.size, self.size)).astype(np.float32)
+
+        # colour + Normalize, one matrix
+        matrix = self.normalize_scale[:, None] * (self.to_rgb @ colour_matrix)
+        matrix[:, 3] += self.normalize_offset
+        image = CV2.transform(image, matrix.astype(np.float32))  # (H, W, C) RGB
+
+        # pixels out of input image --> Expand's fill value
+        index = np.arange(self.size)
+        src_x = (index - affine_matrix[0, 2]) / affine_matrix[0, 0]
+        src_y = (index - affine_matrix[1, 2]) / affine_matrix[1, 1]
+        out_x = (src_x < -0.5) | (src_x > width - 0.5)
+        out_y = (src_y < -0.5) | (src_y > height - 0.5)
+        if out_x.any() or out_y.any():
+            fill_value = self.fill_value.astype(np.float32)
+            image[:, out_x] = fill_value
+            image[out_y, :] = fill_value
+
+        image = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))  # (C, H, W)
+        return image, boxes, labels
+
+
+class ResizeUInt8(object):
+    '''
+    just resize (uint8, (C, H, W) tensor), other augmentations are done on batch by BatchAugmentation
+    '''
+    def __init__(self, size=416):
+        self.size = size
+
+    def __call__(self, image, boxes=None, labels=None):
+        old_h, old_w = image.shape[0], image.shape[1]
+        image = CV2.resize(image.astype(np.uint8, copy=False), (self.size, self.size))
+        boxes = boxes.copy()
+        boxes[:, [0, 2]] /= (old_w / self.size)
+        boxes[:, [1, 3]] /= (old_h / self.size)
+        return torch.from_numpy(image).permute(2, 0, 1), boxes, labels
+
+
 class SSDAugmentation(object):
     def __init__(
             self,
             size: int = 416,
             mean=(0.406, 0.456, 0.485),
             std=(0.225, 0.224, 0.229),
-            augment: list = None
+            augment: list = None,
+            fused: bool = False,
     ):
+        '''
+
+        Args:
+            size:
+            mean:
+            std:
+            augment: list of transforms, None --> default
+            fused: use FusedSSDAugmentation (same distribution, much less passes over the image)
+        '''
         self.mean = mean
         self.std = std
         self.size = size
-        if augment is None:
+        if augment is None and fused:
+            self.augment = FusedSSDAugmentation(self.size, self.mean, self.std)
+        elif augment is None:
             self.augment = MyCompose([
                 ConvertFromInts(),
                 PhotometricDistort(),
@@ -5,18 +5,24 @@ Function --get_voc_data_loader-- will be what you want!
 import os.path
 from torchvision.datasets import ImageFolder
 from torchvision.transforms import Compose
-from Tool.BaseTools.dataaugmentation import SSDAugmentation, BaseAugmentation
+from Tool.BaseTools.dataaugmentation import SSDAugmentation, BaseAugmentation, ResizeUInt8
 import torch
 import xml.etree.ElementTree as ET
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import torchvision.transforms.transforms as transforms
 import numpy as np
 from .cv2_ import CV2
-from typing import List, Union
+from .annotation_index import VOCAnnotationIndex
+from .image_shard import ImageShard, get_voc_image_shard_path
+from .image_cache import SharedImageCache
+from .padded_labels import PaddedLabels
+from typing import List, Union, Callable, NamedTuple
+from functools import partial
 
 
 class XMLTranslate:
-    def __init__(self, root_path: str, file_name: str):
+    def __init__(self, root_path: str, file_name: str, image_cache: SharedImageCache = None):
         if not root_path.endswith('/'):
             root_path += '/'
 
@@ -28,16 +34,23 @@ class XMLTranslate:
         self.img_file_name = None  # type:str
         self.img_size = None  # type:tuple
         self.objects = []  # type:list
+        self.image_cache = image_cache  # decoded images shared by DataLoader workers
         self.__set_info()
 
     def __set_info(self):
 
         self.img_file_name = self.root.find('filename').text.strip()
-        self.img = CV2.imread(self.images_path + self.img_file_name)
+        image_file = self.images_path + self.img_file_name
+        scale_w, scale_h = 1.0, 1.0
+        if self.image_cache is None:
+            self.img = CV2.imread(image_file)
+        else:
+            # cached image may be downscaled
+            self.img, (scale_w, scale_h) = self.image_cache.get_or_load(image_file, lambda: CV2.imread(image_file))
 
         for size in self.root.iter('size'):
-            img_w = float(size.find('width').text.strip())
-            img_h = float(size.find('height').text.strip())
+            img_w = float(size.find('width').text.strip()) * scale_w
+            img_h = float(size.find('height').text.strip()) * scale_h
             img_c = int(size.find('depth').text.strip())
             self.img_size = (img_w, img_h, img_c)
 
@@ -48,7 +61,7 @@ class XMLTranslate:
             b = float(bbox.find('ymin').text.strip())  # point to y_axis dist
             m = float(bbox.find('xmax').text.strip())
             n = float(bbox.find('ymax').text.strip())
-            self.objects.append((kind, a, b, m, n))
+            self.objects.append((kind, a * scale_w, b * scale_h, m * scale_w, n * scale_h))
 
     def resize(self, new_size: tuple = (448, 448)):
         self.img = CV2.resize(self.img, new_size)
@@ -93,7 +106,23 @@ class VOCDataSet(Dataset):
             train: bool = True,
             image_size: tuple = (448, 448),
             transform: Union[SSDAugmentation, BaseAugmentation] = None,
+            use_image_shard: bool = False,
+            image_cache: SharedImageCache = None,
+            kinds_name: list = None,
     ):
+        '''
+
+        Args:
+            root:
+            years:
+            train:
+            image_size:
+            transform:
+            use_image_shard: read images from packed shards(see build_voc_image_shard) instead of JPEGImages/
+            image_cache: decoded images shared by DataLoader workers (create it before workers start)
+            kinds_name: if given, label of an image is a (k, 5) array (kind_id, x, y, x, y),
+                        collate_fn makes PaddedLabels of them. None --> [(kind_name, x, y, x, y), ...]
+        '''
         # .../VOC/year/trainval(or test)/ ----
         super().__init__()
         self.root = root
@@ -111,6 +140,20 @@ class VOCDataSet(Dataset):
             self.transform = transform
 
         self.image_and_xml_path_info = self.__get_image_and_xml_file_abs_path()
+        # pre-parsed xml of every root_path, see VOCAnnotationIndex
+        self.annotation_index = {
+            root_path: VOCAnnotationIndex(root_path)
+            for root_path in sorted(set(root_path for root_path, _ in self.image_and_xml_path_info))
+        }
+        self.use_image_shard = use_image_shard
+        self.image_shard = {
+            root_path: ImageShard(
+                get_voc_image_shard_path(root_path),
+                source_path=os.path.join(root_path, 'JPEGImages')
+            ) for root_path in self.annotation_index.keys()
+        } if use_image_shard else {}
+        self.image_cache = image_cache
+        self.kinds_name = kinds_name
 
     def __get_image_and_xml_file_abs_path(self) -> list:
         res = []
@@ -150,41 +193,75 @@ class VOCDataSet(Dataset):
     def __len__(self):
         return len(self.image_and_xml_path_info)
 
-    def __get_image_label(
+    def get_image_label(
             self,
             index,
     ) -> tuple:
+        '''
+        read image(from JPEGImages/ or image shard) and its boxes/classes (from VOCAnnotationIndex)
+        Returns:
+            img, boxes (k, 4) float32, classes (k, ) kind names (or kind ids if self.kinds_name is given)
+        '''
         root_path, xml_file_name = self.image_and_xml_path_info[index]
-        xml_trans = XMLTranslate(root_path=root_path, file_name=xml_file_name)
-        # xml_trans.resize(new_size=self.image_size)
+        annotation_index = self.annotation_index[root_path]
+        i = annotation_index.index_of(xml_file_name)
 
-        img, label = xml_trans.img, xml_trans.objects
-        boxes = []
-        classes = []
+        image_file_name = annotation_index.image_file_name_of(i)
+        boxes = annotation_index.boxes_of(i).astype(np.float32)
+        if self.kinds_name is None:
+            classes = np.array(annotation_index.kinds_name_of(i))
+        else:
+            classes = annotation_index.kind_ids_of(i, self.kinds_name)
+
+        image_file = os.path.join(root_path, 'JPEGImages', image_file_name)
+        if self.use_image_shard:
+            image_shard = self.image_shard[root_path]
+            # shard may be pre-resized
+            scale_w, scale_h = image_shard.scale_of(image_file_name)
+            load = partial(image_shard.read, image_file_name)
+        else:
+            scale_w, scale_h = 1.0, 1.0
+            load = partial(CV2.imread, image_file)
 
-        for val in label:
-            classes.append(val[0])
-            boxes.append(val[1: 5])
+        if self.image_cache is None:
+            img = load()
+        else:
+            # cached image may be downscaled
+            img, (cache_scale_w, cache_scale_h) = self.image_cache.get_or_load(image_file, load)
+            scale_w, scale_h = scale_w * cache_scale_w, scale_h * cache_scale_h
 
-        boxes = np.array(boxes, dtype=np.float32)
-        classes = np.array(classes)
+        if scale_w != 1.0 or scale_h != 1.0:
+            boxes[:, [0, 2]] *= scale_w
+            boxes[:, [1, 3]] *= scale_h
 
         return img, boxes, classes
 
     def __getitem__(self, index):
-        img, boxes, classes = self.__get_image_label(index)
+        img, boxes, classes = self.get_image_label(index)
 
         new_img_tensor, new_boxes, new_classes = self.transform(
             img,
             boxes,
             classes
         )
+        return new_img_tensor, self.make_label(new_boxes, new_classes)
+
+    def make_label(
+            self,
+            boxes: np.ndarray,
+            classes: np.ndarray,
+    ) -> Union[list, np.ndarray]:
+        if self.kinds_name is not None:
+            # (k, 5) kind_id, x, y, x, y
+            return np.concatenate(
+                (classes.reshape(-1, 1), np.asarray(boxes).reshape(-1, 4)), axis=1
+            ).astype(np.float32)
         new_label = []
-        for i in range(new_classes.shape[0]):
+        for i in range(classes.shape[0]):
             new_label.append(
-                (new_classes[i], *new_boxes[i].tolist())
+                (classes[i], *boxes[i].tolist())
             )
-        return new_img_tensor, new_label
+        return new_label
 
     @staticmethod
     def collate_fn(batch):
@@ -193,9 +270,47 @@ class VOCDataSet(Dataset):
         imgs = batch[0]
         labels = batch[1]
         del batch
+        if len(labels) != 0 and isinstance(labels[0], np.ndarray):
+            # (k, 5) arrays --> (N, max_boxes, 5) tensor
+            labels = PaddedLabels.from_arrays(labels)
         return torch.stack(imgs), labels
 
 
+class BuiltTargets(NamedTuple):
+    '''
+    targets built in DataLoader workers (last element of a batch, see TargetCollateFn),
+    the trainer checks this type (not the length of the batch) and uses them directly
+    '''
+    targets: Union[torch.Tensor, dict]
+
+
+class TargetCollateFn:
+    '''
+    collate_fn which also builds targets, so target encoding runs in DataLoader workers
+    (and scales with num_workers) instead of the main process.
+    A batch becomes (*collate_fn(batch), BuiltTargets(targets)), the trainer will use these targets directly.
+    '''
+    def __init__(
+            self,
+            collate_fn: Callable,
+            target_builder: Callable,
+    ):
+        '''
+
+        Args:
+            collate_fn: e.g. VOCDataSet.collate_fn
+            target_builder: picklable, labels --> targets (on cpu), e.g. trainer.target_builder()
+        '''
+        self.collate_fn = collate_fn
+        self.target_builder = target_builder
+
+    def __call__(self, batch):
+        res = self.collate_fn(batch)
+        # (images, labels) or (images, objects, masks)
+        labels = res[1] if len(res) == 2 else list(res[1:])
+        return (*res, BuiltTargets(self.target_builder(labels)))
+
+
 def get_imagenet_dataset(
         root: str,
         transform: Compose,
@@ -220,27 +335,70 @@ def get_voc_data_loader(
         num_workers: int = 0,
         mean: List[float] = [0.5, 0.5, 0.5],
         std: List[float] = [0.5, 0.5, 0.5],
+        target_builder: Callable = None,
+        use_image_shard: bool = False,
+        image_cache: SharedImageCache = None,
+        fused_augmentation: bool = False,
+        batch_augmentation: bool = False,
+        kinds_name: list = None,
+        distributed: bool = False,
 ):
-
+    '''
+
+    Args:
+        root_path:
+        years:
+        image_size:
+        batch_size:
+        train:
+        num_workers:
+        mean:
+        std:
+        target_builder: (only for train) build targets in DataLoader workers, e.g. trainer.target_builder()
+        use_image_shard: read images from packed shards, see VOCDataSet
+        image_cache: decoded images shared by DataLoader workers, see VOCDataSet
+        fused_augmentation: (only for train) use FusedSSDAugmentation, see SSDAugmentation
+        batch_augmentation: (only for train) workers just resize (uint8 images, see ResizeUInt8),
+                            set trainer.batch_augmentation = BatchAugmentation(...) to augment batches on device
+        kinds_name: labels of batches are PaddedLabels (tensors, no kind names), see VOCDataSet
+        distributed: (only for train) DistributedSampler, every process reads its own part of the data set,
+                     batch_size is the batch size of one process (see Tool/BaseTools/distributed.py)
+
+    Returns:
+
+    '''
     if train:
-        transform_train = SSDAugmentation(
-            size=image_size[0],
-            mean=mean,
-            std=std
-        )
+        if batch_augmentation:
+            transform_train = ResizeUInt8(size=image_size[0])
+        else:
+            transform_train = SSDAugmentation(
+                size=image_size[0],
+                mean=mean,
+                std=std,
+                fused=fused_augmentation
+            )
 
         train_d = VOCDataSet(
             root=root_path,
             years=years,
             train=True,
             image_size=image_size,
-            transform=transform_train
+            transform=transform_train,
+            use_image_shard=use_image_shard,
+            image_cache=image_cache,
+            kinds_name=kinds_name
         )
 
+        collate_fn = VOCDataSet.collate_fn
+        if target_builder is not None:
+            collate_fn = TargetCollateFn(collate_fn, target_builder)
+
+        sampler = DistributedSampler(train_d, shuffle=True) if distributed else None
         train_l = DataLoader(train_d,
                              batch_size=batch_size,
-                             collate_fn=VOCDataSet.collate_fn,
-                             shuffle=True,
+                             collate_fn=collate_fn,
+                             shuffle=sampler is None,
+                             sampler=sampler,
                              num_workers=num_workers)
         return train_l
     else:
@@ -255,7 +413,10 @@ def get_voc_data_loader(
             years=years,
             train=False,
             image_size=image_size,
-            transform=transform_test
+            transform=transform_test,
+            use_image_shard=use_image_shard,
+            image_cache=image_cache,
+            kinds_name=kinds_name
         )
 
         test_l = DataLoader(test_d,
@@ -0,0 +1,235 @@
+'''
+Multi-process (DistributedDataParallel) training.
+One process per device (per GPU, or several local processes on cpu with gloo backend for test).
+    init_distributed --> process group (from torchrun env, or from launch_distributed)
+    convert_sync_batch_norm + wrap_ddp --> model
+    get_voc_data_loader(..., distributed=True) --> every process reads its own part of the data set
+    is_main_process --> checkpoint/visualization just on rank 0
+    shard_indexes + gather_to_main --> evaluation split across processes, results gathered to rank 0
+'''
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from typing import Callable
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def init_distributed(
+        rank: int = None,
+        world_size: int = None,
+        backend: str = None,
+        gpu_ids: list = None,
+) -> torch.device:
+    '''
+    Args:
+        rank: None --> from env (RANK, set by torchrun)
+        world_size: None --> from env (WORLD_SIZE)
+        backend: None --> nccl if cuda is available else gloo
+        gpu_ids: device of every local rank, None --> cuda:local_rank (or cpu)
+
+    Returns:
+        device of this process
+    '''
+    rank = int(os.environ.get('RANK', 0)) if rank is None else rank
+    world_size = int(os.environ.get('WORLD_SIZE', 1)) if world_size is None else world_size
+    local_rank = int(os.environ.get('LOCAL_RANK', rank))
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+
+    if backend == 'nccl':
+        device = torch.device('cuda:{}'.format(local_rank if gpu_ids is None else gpu_ids[local_rank]))
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    return device
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def launch_distributed(
+        fn: Callable,
+        world_size: int,
+        *args,
+        master_port: int = 29500,
+):
+    '''
+    start world_size local processes, fn(rank, world_size, *args) is called in every process
+    (use it on one machine without torchrun, e.g. test on cpu)
+    '''
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(master_port)
+    mp.spawn(fn, args=(world_size, *args), nprocs=world_size, join=True)
+
+
+class AllReduceSum(torch.autograd.Function):
+    # sum over all processes, grads are summed too (every process gets grads of the whole batch)
+    @staticmethod
+    def forward(ctx, x: torch.Tensor) -> torch.Tensor:
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor) -> torch.Tensor:
+        grad = grad.clone()
+        dist.all_reduce(grad)
+        return grad
+
+
+class CPUSyncBatchNorm(nn.BatchNorm2d):
+    '''
+    nn.SyncBatchNorm just supports GPU, this one syncs statistics with all_reduce (gloo) for cpu training/test.
+    '''
+    def forward(
+            self,
+            x: torch.Tensor
+    ) -> torch.Tensor:
+        if not (self.training and is_distributed()):
+            return super().forward(x)
+        n = torch.tensor([x.shape[0] * x.shape[2] * x.shape[3]], dtype=x.dtype, device=x.device)
+        # (sum, sum of square, number) of all processes, grads flow back to every process
+        stats = AllReduceSum.apply(torch.cat((x.sum(dim=(0, 2, 3)), (x * x).sum(dim=(0, 2, 3)), n)))
+        C = x.shape[1]
+        count = stats[-1]
+        mean = stats[:C] / count
+        var = (stats[C:2 * C] / count - mean * mean).clamp(min=0)
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked.add_(1)
+                momentum = self.momentum if self.momentum is not None else 1.0 / float(self.num_batches_tracked)
+                self.running_mean.mul_(1 - momentum).add_(momentum * mean)
+                self.running_var.mul_(1 - momentum).add_(momentum * var * count / (count - 1).clamp(min=1))
+
+        x = (x - mean[None, :, None, None]) * torch.rsqrt(var[None, :, None, None] + self.eps)
+        if self.affine:
+            x = x * self.weight[None, :, None, None] + self.bias[None, :, None, None]
+        return x
+
+
+def convert_sync_batch_norm(
+        model: nn.Module,
+        device: torch.device,
+) -> nn.Module:
+    '''
+    BatchNorm2d --> synced BatchNorm (statistics of the whole batch of all processes)
+    '''
+    if device.type == 'cuda':
+        return nn.SyncBatchNorm.convert_sync_batchnorm(model)
+
+    def convert(module: nn.Module) -> nn.Module:
+        res = module
+        if isinstance(module, nn.BatchNorm2d) and not isinstance(module, CPUSyncBatchNorm):
+            res = CPUSyncBatchNorm(
+                module.num_features, module.eps, module.momentum, module.affine, module.track_running_stats
+            )
+            res.load_state_dict(module.state_dict())
+            res.train(module.training)
+        for name, child in module.named_children():
+            res.add_module(name, convert(child))
+        return res
+
+    return convert(model)
+
+
+def wrap_ddp(
+        model: nn.Module,
+        device: torch.device,
+        sync_bn: bool = True,
+        find_unused_parameters: bool = False,
+) -> DistributedDataParallel:
+    '''
+    model (not on device) --> DistributedDataParallel, model itself is ddp_model.module
+    (use the module itself for checkpoint/visualization/evaluation on rank 0)
+    '''
+    if sync_bn:
+        model = convert_sync_batch_norm(model, device)
+    model.to(device)
+    return DistributedDataParallel(
+        model,
+        device_ids=[device.index] if device.type == 'cuda' else None,
+        find_unused_parameters=find_unused_parameters,
+    )
+
+
+def unwrap_model(
+        model: nn.Module
+) -> nn.Module:
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def all_reduce_mean(
+        x: float
+) -> float:
+    # mean of a python number over all processes (e.g. loss info)
+    if not is_distributed():
+        return x
+    t = torch.tensor([x], dtype=torch.float64)
+    if dist.get_backend() == 'nccl':
+        t = t.cuda()
+    dist.all_reduce(t)
+    return t.item() / get_world_size()
+
+
+def shard_indexes(
+        number: int
+) -> list:
+    '''
+    indexes (of a data set) of this process --> rank, rank + world_size, ...
+    (no padding as DistributedSampler, every index is in just one process, used by evaluation)
+    '''
+    return list(range(get_rank(), number, get_world_size()))
+
+
+def gather_to_main(
+        obj
+):
+    '''
+    Returns:
+        [obj of rank 0, obj of rank 1, ...] on rank 0, None on other ranks
+    '''
+    if not is_distributed():
+        return [obj]
+    res = [None] * get_world_size() if is_main_process() else None
+    dist.gather_object(obj, res, dst=0)
+    return res
+
+
+def broadcast_from_main(
+        obj
+):
+    # obj of rank 0 --> all ranks
+    if not is_distributed():
+        return obj
+    res = [obj]
+    dist.broadcast_object_list(res, src=0)
+    return res[0]
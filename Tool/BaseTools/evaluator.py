@@ -2,12 +2,14 @@
 Used for evaluating some metrics of detector.
 '''
 from abc import abstractmethod
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 from .tools import BaseTools
 from .predictor import BasePredictor
 import numpy as np
 from .model import BaseModel
+from .prefetcher import DevicePrefetcher
+from .distributed import is_distributed, is_main_process, shard_indexes, gather_to_main, broadcast_from_main
 
 
 class BaseEvaluator:
@@ -51,19 +53,66 @@ class BaseEvaluator:
     ):
         pass
 
+    def image_tp_score_and_gt_num(
+            self,
+            pre_kps_vec: list,
+            gt_kps_vec: list,
+    ) -> tuple:
+        '''
+        result of one image (compact, gathered between processes)
+        Returns:
+            kind_index (K, ), is_tp (K, ), score (K, ), gt_num (kinds_number, )
+        '''
+        kind_tp_and_score, gt_num = BaseTools.get_pre_kind_name_tp_score_and_gt_num(
+            pre_kps_vec,
+            gt_kps_vec,
+            kinds_name=self.kinds_name,
+            iou_th=self.iou_th_for_eval
+        )
+        kind_index = np.array([self.kinds_name.index(val[0]) for val in kind_tp_and_score], dtype=np.int64)
+        is_tp = np.array([val[1] for val in kind_tp_and_score], dtype=np.int64)
+        score = np.array([val[2] for val in kind_tp_and_score])
+        gt_num = np.array([gt_num[kind_name] for kind_name in self.kinds_name], dtype=np.int64)
+        return kind_index, is_tp, score, gt_num
+
     def eval_detector_mAP(
             self,
             data_loader_test: DataLoader,
             desc: str = 'eval detector mAP',
-    ):
-        # compute mAP
-        record = {
-            key: [[], [], 0] for key in self.kinds_name
-            # kind_name: [tp_list, score_list, gt_num]
-        }
-        for batch_id, (images, labels) in enumerate(tqdm(data_loader_test,
+            distributed: bool = False,
+    ) -> float:
+        '''
+
+        Args:
+            data_loader_test:
+            desc:
+            distributed: (all processes of the process group call it, see Tool/BaseTools/distributed.py)
+                         every process evaluates its part of images, results are gathered to rank 0
+
+        Returns:
+            mAP (of all images, on all processes)
+        '''
+        use_distributed = distributed and is_distributed()
+        image_indexes = list(range(len(data_loader_test.dataset)))
+        if use_distributed:
+            # every image in just one process (DistributedSampler pads, padded images would be counted twice)
+            image_indexes = shard_indexes(len(data_loader_test.dataset))
+            data_loader_test = DataLoader(
+                Subset(data_loader_test.dataset, image_indexes),
+                batch_size=data_loader_test.batch_size,
+                shuffle=False,
+                num_workers=data_loader_test.num_workers,
+                collate_fn=data_loader_test.collate_fn,
+                pin_memory=data_loader_test.pin_memory,
+                # only valid with workers
+                persistent_workers=data_loader_test.persistent_workers and data_loader_test.num_workers > 0
+            )
+
+        res_vec = []
+        for batch_id, (images, labels) in enumerate(tqdm(DevicePrefetcher(data_loader_test, self.device, keys=(0, )),
                                                          desc=desc,
-                                                         position=0)):
+                                                         position=0,
+                                                         disable=not is_main_process())):
             self.detector.eval()
             images = images.to(self.device)
 
@@ -74,29 +123,34 @@ class BaseEvaluator:
             pre_decode = self.predictor.decode_predict(output)  # kps_vec_s
 
             for image_index in range(images.shape[0]):
-
-                res = BaseTools.get_pre_kind_name_tp_score_and_gt_num(
-                    pre_decode[image_index],
-                    gt_decode[image_index],
-                    kinds_name=self.kinds_name,
-                    iou_th=self.iou_th_for_eval
+                res_vec.append(
+                    self.image_tp_score_and_gt_num(pre_decode[image_index], gt_decode[image_index])
                 )
+        # end for dataloader
 
-                for pre_kind_name, is_tp, pre_score in res[0]:
-                    record[pre_kind_name][0].append(is_tp)  # tp list
-                    record[pre_kind_name][1].append(pre_score)  # score list
+        gathered = gather_to_main((image_indexes, res_vec))
+        if not is_main_process():
+            return broadcast_from_main(None)
 
-                for kind_name, gt_num in res[1].items():
-                    record[kind_name][2] += gt_num
+        # results of all images, in the order of the data set (same as one process)
+        res_of_image = {}
+        for indexes, vec in gathered:
+            res_of_image.update(zip(indexes, vec))
+        res_vec = [res_of_image[i] for i in sorted(res_of_image.keys())]
 
-        # end for dataloader
         ap_vec = []
-        for kind_name in self.kinds_name:
-            tp_list, score_list, gt_num = record[kind_name]
+        for kind_ind, kind_name in enumerate(self.kinds_name):
+            if len(res_vec) == 0:
+                # empty test set (np.concatenate of nothing raises), no gt --> AP 0
+                ap_vec.append(0.)
+                continue
+            tp_list = np.concatenate([is_tp[kind_index == kind_ind] for kind_index, is_tp, _, _ in res_vec])
+            score_list = np.concatenate([score[kind_index == kind_ind] for kind_index, _, score, _ in res_vec])
+            gt_num = sum(int(val[3][kind_ind]) for val in res_vec)
             recall, precision = BaseTools.calculate_pr(gt_num, tp_list, score_list)
             kind_name_ap = BaseTools.voc_ap(recall, precision)
             ap_vec.append(kind_name_ap)
 
         mAP = np.mean(ap_vec)
         print('\nmAP:{:.2%}'.format(mAP))
-
+        return broadcast_from_main(mAP)
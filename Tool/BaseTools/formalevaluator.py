@@ -3,17 +3,21 @@ This packet is modified from --formal evaluate methods--.
 But I just recommend using default version (use_07=True, just evaluate VOC2007)
 '''
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, Subset
 import numpy as np
 from Tool.BaseTools.predictor import BasePredictor
-from torch.autograd import Variable
+from Tool.BaseTools.annotation_index import VOCAnnotationIndex
+from Tool.BaseTools.distributed import is_distributed, is_main_process, shard_indexes, gather_to_main, \
+    broadcast_from_main
 import time
 import pickle
 import os
 import os.path as osp
 import cv2
 import sys
+import multiprocessing
 from abc import abstractmethod
+from typing import List
 
 if sys.version_info[0] == 2:
     import xml.etree.cElementTree as ET
@@ -49,8 +53,34 @@ class BaseFormalEvaluator:
             transform,
             labelmap: list,
             display=False,
-            use_07: bool = True
+            use_07: bool = True,
+            batch_size: int = 1,
+            num_workers: int = 0,
+            export_txt: bool = False,
+            eval_workers: int = 0,
+            distributed: bool = False,
     ):
+        '''
+
+        Args:
+            predictor:
+            data_root:
+            img_size:
+            device:
+            transform:
+            labelmap:
+            display:
+            use_07:
+            batch_size: images of one forward in evaluate
+            num_workers: workers of the DataLoader used in evaluate
+            export_txt: write det_test_*.txt(VOCdevkit results files) and compute AP from them,
+                        default compute AP from all_boxes in memory
+            eval_workers: number of processes computing per-class AP (0 --> in this process).
+                          workers are started by forkserver/spawn (not fork, it is unsafe after cuda init
+                          or with threads, e.g. DevicePrefetcher), they just get the arrays of every class
+            distributed: (all processes of the process group call evaluate, see Tool/BaseTools/distributed.py)
+                         every process detects its part of images, detections are gathered to rank 0 for AP
+        '''
         self.predictor = predictor
         self.data_root = data_root
         self.img_size = img_size
@@ -65,6 +95,13 @@ class BaseFormalEvaluator:
 
         self.display = display
         self.use_07 = use_07
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.export_txt = export_txt
+        self.eval_workers = eval_workers
+        self.distributed = distributed
+        self.map = None  # type: float
+        self.recs = None  # type: dict
         # path
 
         self.devkit_path = os.path.join(data_root, self.year, self.set_type)
@@ -88,17 +125,21 @@ class BaseFormalEvaluator:
     ):
         pass
 
-    def get_predict_info(
+    def get_kps_vec_s(
             self,
-            net,
-            x: torch.Tensor,
+            out
+    ) -> List[List]:
+        '''
+        decode model output of batch images
+        Returns:
+            kps_vec_s --> [kps_vec0, kps_vec1, ...]
+        '''
+        return self.predictor.decode_predict(out)
 
+    def kps_vec_to_predict_info(
+            self,
+            kps_vec: List
     ) -> dict:
-        assert len(x.shape) == 4 and x.shape[0] == 1
-
-        out = net(x)
-        kps_vec = self.predictor.decode_one_predict(out)
-
         bboxes = []
         scores = []
         cls_inds = []
@@ -120,48 +161,125 @@ class BaseFormalEvaluator:
             'cls_inds': cls_inds
         }
 
+    def get_predict_info(
+            self,
+            net,
+            x: torch.Tensor,
+
+    ) -> dict:
+        assert len(x.shape) == 4 and x.shape[0] == 1
+
+        return self.get_predict_info_batch(net, x)[0]
+
+    def get_predict_info_batch(
+            self,
+            net,
+            x: torch.Tensor,
+    ) -> List[dict]:
+        out = net(x)
+        return [
+            self.kps_vec_to_predict_info(kps_vec) for kps_vec in self.get_kps_vec_s(out)
+        ]
+
+    def get_data_loader(
+            self,
+            image_indexes: list = None,
+    ) -> DataLoader:
+        dataset = VOCDetectionForEval(self.dataset)
+        if image_indexes is not None:
+            dataset = Subset(dataset, image_indexes)
+        return DataLoader(
+            dataset,
+            batch_size=self.batch_size,
+            shuffle=False,
+            num_workers=self.num_workers,
+            collate_fn=VOCDetectionForEval.collate_fn
+        )
+
+    def predict_info_to_dets(
+            self,
+            res: dict,
+            h: int,
+            w: int,
+    ) -> np.ndarray:
+        '''
+        detections of one image (compact, gathered between processes)
+        Returns:
+            (K, 6) float32 --> kind_index, x1, y1, x2, y2, score (sorted by kind_index)
+        '''
+        bboxes = res.get('bboxes')
+        scores = res.get('scores')
+        cls_inds = res.get('cls_inds')
+        if len(bboxes) == 0:
+            return np.empty([0, 6], dtype=np.float32)
+        bboxes = bboxes * np.array([[w, h, w, h]])
+        dets = np.hstack((cls_inds[:, np.newaxis], bboxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
+        # stable --> same order as np.where(cls_inds == j)
+        return dets[np.argsort(cls_inds, kind='stable')]
+
+    def dets_to_all_boxes(
+            self,
+            dets_vec: List[np.ndarray],
+    ) -> List[List[np.ndarray]]:
+        '''
+        Args:
+            dets_vec: dets of all images (see predict_info_to_dets)
+
+        Returns:
+            all_boxes[cls][image] = N x 5 array of detections in (x1, y1, x2, y2, score)
+        '''
+        all_boxes = [[[] for _ in range(len(dets_vec))]
+                     for _ in range(len(self.labelmap))]
+        for i, dets in enumerate(dets_vec):
+            kind_index = dets[:, 0]
+            for j in range(len(self.labelmap)):
+                all_boxes[j][i] = dets[kind_index == j, 1:]
+        return all_boxes
+
     def evaluate(self, net):
         net.eval()
         num_images = len(self.dataset)
-        # all detections are collected into:
-        #    all_boxes[cls][image] = N x 5 array of detections in
-        #    (x1, y1, x2, y2, score)
-        self.all_boxes = [[[] for _ in range(num_images)]
-                          for _ in range(len(self.labelmap))]
+        use_distributed = self.distributed and is_distributed()
+        # images of this process
+        image_indexes = shard_indexes(num_images) if use_distributed else list(range(num_images))
 
         # timers
         det_file = os.path.join(self.output_dir, 'detections.pkl')
 
-        for i in range(num_images):
-            im, gt, h, w = self.dataset.pull_item(i)
-
-            x = Variable(im.unsqueeze(0)).to(self.device)
+        dets_vec = []
+        for images, hs, ws in self.get_data_loader(image_indexes if use_distributed else None):
+            x = images.to(self.device)
             t0 = time.time()
             # forward
             # bboxes, scores, cls_inds = net(x)
-            res = self.get_predict_info(net, x)
-            bboxes = res.get('bboxes')
-            scores = res.get('scores')
-            cls_inds = res.get('cls_inds')
+            with torch.no_grad():
+                res_vec = self.get_predict_info_batch(net, x)
 
             detect_time = time.time() - t0
-            scale = np.array([[w, h, w, h]])
-            if len(bboxes) != 0:
-                bboxes *= scale
-            for j in range(len(self.labelmap)):
-                inds = np.where(cls_inds == j)[0]
-                if len(inds) == 0:
-                    self.all_boxes[j][i] = np.empty([0, 5], dtype=np.float32)
-                    continue
-                c_bboxes = bboxes[inds]
-                c_scores = scores[inds]
-                c_dets = np.hstack((c_bboxes,
-                                    c_scores[:, np.newaxis])).astype(np.float32,
-                                                                     copy=False)
-                self.all_boxes[j][i] = c_dets
-
-            if i % 500 == 0:
-                print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1, num_images, detect_time))
+            for res, h, w in zip(res_vec, hs, ws):
+                i = len(dets_vec)
+                dets_vec.append(self.predict_info_to_dets(res, h, w))
+
+                # images of this process (just printed by rank 0)
+                if i % 500 == 0 and is_main_process():
+                    print('im_detect: {:d}/{:d} {:.3f}s'.format(i + 1, len(image_indexes), detect_time))
+
+        if use_distributed:
+            # (image_indexes, dets_vec) of all processes --> rank 0, in the order of images
+            gathered = gather_to_main((image_indexes, dets_vec))
+            if not is_main_process():
+                self.map = broadcast_from_main(None)
+                return
+            all_dets_vec = [None] * num_images
+            for indexes, vec in gathered:
+                for index, dets in zip(indexes, vec):
+                    all_dets_vec[index] = dets
+            dets_vec = all_dets_vec
+
+        # all detections are collected into:
+        #    all_boxes[cls][image] = N x 5 array of detections in
+        #    (x1, y1, x2, y2, score)
+        self.all_boxes = self.dets_to_all_boxes(dets_vec)
 
         with open(det_file, 'wb') as f:
             pickle.dump(self.all_boxes, f, pickle.HIGHEST_PROTOCOL)
@@ -170,6 +288,8 @@ class BaseFormalEvaluator:
         self.evaluate_detections(self.all_boxes)
 
         print('Mean AP: {:.2%}'.format(self.map))
+        if use_distributed:
+            broadcast_from_main(self.map)
 
     def parse_rec(self, filename):
         """ Parse a PASCAL VOC xml file """
@@ -193,6 +313,24 @@ class BaseFormalEvaluator:
 
         return objects
 
+    def parse_rec_from_index(self, annotation_index: VOCAnnotationIndex, i: int):
+        """ same as parse_rec, but read from pre-parsed annotation index """
+        objects = []
+        boxes = annotation_index.boxes_of(i).astype(np.int64).tolist()
+        for k, name in enumerate(annotation_index.kinds_name_of(i)):
+            obj_struct = {}
+
+            if self.use_07:
+                obj_struct['pose'] = annotation_index.poses_of(i)[k]
+                obj_struct['truncated'] = int(annotation_index.truncated_of(i)[k])
+                obj_struct['difficult'] = int(annotation_index.difficult_of(i)[k])
+
+            obj_struct['name'] = name
+            obj_struct['bbox'] = boxes[k]
+            objects.append(obj_struct)
+
+        return objects
+
     def get_output_dir(self, name, phase):
         """Return the directory where experimental artifacts are placed.
         If the directory does not exist, it is created.
@@ -221,7 +359,7 @@ class BaseFormalEvaluator:
             with open(filename, 'wt') as f:
                 for im_ind, index in enumerate(self.dataset.ids):
                     dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
+                    if len(dets) == 0:
                         continue
                     # the VOCdevkit expects 1-based indices
                     for k in range(dets.shape[0]):
@@ -230,22 +368,42 @@ class BaseFormalEvaluator:
                                     dets[k, 0] + 1, dets[k, 1] + 1,
                                     dets[k, 2] + 1, dets[k, 3] + 1))
 
-    def do_python_eval(self, use_07=True):
-        cachedir = os.path.join(self.devkit_path, 'annotations_cache')
+    def do_python_eval(self, use_07=True, all_boxes=None):
+        '''
+
+        Args:
+            use_07:
+            all_boxes: all_boxes[cls][image], if None, read detections from det_test_*.txt
+
+        Returns:
+
+        '''
         aps = []
         # The PASCAL VOC metric changed in 2010
         use_07_metric = use_07
         print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
         if not os.path.isdir(self.output_dir):
             os.mkdir(self.output_dir)
+        if self.eval_workers > 0:
+            # gt/detections of every class are passed explicitly, workers do not need the evaluator
+            args_vec = [
+                self.get_class_eval_args(i, all_boxes, use_07_metric) for i in range(len(self.labelmap))
+            ]
+            job_ind = [i for i, args in enumerate(args_vec) if args is not None]
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            with multiprocessing.get_context(start_method).Pool(self.eval_workers) as pool:
+                # starmap keeps the order of classes
+                job_res_vec = pool.starmap(BaseFormalEvaluator.compute_rec_prec_ap, [args_vec[i] for i in job_ind])
+            res_vec = [(-1., -1., -1.)] * len(self.labelmap)
+            for i, res in zip(job_ind, job_res_vec):
+                res_vec[i] = res
+        else:
+            res_vec = [
+                self.eval_one_class(i, all_boxes, use_07_metric) for i in range(len(self.labelmap))
+            ]
+
         for i, cls in enumerate(self.labelmap):
-            filename = self.get_voc_results_file_template(cls)
-            rec, prec, ap = self.voc_eval(detpath=filename,
-                                          classname=cls,
-                                          cachedir=cachedir,
-                                          ovthresh=0.5,
-                                          use_07_metric=use_07_metric
-                                        )
+            rec, prec, ap = res_vec[i]
             aps += [ap]
             print('AP for {} = {:.4f}'.format(cls, ap))
             with open(os.path.join(self.output_dir, cls + '_pr.pkl'), 'wb') as f:
@@ -268,7 +426,38 @@ class BaseFormalEvaluator:
             self.map = np.mean(aps)
             print('Mean AP = {:.4f}'.format(np.mean(aps)))
 
-    def voc_ap(self, rec, prec, use_07_metric=True):
+    def eval_one_class(self, i, all_boxes, use_07_metric=True):
+        '''
+        AP of one class (labelmap[i]) in this process
+
+        Returns:
+            rec, prec, ap (-1 if no detection of this class)
+        '''
+        args = self.get_class_eval_args(i, all_boxes, use_07_metric)
+        if args is None:
+            return -1., -1., -1.
+        return self.compute_rec_prec_ap(*args)
+
+    def get_class_eval_args(self, i, all_boxes, use_07_metric=True):
+        '''
+        gt and detections of one class (labelmap[i]), all_boxes is None --> read detections from det_test_*.txt
+
+        Returns:
+            args of compute_rec_prec_ap, None if no detection of this class
+        '''
+        cls = self.labelmap[i]
+        class_recs, npos = self.get_class_recs(self.get_recs(), cls)
+        if all_boxes is None:
+            dets = self.read_dets_from_txt(self.get_voc_results_file_template(cls), cls)
+        else:
+            dets = self.read_dets_from_boxes(all_boxes[i])
+        if dets is None:
+            return None
+        image_ids, confidence, BB = dets
+        return class_recs, npos, image_ids, confidence, BB, 0.5, use_07_metric
+
+    @staticmethod
+    def voc_ap(rec, prec, use_07_metric=True):
         """ ap = voc_ap(rec, prec, [use_07_metric])
         Compute VOC AP given precision and recall.
         If use_07_metric is true, uses the
@@ -301,49 +490,45 @@ class BaseFormalEvaluator:
             ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
         return ap
 
-    def voc_eval(self, detpath, classname, cachedir, ovthresh=0.5, use_07_metric=True):
-        if not os.path.isdir(cachedir):
-            os.mkdir(cachedir)
-        cachefile = os.path.join(cachedir, 'annots.pkl')
+    def get_recs(self):
+        """
+        ground-truth of all test images, read from the annotation index(rebuilt when xml changes) only once
+        (annotations_cache/annots.pkl is not written or read any more)
+        """
+        if self.recs is not None:
+            return self.recs
+
         # read list of images
         with open(self.imgsetpath, 'r') as f:
             lines = f.readlines()
         imagenames = [x.strip() for x in lines]
-        if not os.path.isfile(cachefile):
-            # load annots
-            recs = {}
-            for i, imagename in enumerate(imagenames):
-                recs[imagename] = self.parse_rec(self.annopath % (imagename))
-                if i % 100 == 0 and self.display:
-                    print('Reading annotation for {:d}/{:d}'.format(
-                    i + 1, len(imagenames)))
-            # save
-            if self.display:
-                print('Saving cached annotations to {:s}'.format(cachefile))
-            with open(cachefile, 'wb') as f:
-                pickle.dump(recs, f)
-        else:
-            # load
-            with open(cachefile, 'rb') as f:
-                recs = pickle.load(f)
+        annotation_index = self.dataset.annotation_index[self.devkit_path]
+        self.recs = {
+            imagename: self.parse_rec_from_index(annotation_index, annotation_index.index_of(imagename))
+            for imagename in imagenames
+        }
+        return self.recs
 
+    def get_class_recs(self, recs, classname):
         # extract gt objects for this class
         class_recs = {}
         npos = 0
-        for imagename in imagenames:
-            R = [obj for obj in recs[imagename] if obj['name'] == classname]
+        for imagename, objects in recs.items():
+            R = [obj for obj in objects if obj['name'] == classname]
             bbox = np.array([x['bbox'] for x in R])
             if self.use_07:
-                difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
+                difficult = np.array([x['difficult'] for x in R]).astype(bool)
             else:
-                difficult = np.array([0 for _ in R]).astype(np.bool)
+                difficult = np.array([0 for _ in R]).astype(bool)
             det = [False] * len(R)
             npos = npos + sum(~difficult)
             class_recs[imagename] = {'bbox': bbox,
                                     'difficult': difficult,
                                     'det': det}
+        return class_recs, npos
 
-        # read dets
+    def read_dets_from_txt(self, detpath, classname):
+        """ (image_ids, confidence, BB) of det_test_*.txt, None if no detection """
         detfile = detpath.format(classname)
         with open(detfile, 'r') as f:
             lines = f.readlines()
@@ -353,68 +538,139 @@ class BaseFormalEvaluator:
             image_ids = [x[0] for x in splitlines]
             confidence = np.array([float(x[1]) for x in splitlines])
             BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
-
-            # sort by confidence
-            sorted_ind = np.argsort(-confidence)
-            sorted_scores = np.sort(-confidence)
-            BB = BB[sorted_ind, :]
-            image_ids = [image_ids[x] for x in sorted_ind]
-
-            # go down dets and mark TPs and FPs
-            nd = len(image_ids)
-            tp = np.zeros(nd)
-            fp = np.zeros(nd)
-            for d in range(nd):
-                R = class_recs[image_ids[d]]
-                bb = BB[d, :].astype(float)
-                ovmax = -np.inf
-                BBGT = R['bbox'].astype(float)
-                if BBGT.size > 0:
-                    # compute overlaps
-                    # intersection
-                    ixmin = np.maximum(BBGT[:, 0], bb[0])
-                    iymin = np.maximum(BBGT[:, 1], bb[1])
-                    ixmax = np.minimum(BBGT[:, 2], bb[2])
-                    iymax = np.minimum(BBGT[:, 3], bb[3])
-                    iw = np.maximum(ixmax - ixmin, 0.)
-                    ih = np.maximum(iymax - iymin, 0.)
-                    inters = iw * ih
-                    uni = ((bb[2] - bb[0]) * (bb[3] - bb[1]) +
-                        (BBGT[:, 2] - BBGT[:, 0]) *
-                        (BBGT[:, 3] - BBGT[:, 1]) - inters)
-                    overlaps = inters / uni
-                    ovmax = np.max(overlaps)
-                    jmax = np.argmax(overlaps)
-
-                if ovmax > ovthresh:
-                    if not R['difficult'][jmax]:
-                    # if True:
-                        if not R['det'][jmax]:
-                            tp[d] = 1.
-                            R['det'][jmax] = 1
-                        else:
-                            fp[d] = 1.
-                else:
-                    fp[d] = 1.
-
-            # compute precision recall
-            fp = np.cumsum(fp)
-            tp = np.cumsum(tp)
-            rec = tp / float(npos)
-            # avoid divide by zero in case the first detection matches a difficult
-            # ground truth
-            prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-            ap = self.voc_ap(rec, prec, use_07_metric)
-        else:
-            rec = -1.
-            prec = -1.
-            ap = -1.
+            return image_ids, confidence, BB
+        return None
+
+    def read_dets_from_boxes(self, cls_boxes):
+        """ same as read_dets_from_txt, but detections come from all_boxes[cls] """
+        image_ids = []
+        dets_vec = []
+        for im_ind, index in enumerate(self.dataset.ids):
+            dets = cls_boxes[im_ind]
+            if len(dets) == 0:
+                continue
+            image_ids += [index[1]] * dets.shape[0]
+            dets_vec.append(dets)
+
+        if len(dets_vec) != 0:
+            dets = np.concatenate(dets_vec, axis=0)
+            # rounded as in det_test_*.txt, export_txt does not change AP
+            confidence = self.round_as_txt(dets[:, -1], 3)
+            # the VOCdevkit expects 1-based indices
+            BB = self.round_as_txt(dets[:, :4] + 1, 1)
+            return image_ids, confidence, BB
+        return None
+
+    @staticmethod
+    def round_as_txt(x, decimals):
+        """ same value as float('{:.{decimals}f}'.format(x)) of write_voc_results_file, float64 """
+        return np.array(
+            ['{:.{}f}'.format(val, decimals) for val in x.reshape(-1).tolist()], dtype=np.float64
+        ).reshape(x.shape)
+
+    @staticmethod
+    def compute_rec_prec_ap(class_recs, npos, image_ids, confidence, BB, ovthresh=0.5, use_07_metric=True):
+        # static (no evaluator state), runs in eval_workers
+        # sort by confidence
+        sorted_ind = np.argsort(-confidence)
+        sorted_scores = np.sort(-confidence)
+        BB = BB[sorted_ind, :]
+        image_ids = [image_ids[x] for x in sorted_ind]
+
+        # go down dets and mark TPs and FPs
+        tp, fp = BaseFormalEvaluator.compute_tp_fp(class_recs, image_ids, BB, ovthresh)
+
+        # compute precision recall
+        fp = np.cumsum(fp)
+        tp = np.cumsum(tp)
+        rec = tp / float(npos)
+        # avoid divide by zero in case the first detection matches a difficult
+        # ground truth
+        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        ap = BaseFormalEvaluator.voc_ap(rec, prec, use_07_metric)
 
         return rec, prec, ap
 
+    @staticmethod
+    def compute_tp_fp(class_recs, image_ids, BB, ovthresh=0.5, chunk_elements=2 ** 16):
+        """
+        tp/fp of detections(sorted by confidence) for one class, in array form.
+        The overlaps of detections with (padded) gt boxes of their image are computed in chunks of detections
+        (memory O(chunk_size * max_gt_number) instead of O(nd * max_gt_number)).
+        The gt a detection may claim(jmax) does not depend on the others, so the greedy
+        assignment is: the first detection claiming a non-difficult gt is tp, later ones are fp.
+        """
+        nd = len(image_ids)
+        image_names = list(class_recs.keys())
+        image_name_to_ind = {name: i for i, name in enumerate(image_names)}
+        gt_number = [len(class_recs[name]['difficult']) for name in image_names]
+        max_gt_number = max(gt_number + [1])
+
+        BBGT = np.zeros(shape=(len(image_names), max_gt_number, 4), dtype=float)
+        is_gt = np.zeros(shape=(len(image_names), max_gt_number), dtype=bool)
+        difficult = np.zeros(shape=(len(image_names), max_gt_number), dtype=bool)
+        for i, name in enumerate(image_names):
+            if gt_number[i] == 0:
+                continue
+            BBGT[i, :gt_number[i]] = class_recs[name]['bbox'].astype(float)
+            is_gt[i, :gt_number[i]] = True
+            difficult[i, :gt_number[i]] = class_recs[name]['difficult']
+
+        image_ind = np.array([image_name_to_ind[x] for x in image_ids], dtype=np.int64)
+        # (nd, )
+        bb_all = BB.astype(float)
+        ovmax = np.zeros(shape=(nd, ), dtype=float)
+        jmax = np.zeros(shape=(nd, ), dtype=np.int64)
+        chunk_size = max(chunk_elements // max_gt_number, 1)
+        for start in range(0, nd, chunk_size):
+            chunk_ind = image_ind[start:start + chunk_size]
+            bb = bb_all[start:start + chunk_size]
+            gt = BBGT[chunk_ind]
+            # (chunk_size, max_gt_number, 4)
+
+            # compute overlaps
+            # intersection
+            ixmin = np.maximum(gt[..., 0], bb[:, 0:1])
+            iymin = np.maximum(gt[..., 1], bb[:, 1:2])
+            ixmax = np.minimum(gt[..., 2], bb[:, 2:3])
+            iymax = np.minimum(gt[..., 3], bb[:, 3:4])
+            iw = np.maximum(ixmax - ixmin, 0.)
+            ih = np.maximum(iymax - iymin, 0.)
+            inters = iw * ih
+            uni = ((bb[:, 2:3] - bb[:, 0:1]) * (bb[:, 3:4] - bb[:, 1:2]) +
+                   (gt[..., 2] - gt[..., 0]) *
+                   (gt[..., 3] - gt[..., 1]) - inters)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                overlaps = inters / uni
+            overlaps[~is_gt[chunk_ind]] = -np.inf
+            # (chunk_size, max_gt_number)
+
+            ovmax[start:start + chunk_size] = np.max(overlaps, axis=1)
+            jmax[start:start + chunk_size] = np.argmax(overlaps, axis=1)
+
+        is_hit = ovmax > ovthresh
+        claim = is_hit & ~difficult[image_ind, jmax]
+
+        # first claim of every gt box(image_ind, jmax)
+        claim_ind = np.nonzero(claim)[0]
+        _, first_ind = np.unique(image_ind[claim_ind] * max_gt_number + jmax[claim_ind], return_index=True)
+        is_tp = np.zeros(shape=(nd, ), dtype=bool)
+        is_tp[claim_ind[first_ind]] = True
+
+        for i in claim_ind[first_ind]:
+            class_recs[image_ids[i]]['det'][jmax[i]] = 1
+
+        tp = is_tp.astype(float)
+        fp = (~is_hit | (claim & ~is_tp)).astype(float)
+        return tp, fp
+
     def evaluate_detections(self, box_list):
-        self.write_voc_results_file(box_list)
-        self.do_python_eval(self.use_07)
+        if self.export_txt:
+            self.write_voc_results_file(box_list)
+            self.do_python_eval(self.use_07)
+        else:
+            self.do_python_eval(self.use_07, box_list)
+
 
 
 ###############################################################
@@ -479,6 +735,35 @@ class VOCAnnotationTransform(object):
 
         return res  # [[xmin, ymin, xmax, ymax, label_ind], ... ]
 
+    def from_index(self, annotation_index: VOCAnnotationIndex, i, width, height):
+        """
+        same as __call__, but read objects of image i from pre-parsed annotation index
+        """
+        res = []
+        boxes = annotation_index.boxes_of(i).astype(np.int64) - 1
+        difficult_vec = annotation_index.difficult_of(i)
+        for k, name in enumerate(annotation_index.kinds_name_of(i)):
+
+            if self.use_07:
+                difficult = difficult_vec[k] == 1
+            else:
+                difficult = 0
+
+            if not self.keep_difficult and difficult:
+                continue
+
+            name = name.lower().strip()
+            bndbox = [
+                boxes[k, 0].item() / width,
+                boxes[k, 1].item() / height,
+                boxes[k, 2].item() / width,
+                boxes[k, 3].item() / height,
+                self.class_to_ind[name]
+            ]
+            res += [bndbox]  # [xmin, ymin, xmax, ymax, label_ind]
+
+        return res  # [[xmin, ymin, xmax, ymax, label_ind], ... ]
+
 
 class VOCDetection(Dataset):
     """VOC Detection Dataset Object
@@ -522,6 +807,10 @@ class VOCDetection(Dataset):
             rootpath = osp.join(self.root, year, name)
             for line in open(osp.join(rootpath, 'ImageSets', 'Main', name + '.txt')):
                 self.ids.append((rootpath, line.strip()))
+        # pre-parsed xml of every rootpath
+        self.annotation_index = {
+            rootpath: VOCAnnotationIndex(rootpath) for rootpath in sorted(set(rootpath for rootpath, _ in self.ids))
+        }
 
     def __getitem__(self, index):
         im, gt, h, w = self.pull_item(index)
@@ -534,12 +823,11 @@ class VOCDetection(Dataset):
     def pull_item(self, index):
         img_id = self.ids[index]
 
-        target = ET.parse(self._annopath % img_id).getroot()
+        annotation_index = self.annotation_index[img_id[0]]
         img = cv2.imread(self._imgpath % img_id)
         height, width, channels = img.shape
 
-        if self.target_transform is not None:
-            target = self.target_transform(target, width, height)
+        target = self.target_transform.from_index(annotation_index, annotation_index.index_of(img_id[1]), width, height)
 
         if self.transform is not None:
 
@@ -579,6 +867,26 @@ class VOCDetection(Dataset):
                 eg: ('001718', [('dog', (96, 13, 438, 332))])
         '''
         img_id = self.ids[index]
-        anno = ET.parse(self._annopath % img_id).getroot()
-        gt = self.target_transform(anno, 1, 1)
+        annotation_index = self.annotation_index[img_id[0]]
+        gt = self.target_transform.from_index(annotation_index, annotation_index.index_of(img_id[1]), 1, 1)
         return img_id[1], gt
+
+
+class VOCDetectionForEval(Dataset):
+    """
+    used by BaseFormalEvaluator.evaluate, batch --> (images, heights, widths)
+    """
+    def __init__(self, dataset: VOCDetection):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        im, _, h, w = self.dataset.pull_item(index)
+        return im, h, w
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @staticmethod
+    def collate_fn(batch):
+        imgs, hs, ws = list(zip(*batch))
+        return torch.stack(imgs), list(hs), list(ws)
@@ -0,0 +1,218 @@
+'''
+Decoded-image cache shared by all DataLoader workers.
+Images are kept (decoded, optionally downscaled) in fixed-size slots of shared memory,
+the least recently used slot is evicted when the cache is full.
+Create it in the main process (before DataLoader workers start) and pass it to the dataset.
+Shared memory is released by close(), or when the cache is garbage collected / at exit of the main process.
+'''
+import os
+import hashlib
+import weakref
+import cv2
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Callable
+
+
+class SharedImageCache:
+    # counters in meta memory
+    CLOCK, HITS, MISSES, EVICTIONS = 0, 1, 2, 3
+
+    def __init__(
+            self,
+            max_bytes: int,
+            slot_bytes: int = 500 * 500 * 3,
+            max_side: int = None,
+            multiprocessing_context: str = None,
+    ):
+        '''
+
+        Args:
+            max_bytes: size of the cache (images), number of slots = max_bytes // slot_bytes
+            slot_bytes: max bytes of one image (VOC images <= 500x500x3), larger images are not cached
+            max_side: downscale images whose longer side > max_side before caching (boxes should be scaled)
+            multiprocessing_context: same as DataLoader(multiprocessing_context=...), e.g. 'spawn', None --> default
+        '''
+        self.slots_number = max(max_bytes // slot_bytes, 1)
+        self.slot_bytes = slot_bytes
+        self.max_side = max_side
+        self.lock = multiprocessing.get_context(multiprocessing_context).Lock()
+        self.owner_pid = os.getpid()
+
+        self.data_memory = shared_memory.SharedMemory(create=True, size=self.slots_number * slot_bytes)
+        self.meta_memory = shared_memory.SharedMemory(create=True, size=self.__meta_bytes())
+        self.__map_meta()
+        self.keys[:] = 0
+        self.last_used[:] = 0
+        self.counters[:] = 0
+        # unlink even if close() is never called, otherwise segments stay in /dev/shm
+        self.finalizer = weakref.finalize(
+            self, SharedImageCache.unlink_memory, self.owner_pid, self.data_memory, self.meta_memory
+        )
+
+    @staticmethod
+    def unlink_memory(
+            owner_pid: int,
+            *memories: shared_memory.SharedMemory
+    ):
+        # forked workers have a copy of the finalizer, only the owner unlinks
+        if os.getpid() != owner_pid:
+            return
+        for memory in memories:
+            try:
+                memory.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __meta_bytes(self) -> int:
+        # keys(n), last_used(n), shapes(n, 3) int64, scales(n, 2) float64, ndims(n), counters(4) int64
+        return 8 * (self.slots_number * 8 + 4)
+
+    def __map_meta(self):
+        n = self.slots_number
+        buf = self.meta_memory.buf
+        self.keys = np.ndarray((n, ), dtype=np.int64, buffer=buf, offset=0)
+        self.last_used = np.ndarray((n, ), dtype=np.int64, buffer=buf, offset=8 * n)
+        self.shapes = np.ndarray((n, 3), dtype=np.int64, buffer=buf, offset=8 * 2 * n)
+        self.scales = np.ndarray((n, 2), dtype=np.float64, buffer=buf, offset=8 * 5 * n)
+        self.ndims = np.ndarray((n, ), dtype=np.int64, buffer=buf, offset=8 * 7 * n)
+        self.counters = np.ndarray((4, ), dtype=np.int64, buffer=buf, offset=8 * 8 * n)
+        self.data = np.ndarray((n, self.slot_bytes), dtype=np.uint8, buffer=self.data_memory.buf)
+
+    def __getstate__(self):
+        # (spawn) workers attach to the same shared memory by name
+        state = self.__dict__.copy()
+        for name in ['data_memory', 'meta_memory', 'finalizer',
+                     'keys', 'last_used', 'shapes', 'scales', 'ndims', 'counters', 'data']:
+            state.pop(name)
+        state['data_memory_name'] = self.data_memory.name
+        state['meta_memory_name'] = self.meta_memory.name
+        return state
+
+    def __setstate__(self, state):
+        self.data_memory = shared_memory.SharedMemory(name=state.pop('data_memory_name'))
+        self.meta_memory = shared_memory.SharedMemory(name=state.pop('meta_memory_name'))
+        self.finalizer = None
+        self.__dict__.update(state)
+        self.__map_meta()
+
+    def close(self):
+        # views must be released before closing shared memory
+        for name in ['keys', 'last_used', 'shapes', 'scales', 'ndims', 'counters', 'data']:
+            self.__dict__.pop(name, None)
+        self.data_memory.close()
+        self.meta_memory.close()
+        if self.finalizer is not None:
+            self.finalizer()
+
+    @staticmethod
+    def hash_key(
+            key: str
+    ) -> int:
+        # 0 means empty slot
+        h = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+        return h if h != 0 else 1
+
+    def __find(
+            self,
+            h: int
+    ) -> int:
+        index = np.flatnonzero(self.keys == h)
+        return int(index[0]) if index.shape[0] > 0 else -1
+
+    def __tick(self) -> int:
+        self.counters[self.CLOCK] += 1
+        return int(self.counters[self.CLOCK])
+
+    def get(
+            self,
+            key: str
+    ):
+        '''
+        Returns:
+            (image, (scale_w, scale_h)) or None
+        '''
+        h = self.hash_key(key)
+        with self.lock:
+            i = self.__find(h)
+            if i < 0:
+                self.counters[self.MISSES] += 1
+                return None
+            self.counters[self.HITS] += 1
+            self.last_used[i] = self.__tick()
+            shape = tuple(self.shapes[i, :self.ndims[i]].tolist())
+            # copy inside the lock, slot may be evicted by other workers later
+            image = self.data[i, :int(np.prod(shape))].reshape(shape).copy()
+            return image, tuple(self.scales[i].tolist())
+
+    def put(
+            self,
+            key: str,
+            image: np.ndarray,
+            scale: tuple = (1.0, 1.0),
+    ):
+        if image is None or image.nbytes > self.slot_bytes:
+            return
+        h = self.hash_key(key)
+        with self.lock:
+            i = self.__find(h)
+            if i < 0:
+                i = int(np.argmin(self.last_used))  # empty slots have last_used 0
+                if self.keys[i] != 0:
+                    self.counters[self.EVICTIONS] += 1
+                self.keys[i] = h
+            self.shapes[i] = image.shape if image.ndim == 3 else (*image.shape, 1)
+            self.ndims[i] = image.ndim
+            self.scales[i] = scale
+            self.data[i, :image.nbytes] = np.ascontiguousarray(image).reshape(-1)
+            self.last_used[i] = self.__tick()
+
+    def downscale(
+            self,
+            image: np.ndarray
+    ):
+        '''
+        Returns:
+            image, (scale_w, scale_h)
+        '''
+        h, w = image.shape[:2]
+        if self.max_side is None or max(h, w) <= self.max_side:
+            return image, (1.0, 1.0)
+        rate = self.max_side / max(h, w)
+        new_w, new_h = max(int(round(w * rate)), 1), max(int(round(h * rate)), 1)
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
+        return image, (new_w / w, new_h / h)
+
+    def get_or_load(
+            self,
+            key: str,
+            loader: Callable[[], np.ndarray]
+    ):
+        '''
+        Args:
+            key: e.g. image path
+            loader: read image from disk/shard when missed
+
+        Returns:
+            image, (scale_w, scale_h) --> boxes of original image should be scaled by them
+        '''
+        res = self.get(key)
+        if res is not None:
+            return res
+        image, scale = self.downscale(loader())
+        self.put(key, image, scale)
+        return image, scale
+
+    def stats(self) -> dict:
+        with self.lock:
+            hits, misses, evictions = [int(self.counters[k]) for k in [self.HITS, self.MISSES, self.EVICTIONS]]
+            used = int((self.keys != 0).sum())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'hit_rate': hits / max(hits + misses, 1),
+            'used_slots': used,
+            'slots': self.slots_number,
+        }
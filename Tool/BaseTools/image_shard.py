@@ -0,0 +1,247 @@
+'''
+Packed image shard.
+All images of one folder (e.g. .../JPEGImages/) are packed into a single file (data.bin) with an offset index,
+then read through mmap. Each sample does not need to open its own file any more (slow on network storage).
+Images are stored as raw file bytes (decoded from the memory-mapped buffer directly)
+or as (pre-resized) uint8 arrays (no decode at all).
+Build shards with --build_voc_image_shard--, annotations are read from VOCAnnotationIndex.
+A shard keeps a stamp of its source folder, it is not used (rebuild it) when images are added/removed/modified.
+'''
+import os
+import hashlib
+import cv2
+import numpy as np
+
+
+def get_folder_stamp(
+        images_path: str
+) -> np.ndarray:
+    # names/sizes/modify times of all files, see VOCAnnotationIndex
+    entries = sorted(
+        (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+        for entry in os.scandir(images_path) if entry.is_file()
+    )
+    digest = hashlib.sha1(repr(entries).encode('utf-8')).digest()
+    return np.frombuffer(digest, dtype=np.uint8)
+
+
+class ImageShardWriter:
+    def __init__(
+            self,
+            shard_path: str,
+            encoded: bool = True,
+            image_size: tuple = None,
+            interpolation: int = cv2.INTER_LINEAR,
+            source_path: str = None,
+    ):
+        '''
+
+        Args:
+            shard_path: folder of the shard
+            encoded: True --> store file bytes(jpg/png), False --> store decoded uint8 array
+            image_size: (w, h), pre-resize images to this size, None --> keep original size
+            interpolation: used by pre-resize (cv2.INTER_NEAREST for masks)
+            source_path: folder of the images, its stamp is saved (see ImageShard), None --> no stamp
+        '''
+        self.shard_path = shard_path
+        self.encoded = encoded
+        self.image_size = image_size
+        self.interpolation = interpolation
+        # stamp before reading images, images modified while building make the shard stale
+        self.stamp = None if source_path is None else get_folder_stamp(source_path)
+
+        os.makedirs(shard_path, exist_ok=True)
+        self.data_file = open(os.path.join(shard_path, 'data.bin.tmp'), 'wb')
+        self.keys = []
+        self.offsets = [0]
+        self.shapes = []  # (h, w, c) of stored image (pre-resized or not)
+        self.is_encoded = []  # stored as file bytes or as uint8 array
+        self.sizes = []  # (w, h) of original image
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # failed, do not leave a broken shard
+            self.data_file.close()
+            os.remove(os.path.join(self.shard_path, 'data.bin.tmp'))
+
+    def add(
+            self,
+            key: str,
+            file_name: str,
+    ):
+        with open(file_name, 'rb') as f:
+            buffer = f.read()
+
+        image = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.sizes.append((image.shape[1], image.shape[0]))
+        if self.image_size is not None:
+            image = cv2.resize(image, tuple(self.image_size), interpolation=self.interpolation)
+
+        if self.encoded:
+            if self.image_size is not None:
+                # re-encode with the same format, (png is lossless, masks keep their colors)
+                _, encoded_image = cv2.imencode(os.path.splitext(file_name)[1], image)
+                buffer = encoded_image.tobytes()
+        else:
+            buffer = np.ascontiguousarray(image).tobytes()
+        self.shapes.append(image.shape)
+        self.is_encoded.append(self.encoded)
+
+        self.data_file.write(buffer)
+        self.keys.append(key)
+        self.offsets.append(self.offsets[-1] + len(buffer))
+
+    def close(self):
+        if self.data_file.closed:
+            return
+        self.data_file.close()
+        arrays = {
+            'keys': np.array(self.keys, dtype=np.str_),
+            'offsets': np.array(self.offsets, dtype=np.int64),
+            'shapes': np.array(self.shapes, dtype=np.int64).reshape(-1, 3),
+            'sizes': np.array(self.sizes, dtype=np.int64).reshape(-1, 2),
+            'is_encoded': np.array(self.is_encoded, dtype=bool),
+        }
+        if self.stamp is not None:
+            arrays['stamp'] = self.stamp
+        for name, array in arrays.items():
+            np.save(os.path.join(self.shard_path, name + '.npy'), array)
+        # data is renamed at last, so a half-written shard is never used
+        os.replace(os.path.join(self.shard_path, 'data.bin.tmp'), os.path.join(self.shard_path, 'data.bin'))
+
+
+class ImageShard:
+    def __init__(
+            self,
+            shard_path: str,
+            source_path: str = None,
+    ):
+        '''
+
+        Args:
+            shard_path:
+            source_path: folder of the images, if it exists the shard must have been built from
+                         its current files (stamp), otherwise raise an error. None --> no check
+        '''
+        if not os.path.isfile(os.path.join(shard_path, 'data.bin')):
+            raise FileNotFoundError(
+                'No image shard in {}, build it with build_voc_image_shard first.'.format(shard_path)
+            )
+        self.shard_path = shard_path
+        if source_path is not None and os.path.isdir(source_path):
+            stamp_file = os.path.join(shard_path, 'stamp.npy')
+            is_stale = not os.path.isfile(stamp_file) or \
+                not np.array_equal(np.load(stamp_file), get_folder_stamp(source_path))
+            if is_stale:
+                raise RuntimeError(
+                    'Image shard {} is stale ({} is changed), rebuild it with build_voc_image_shard.'.format(
+                        shard_path, source_path
+                    )
+                )
+        self.data = None  # type: np.memmap
+        self.offsets = None  # type: np.ndarray
+        self.shapes = None  # type: np.ndarray
+        self.sizes = None  # type: np.ndarray
+        self.is_encoded = None  # type: np.ndarray
+        self.key_to_index = None  # type: dict
+        self.__load()
+
+    def __load(self):
+        self.offsets = np.load(os.path.join(self.shard_path, 'offsets.npy'))
+        self.shapes = np.load(os.path.join(self.shard_path, 'shapes.npy'))
+        self.sizes = np.load(os.path.join(self.shard_path, 'sizes.npy'))
+        if not os.path.isfile(os.path.join(self.shard_path, 'is_encoded.npy')):
+            # shards of old versions stored no shape of (pre-resized) encoded images
+            raise RuntimeError('Image shard {} is too old, rebuild it with build_voc_image_shard.'.format(
+                self.shard_path
+            ))
+        self.is_encoded = np.load(os.path.join(self.shard_path, 'is_encoded.npy'))
+        keys = np.load(os.path.join(self.shard_path, 'keys.npy')).tolist()
+        self.key_to_index = {key: i for i, key in enumerate(keys)}
+        if self.offsets[-1] > 0:
+            self.data = np.memmap(os.path.join(self.shard_path, 'data.bin'), dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(shape=(0, ), dtype=np.uint8)
+
+    def __getstate__(self):
+        # do not pickle the mmap (e.g. to DataLoader workers), re-map it in __setstate__
+        return {'shard_path': self.shard_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__load()
+
+    def __len__(self):
+        return len(self.key_to_index)
+
+    def __contains__(self, key: str):
+        return key in self.key_to_index
+
+    def read(
+            self,
+            key: str
+    ) -> np.ndarray:
+        '''
+        same as CV2.imread (BGR, uint8), key --> file name in the packed folder, e.g. '000001.jpg'
+        '''
+        i = self.key_to_index[key]
+        buffer = self.data[self.offsets[i]: self.offsets[i + 1]]  # a view of the mmap, no copy
+        if self.is_encoded[i]:
+            return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        else:
+            # copy, the mmap is read-only while augmentations may change image in place
+            return np.array(buffer).reshape(self.shapes[i])
+
+    def scale_of(
+            self,
+            key: str
+    ) -> tuple:
+        '''
+        Returns:
+            (stored w / original w, stored h / original h), boxes of original image should be scaled by them
+        '''
+        i = self.key_to_index[key]
+        w, h = self.sizes[i].tolist()
+        return self.shapes[i, 1] / w, self.shapes[i, 0] / h
+
+
+def build_voc_image_shard(
+        root_path: str,
+        folder: str = 'JPEGImages',
+        encoded: bool = True,
+        image_size: tuple = None,
+        interpolation: int = cv2.INTER_LINEAR,
+        shard_path: str = None,
+):
+    '''
+    pack all images of root_path/folder, into root_path/folder_shard/ (default)
+    Args:
+        root_path: .../VOC/year/trainval(or test)/
+        folder: 'JPEGImages', 'SegmentationClass' or 'SegmentationObject'
+        encoded: see ImageShardWriter
+        image_size: see ImageShardWriter
+        interpolation: see ImageShardWriter (use cv2.INTER_NEAREST for masks)
+        shard_path:
+
+    Returns:
+        shard_path
+    '''
+    if shard_path is None:
+        shard_path = get_voc_image_shard_path(root_path, folder)
+    images_path = os.path.join(root_path, folder)
+    with ImageShardWriter(shard_path, encoded, image_size, interpolation, source_path=images_path) as writer:
+        for file_name in sorted(os.listdir(images_path)):
+            writer.add(file_name, os.path.join(images_path, file_name))
+    return shard_path
+
+
+def get_voc_image_shard_path(
+        root_path: str,
+        folder: str = 'JPEGImages',
+) -> str:
+    return os.path.join(root_path, folder + '_shard')
@@ -0,0 +1,148 @@
+'''
+Loss bookkeeping of a training epoch without per-step host syncs.
+    losses of every step are summed up on device (float64), val.item() of every loss every step is not needed
+    sync_frequency steps are synced at once --> metrics stream (step time, data wait time, losses) for logging
+    the epoch mean is synced once at the end of the epoch
+Times are measured on host (no cuda synchronize), they are right on average of some steps,
+not for every single step (host runs ahead of the cuda queue until a sync).
+'''
+import time
+import torch
+from typing import Callable, Iterable
+
+
+class TrainMetrics:
+    def __init__(
+            self,
+            device: torch.device,
+            now_epoch: int = 0,
+            sync_frequency: int = 0,
+            callback: Callable[[list], None] = None,
+    ):
+        '''
+
+        Args:
+            device: device of losses
+            now_epoch:
+            sync_frequency: sync every k steps and give the metrics of these steps to callback,
+                            0 --> just at the end of the epoch
+            callback: callback(metrics_vec), metrics_vec --> [metrics of one step, ...],
+                      metrics of one step --> {'epoch':, 'batch_id':, 'step_time':, 'data_time':, loss_key: float, ...}
+                      None --> no metrics stream (just the epoch mean)
+        '''
+        self.device = torch.device(device)
+        self.now_epoch = now_epoch
+        self.sync_frequency = sync_frequency
+        self.callback = callback
+
+        self.keys = None  # type: list
+        self.loss_sum = None  # type: torch.Tensor
+        self.step_number = 0
+
+        # steps not synced yet
+        self.pending_losses = []
+        self.pending_info = []
+        self.step_start = None  # type: float
+        self.data_time = None  # type: float
+
+    def timed(
+            self,
+            data_loader: Iterable,
+    ):
+        '''
+        for batch in metrics.timed(data_loader) --> data wait time and step time of every step
+        (step time --> from asking for the batch to update of this step)
+        '''
+        iterator = iter(data_loader)
+        while True:
+            self.step_start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.data_time = time.perf_counter() - self.step_start
+            yield batch
+
+    def update(
+            self,
+            loss_dict: dict,
+    ):
+        # no sync here (losses are detached and stacked on device)
+        if self.keys is None:
+            self.keys = list(loss_dict.keys())
+            self.loss_sum = torch.zeros(size=(len(self.keys), ), dtype=torch.float64, device=self.device)
+        losses = torch.stack([
+            torch.as_tensor(loss_dict[key]).detach().to(self.device, torch.float64) for key in self.keys
+        ])  # (K, )
+        self.loss_sum += losses
+        self.step_number += 1
+
+        if self.callback is not None:
+            self.pending_losses.append(losses)
+            self.pending_info.append({
+                'epoch': self.now_epoch,
+                'batch_id': self.step_number - 1,
+                'step_time': None if self.step_start is None else time.perf_counter() - self.step_start,
+                'data_time': self.data_time,
+            })
+            if self.sync_frequency > 0 and len(self.pending_losses) >= self.sync_frequency:
+                self.sync()
+
+    def sync(self):
+        if self.callback is None or len(self.pending_losses) == 0:
+            return
+        # one transfer for all pending steps
+        losses_vec = torch.stack(self.pending_losses).tolist()  # (steps, K)
+        metrics_vec = []
+        for info, losses in zip(self.pending_info, losses_vec):
+            metrics = dict(info)
+            metrics.update(zip(self.keys, losses))
+            metrics_vec.append(metrics)
+        self.pending_losses = []
+        self.pending_info = []
+        self.callback(metrics_vec)
+
+    def mean(self) -> dict:
+        '''
+        Returns:
+            mean of every loss of this epoch (python float)
+        '''
+        self.sync()
+        if self.step_number == 0:
+            return {}
+        return {
+            key: val / self.step_number for key, val in zip(self.keys, self.loss_sum.tolist())
+        }
+
+
+def debug_train_metrics_speed(
+        step_number: int = 200,
+        device: str = 'cpu',
+):
+    # val.item() of 6 losses every step vs TrainMetrics
+    net = torch.nn.Linear(256, 256).to(device)
+    x = torch.rand(64, 256, device=device)
+
+    def loss_func():
+        out = net(x)
+        return {'total_loss': out.mean(), **{'loss_{}'.format(i): (out * i).mean() for i in range(5)}}
+
+    start = time.perf_counter()
+    loss_dict_vec = {}
+    for _ in range(step_number):
+        for key, val in loss_func().items():
+            loss_dict_vec.setdefault(key, []).append(val.item())
+    print('item() every step ({}): {:.1f} step/s'.format(device, step_number / (time.perf_counter() - start)))
+
+    start = time.perf_counter()
+    metrics = TrainMetrics(device)
+    for _ in metrics.timed(range(step_number)):
+        metrics.update(loss_func())
+    metrics.mean()
+    print('TrainMetrics ({}): {:.1f} step/s'.format(device, step_number / (time.perf_counter() - start)))
+
+
+if __name__ == '__main__':
+    debug_train_metrics_speed()
+    if torch.cuda.is_available():
+        debug_train_metrics_speed(device='cuda')
@@ -0,0 +1,119 @@
+'''
+Labels of a batch as padded tensors.
+Instead of [[(kind_name, x, y, x, y), ...], ...] (python lists and str, pickled between DataLoader workers,
+kinds_name.index(...) for every object in make_target), a batch of labels is
+    objects (N, max_boxes, 5) float32 --> kind_id, x, y, x, y (not scaled), padding rows are 0
+    counts (N, ) int64 --> number of objects of every image
+Datasets return labels as (k, 5) arrays when they are given kinds_name, collate_fn builds PaddedLabels.
+'''
+import torch
+import numpy as np
+from typing import List, Union
+
+
+class PaddedLabels:
+    def __init__(
+            self,
+            objects: torch.Tensor,
+            counts: torch.Tensor,
+    ):
+        '''
+
+        Args:
+            objects: (N, max_boxes, 5)  kind_id, x, y, x, y
+            counts: (N, )
+        '''
+        self.objects = objects
+        self.counts = counts
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    def __repr__(self):
+        return 'PaddedLabels(objects={}, counts={})'.format(tuple(self.objects.shape), self.counts.tolist())
+
+    @property
+    def valid(self) -> torch.Tensor:
+        '''
+        Returns:
+            (N, max_boxes) bool, False --> padding
+        '''
+        return torch.arange(self.objects.shape[1], device=self.counts.device)[None] < self.counts[:, None]
+
+    def to(
+            self,
+            device: Union[str, torch.device]
+    ):
+        return PaddedLabels(self.objects.to(device), self.counts.to(device))
+
+    def pin_memory(self):
+        # called by DataLoader(pin_memory=True)
+        return PaddedLabels(self.objects.pin_memory(), self.counts.pin_memory())
+
+    @staticmethod
+    def from_arrays(
+            label_arrays: List[np.ndarray],
+    ):
+        '''
+        Args:
+            label_arrays: [(k0, 5), (k1, 5), ...] kind_id, x, y, x, y
+
+        Returns:
+            PaddedLabels
+        '''
+        counts = np.array([label.shape[0] for label in label_arrays], dtype=np.int64)
+        objects = np.zeros(shape=(len(label_arrays), max(counts.max(initial=0), 1), 5), dtype=np.float32)
+        for i, label in enumerate(label_arrays):
+            objects[i, :label.shape[0]] = label
+        return PaddedLabels(torch.from_numpy(objects), torch.from_numpy(counts))
+
+    @staticmethod
+    def from_list(
+            labels: List[List],
+            kinds_name: list,
+    ):
+        '''
+        Args:
+            labels: [[(kind_name, x, y, x, y), ...], ...]
+            kinds_name:
+
+        Returns:
+            PaddedLabels
+        '''
+        return PaddedLabels.from_arrays([
+            np.array(
+                [[kinds_name.index(obj[0]), *obj[1:5]] for obj in label], dtype=np.float32
+            ).reshape(-1, 5) for label in labels
+        ])
+
+    def to_list(
+            self,
+            kinds_name: list = None,
+    ) -> List[List]:
+        '''
+        Args:
+            kinds_name: None --> keep kind ids
+
+        Returns:
+            [[(kind_name(or kind_id), x, y, x, y), ...], ...]
+        '''
+        objects, counts = self.objects.cpu().tolist(), self.counts.cpu().tolist()
+        labels = []
+        for label, count in zip(objects, counts):
+            labels.append([
+                (int(obj[0]) if kinds_name is None else kinds_name[int(obj[0])], *obj[1:5]) for obj in label[:count]
+            ])
+        return labels
+
+    def flatten(self):
+        '''
+        all objects of the batch
+
+        Returns:
+            batch_index (M, ), kind_index (M, ), abs_gt_pos (M, 4)  (np.ndarray)
+        '''
+        objects, counts = self.objects.cpu().numpy(), self.counts.cpu().numpy()
+        batch_index = np.repeat(np.arange(counts.shape[0], dtype=np.int64), counts)
+        valid = np.arange(objects.shape[1])[None] < counts[:, None]  # (N, max_boxes)
+        objects = objects[valid]  # (M, 5)
+        return batch_index, objects[:, 0].astype(np.int64), objects[:, 1:5].astype(np.float64)
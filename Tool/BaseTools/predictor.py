@@ -67,40 +67,99 @@ class BasePredictor:
 
         Returns: kps_vec
         '''
-        def for_response(
-                now_kind_pos_abs,
-                now_kind_scores_max_value,
-        ):
-            res = []
-            keep_index = BaseTools.nms(
-                now_kind_pos_abs,
-                now_kind_scores_max_value,
-                threshold=iou_th,
+        return self.nms_batch(
+            position_abs_,
+            scores_max_value,
+            scores_max_index,
+            torch.zeros_like(scores_max_index),
+            batch_size=1
+        )[0]
+
+    def nms_batch(
+            self,
+            position_abs_: torch.Tensor,
+            scores_max_value: torch.Tensor,
+            scores_max_index: torch.Tensor,
+            image_index: torch.Tensor,
+            batch_size: int
+    ) -> List[List]:
+        '''
+        for batch images, all predicted objects( already mask some bad ones)
+        all images and all kinds are done in one call of BaseTools.batched_nms
+        Args:
+            position_abs_: (P, 4)
+            scores_max_value: (P, ) predicted kind_name's score
+            scores_max_index: (P, ) predicted kind_name's index
+            image_index: (P, ) which image the object belongs to
+            batch_size: images number
+
+        Returns: kps_vec_s
+        '''
+        kinds_number = len(self.kinds_name)
+        keep_index = BaseTools.batched_nms(
+            position_abs_,
+            scores_max_value,
+            image_index * kinds_number + scores_max_index,
+            threshold=self.iou_th,
+        )
+        # sorted by (image_index, kind_index, -score)
+
+        position_list = position_abs_[keep_index].cpu().detach().tolist()
+        score_list = scores_max_value[keep_index].cpu().detach().tolist()
+        kind_index_list = scores_max_index[keep_index].cpu().detach().tolist()
+        image_index_list = image_index[keep_index].cpu().detach().tolist()
+
+        total = [[] for _ in range(batch_size)]
+        for pos, score, kind_index, i in zip(position_list, score_list, kind_index_list, image_index_list):
+            total[i].append(
+                (self.kinds_name[kind_index], tuple(pos), score)  # kps
             )
 
-            for index in keep_index:
-                s = now_kind_scores_max_value[index]
-                abs_double_pos = tuple(now_kind_pos_abs[index].cpu().detach().numpy().tolist())
-                predict_kind_name = kind_name
+        return total
+
+    def mask_batch(
+            self,
+            position_abs_: torch.Tensor,
+            conf_: torch.Tensor,
+            cls_prob_: torch.Tensor,
+    ) -> tuple:
+        '''
+        for batch images, mask bad objects with prob_th, conf_th and score_th
+        Args:
+            position_abs_: (N, -1, 4) scaled on image
+            conf_: (N, -1)
+            cls_prob_: (N, -1, kinds_num)
+
+        Returns:
+            (position_abs, scores_max_value, scores_max_index, image_index) of masked objects
+            (P, 4), (P, ), (P, ), (P, )
+        '''
+        scores_ = cls_prob_ * conf_.unsqueeze(-1).expand_as(cls_prob_)
+        # (N, -1, kinds_num)
 
-                res.append(
-                    (predict_kind_name, abs_double_pos, s.item())  # kps
-                )
+        cls_prob_mask = cls_prob_.max(dim=-1)[0] > self.prob_th  # type: torch.Tensor
+        # (N, -1)
 
-            return res
+        conf_mask = conf_ > self.conf_th  # type: torch.Tensor
+        # (N, -1)
 
-        iou_th = self.iou_th
-        kinds_name = self.kinds_name
+        scores_max_value, scores_max_index = scores_.max(dim=-1)
+        # (N, -1)
 
-        total = []
-        for kind_index, kind_name in enumerate(kinds_name):
-            now_kind_response = scores_max_index == kind_index
-            total = total + for_response(
-                position_abs_[now_kind_response],
-                scores_max_value[now_kind_response],
-            )
+        scores_mask = scores_max_value > self.score_th  # type: torch.Tensor
+        # (N, -1)
 
-        return total
+        mask = conf_mask & cls_prob_mask & scores_mask
+        # (N, -1)
+
+        image_index = torch.arange(mask.shape[0], device=mask.device).unsqueeze(-1).expand_as(mask)
+
+        return (
+            position_abs_[mask],
+            scores_max_value[mask],
+            scores_max_index[mask],
+            image_index[mask]
+        )
 
     @abstractmethod
     def decode_one_target(
@@ -0,0 +1,188 @@
+'''
+Feed batches of a DataLoader to device ahead of time.
+    cuda --> batch k + 1 is pinned and copied (non_blocking) on a side stream while batch k is computed
+    cpu --> simple double buffer, batch k + 1 is loaded by a background thread while batch k is computed
+Only tensors (and dicts of tensors, BuiltTargets built in DataLoader workers) of a batch are moved,
+python labels/PaddedLabels/np.ndarray are kept as they are (they are used on cpu, e.g. make_targets).
+'''
+import threading
+import queue
+import torch
+from torch.utils.data import DataLoader
+from typing import Union, Iterable
+from .dataset_define import BuiltTargets
+
+
+class DevicePrefetcher:
+    def __init__(
+            self,
+            data_loader: Union[DataLoader, Iterable],
+            device: Union[str, torch.device],
+            keys: tuple = None,
+    ):
+        '''
+
+        Args:
+            data_loader: any loader of this project, a batch is a tuple/list (images, labels, ...)
+            device:
+            keys: indexes of the batch elements to be moved, None --> all tensors (and dicts of tensors)
+                  e.g. (0, ) for evaluators, just images are used on device
+        '''
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.keys = keys
+        self.use_cuda = self.device.type == 'cuda'
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __move(
+            self,
+            x,
+    ):
+        if isinstance(x, torch.Tensor):
+            if self.use_cuda and not x.is_pinned():
+                # pin here if the loader does not (DataLoader(pin_memory=True) is better, it pins in a thread)
+                x = x.pin_memory()
+            return x.to(self.device, non_blocking=True)
+        if isinstance(x, dict) and all(isinstance(val, torch.Tensor) for val in x.values()):
+            return {key: self.__move(val) for key, val in x.items()}
+        if isinstance(x, BuiltTargets):
+            return BuiltTargets(self.__move(x.targets))
+        return x
+
+    def move_batch(
+            self,
+            batch,
+    ):
+        if not isinstance(batch, (tuple, list)):
+            return self.__move(batch)
+        return [
+            self.__move(x) if self.keys is None or i in self.keys else x for i, x in enumerate(batch)
+        ]
+
+    @staticmethod
+    def __record_stream(
+            x,
+            stream,
+    ):
+        # tensors are used by the current stream, do not let the allocator reuse them too early
+        if isinstance(x, torch.Tensor) and x.is_cuda:
+            x.record_stream(stream)
+        elif isinstance(x, dict):
+            for val in x.values():
+                DevicePrefetcher.__record_stream(val, stream)
+        elif isinstance(x, (tuple, list)):
+            for val in x:
+                DevicePrefetcher.__record_stream(val, stream)
+
+    def __iter_cuda(self):
+        copy_stream = torch.cuda.Stream(device=self.device)
+        iterator = iter(self.data_loader)
+
+        def load_next():
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(copy_stream):
+                return self.move_batch(batch)
+
+        next_batch = load_next()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(copy_stream)
+            batch = next_batch
+            self.__record_stream(batch, current_stream)
+            # copy of batch k + 1 is issued before batch k is computed
+            next_batch = load_next()
+            yield batch
+
+    def __iter_cpu(self):
+        buffer = queue.Queue(maxsize=1)  # (one batch in the buffer) + (one batch being computed)
+        end = object()
+        stop = threading.Event()
+
+        def put(x) -> bool:
+            while not stop.is_set():
+                try:
+                    buffer.put(x, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def load():
+            try:
+                for batch in self.data_loader:
+                    if not put(self.move_batch(batch)):
+                        return
+                put(end)
+            except BaseException as e:
+                # any error (not just Exception) is raised in the consumer, it would wait forever otherwise
+                put(e)
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = buffer.get()
+                if batch is end:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            # the consumer may break early
+            stop.set()
+            thread.join()
+
+    def __iter__(self):
+        if self.use_cuda:
+            return self.__iter_cuda()
+        return self.__iter_cpu()
+
+
+def debug_prefetcher_speed(
+        batch_size: int = 16,
+        size: int = 416,
+        batch_number: int = 20,
+        load_time: float = 0.02,
+        device: str = 'cpu',
+):
+    # load_time --> time of reading/augmenting one batch, compute --> a small conv net
+    import time
+    from torch.utils.data import Dataset
+
+    class SlowDataSet(Dataset):
+        def __len__(self):
+            return batch_size * batch_number
+
+        def __getitem__(self, index):
+            if index % batch_size == 0:
+                time.sleep(load_time)
+            return torch.rand(3, size, size), index
+
+    loader = DataLoader(SlowDataSet(), batch_size=batch_size, pin_memory=device != 'cpu')
+    net = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 16, 3, 2, 1),
+        torch.nn.ReLU(),
+        torch.nn.Conv2d(16, 32, 3, 2, 1),
+    ).to(device)
+
+    def run(batches):
+        start = time.time()
+        with torch.no_grad():
+            for batch in batches:
+                images = batch[0].to(device)
+                net(images).sum().item()
+        return batch_size * batch_number / (time.time() - start)
+
+    print('without prefetcher ({}): {:.1f} img/s'.format(device, run(loader)))
+    print('DevicePrefetcher ({}): {:.1f} img/s'.format(device, run(DevicePrefetcher(loader, device))))
+
+
+if __name__ == '__main__':
+    debug_prefetcher_speed()
+    if torch.cuda.is_available():
+        debug_prefetcher_speed(device='cuda')
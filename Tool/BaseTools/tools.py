@@ -11,6 +11,9 @@ from abc import abstractmethod
 
 
 class BaseTools:
+    # (grid_number, anchors, device, dtype) --> (grid, pre_wh), see get_grid_and_anchor
+    grid_and_anchor_cache = {}
+
     @staticmethod
     @abstractmethod
     def get_grid_number_and_pre_anchor_w_h(
@@ -35,6 +38,26 @@ class BaseTools:
         '''
         pass
 
+    @staticmethod
+    def last_write_mask(
+            cell_id: torch.Tensor
+    ) -> torch.Tensor:
+        '''
+        writes are given in program order, find the ones a python loop of assignments
+        would leave (the last write of every cell).
+        Args:
+            cell_id: (Q, )
+
+        Returns:
+            (Q, ) bool
+        '''
+        sorted_id, perm = torch.sort(cell_id, stable=True)
+        last = torch.ones_like(sorted_id, dtype=torch.bool)
+        last[:-1] = sorted_id[1:] != sorted_id[:-1]
+        mask = torch.zeros_like(last)
+        mask[perm] = last
+        return mask
+
     @staticmethod
     @abstractmethod
     def split_target(
@@ -135,6 +158,41 @@ class BaseTools:
         img = CV2.cvtColorToBGR(img)
         return img
 
+    @staticmethod
+    def index_map_to_one_hot(
+            index_map: Union[torch.Tensor, np.ndarray],
+            kinds_number: int,
+    ) -> Union[torch.Tensor, np.ndarray]:
+        '''
+        build one-hot masks (where they are needed, e.g. on device in loss)
+        Args:
+            index_map: (..., H, W) uint8, index >= kinds_number (e.g. 255) --> no kind
+            kinds_number:
+
+        Returns:
+            (..., H, W, kinds_number) float32, same as the old one-hot masks (all zero if no kind)
+        '''
+        if isinstance(index_map, np.ndarray):
+            return (index_map[..., None] == np.arange(kinds_number)).astype(np.float32)
+        kinds = torch.arange(kinds_number, device=index_map.device, dtype=index_map.dtype)
+        return (index_map.unsqueeze(-1) == kinds).float()
+
+    @staticmethod
+    def mask_to_kind_index(
+            mask: np.ndarray,
+            ignore_index: int = 255,
+    ) -> np.ndarray:
+        '''
+        Args:
+            mask: (..., H, W, K) float one-hot or (..., H, W) uint8 index map
+
+        Returns:
+            (..., H, W) kind index, pixels without kind --> 0 (same as argmax of all zero one-hot)
+        '''
+        if mask.dtype == np.uint8:
+            return np.where(mask == ignore_index, 0, mask).astype(np.int64)
+        return mask.argmax(axis=-1)
+
     @staticmethod
     def compute_iou_m_to_n(
             bbox1: Union[torch.Tensor, np.ndarray, list],
@@ -151,34 +209,9 @@ class BaseTools:
             if len(bbox2.shape) == 1:
                 bbox2 = bbox2.unsqueeze(0)
 
-        N = bbox1.size(0)
-        M = bbox2.size(0)
-
-        # Compute left-top coordinate of the intersections
-        lt = torch.max(
-            bbox1[:, :2].unsqueeze(1).expand(N, M, 2),  # [N, 2] -> [N, 1, 2] -> [N, M, 2]
-            bbox2[:, :2].unsqueeze(0).expand(N, M, 2)  # [M, 2] -> [1, M, 2] -> [N, M, 2]
-        )
-        # Conpute right-bottom coordinate of the intersections
-        rb = torch.min(
-            bbox1[:, 2:].unsqueeze(1).expand(N, M, 2),  # [N, 2] -> [N, 1, 2] -> [N, M, 2]
-            bbox2[:, 2:].unsqueeze(0).expand(N, M, 2)  # [M, 2] -> [1, M, 2] -> [N, M, 2]
-        )
-        # Compute area of the intersections from the coordinates
-        wh = rb - lt  # width and height of the intersection, [N, M, 2]
-        wh[wh < 0] = 0  # clip at 0
-        inter = wh[:, :, 0] * wh[:, :, 1]  # [N, M]
-
-        # Compute area of the bboxes
-        area1 = (bbox1[:, 2] - bbox1[:, 0]) * (bbox1[:, 3] - bbox1[:, 1])  # [N, ]
-        area2 = (bbox2[:, 2] - bbox2[:, 0]) * (bbox2[:, 3] - bbox2[:, 1])  # [M, ]
-        area1 = area1.unsqueeze(1).expand_as(inter)  # [N, ] -> [N, 1] -> [N, M]
-        area2 = area2.unsqueeze(0).expand_as(inter)  # [M, ] -> [1, M] -> [N, M]
-
-        # Compute IoU from the areas
-        union = area1 + area2 - inter  # [N, M]
-        iou = inter / union  # [N, M]
-        return iou
+        # (N, 1, 4) and (1, M, 4) --> (N, M), boxes may be integers
+        # same eps as iou_score/compute_iou, zero-area boxes give 0 (not NaN)
+        return BaseTools.iou_score(bbox1.float().unsqueeze(1), bbox2.float().unsqueeze(0))
 
     @staticmethod
     def iou_score(bboxes_a, bboxes_b):
@@ -247,11 +280,168 @@ class BaseTools:
         # H * W * 2
         return grid
 
+    @staticmethod
+    def get_grid_and_anchor(
+            grid_number: tuple,
+            anchor_pre_wh_for_single_size: tuple,
+            device: Union[str, torch.device],
+            dtype: torch.dtype = torch.float32,
+    ) -> tuple:
+        '''
+        cached version of get_grid + torch.tensor(anchor_pre_wh) for decoding/encoding position.
+        Tensors are built (and copied to device) only once for each
+        (grid_number, anchors, device, dtype), the cache is shared by all tools
+        and cleared by clear_grid_and_anchor_cache (called in change_image_wh).
+        Args:
+            grid_number: (W, H)
+            anchor_pre_wh_for_single_size: ((w, h), ...) scaled on grid
+            device:
+            dtype:
+
+        Returns:
+            grid    --> (1, H, W, 1, 2)
+            pre_wh  --> (a_n, 2)
+        '''
+        key = (
+            tuple(grid_number),
+            tuple(tuple(wh) for wh in anchor_pre_wh_for_single_size),
+            torch.device(device),
+            dtype
+        )
+        res = BaseTools.grid_and_anchor_cache.get(key)
+        if res is None:
+            grid = BaseTools.get_grid(grid_number)
+            # H * W * 2
+            grid = grid.unsqueeze(-2).unsqueeze(0).to(device=key[2], dtype=dtype)
+            # 1 * H * W * 1 * 2
+
+            pre_wh = torch.tensor(
+                anchor_pre_wh_for_single_size,
+                dtype=torch.float32
+            ).to(device=key[2], dtype=dtype)
+            # a_n * 2
+
+            res = (grid, pre_wh)
+            BaseTools.grid_and_anchor_cache[key] = res
+        return res
+
+    @staticmethod
+    def clear_grid_and_anchor_cache():
+        BaseTools.grid_and_anchor_cache.clear()
+
+    @staticmethod
+    def nms_overlap(
+            boxes_a: torch.Tensor,
+            areas_a: torch.Tensor,
+            boxes_b: torch.Tensor,
+            areas_b: torch.Tensor,
+    ) -> torch.Tensor:
+        # same overlap definition as py_nms
+        # boxes_a (M, 4) boxes_b (T, 4) --> (M, T)
+        xx1 = torch.max(boxes_a[:, 0].unsqueeze(1), boxes_b[:, 0].unsqueeze(0))
+        yy1 = torch.max(boxes_a[:, 1].unsqueeze(1), boxes_b[:, 1].unsqueeze(0))
+        xx2 = torch.min(boxes_a[:, 2].unsqueeze(1), boxes_b[:, 2].unsqueeze(0))
+        yy2 = torch.min(boxes_a[:, 3].unsqueeze(1), boxes_b[:, 3].unsqueeze(0))
+        inter = (xx2 - xx1).clamp_(min=0) * (yy2 - yy1).clamp_(min=0)
+        return inter / (areas_a.unsqueeze(1) + areas_b.unsqueeze(0) - inter + 1e-20)
+
+    @staticmethod
+    def batched_nms(
+            position_abs: torch.Tensor,
+            scores: torch.Tensor,
+            group_index: torch.Tensor = None,
+            threshold: float = 0.5,
+            tile_size: int = 512,
+    ) -> torch.Tensor:
+        '''
+        NMS for many groups in one call, everything stays on position_abs.device.
+        A box could only be suppressed by boxes of its own group,
+        so group_index could be kind_index (one image) or image_index * kinds_num + kind_index (batch images).
+
+        Boxes are sorted by (group, -score), so each group is contiguous.
+        They are resolved tile by tile:
+            1) boxes of now tile are suppressed by kept boxes(same group) of former tiles
+            2) boxes inside now tile are resolved by iterating keep = ~any(iou_upper[keep] > threshold)
+               until it does not change (Cluster-NMS), which gives exactly the greedy result.
+        Args:
+            position_abs: (P, 4)  (x, y, x, y)
+            scores: (P, )
+            group_index: (P, ) long, None --> all boxes in one group
+            threshold: iou threshold
+            tile_size: the biggest iou matrix computed once is (group_size, tile_size)
+
+        Returns:
+            keep index, (K, ) long tensor, sorted by (group_index, -score)
+        '''
+        device = position_abs.device
+        P = position_abs.shape[0]
+        if P == 0:
+            return torch.zeros(size=(0,), dtype=torch.long, device=device)
+
+        if group_index is None:
+            group_index = torch.zeros(size=(P,), dtype=torch.long, device=device)
+
+        order = torch.sort(scores.detach(), descending=True, stable=True)[1]
+        order = order[torch.sort(group_index[order], stable=True)[1]]
+
+        boxes = position_abs.detach()[order].float()
+        groups = group_index[order]
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+        _, counts = torch.unique_consecutive(groups, return_counts=True)
+        group_begin = (torch.cumsum(counts, dim=0) - counts).repeat_interleave(counts).tolist()
+        # group_begin[i] --> first index of the group box i belongs to
+
+        keep = torch.ones(size=(P,), dtype=torch.bool, device=device)
+        for start in range(0, P, tile_size):
+            end = min(start + tile_size, P)
+            tile_boxes = boxes[start: end]
+            tile_areas = areas[start: end]
+            tile_groups = groups[start: end]
+
+            candidate = torch.ones(size=(end - start,), dtype=torch.bool, device=device)
+            begin = group_begin[start]
+            if begin < start:
+                # suppressed by kept boxes of former tiles
+                kept = begin + torch.nonzero(keep[begin: start]).view(-1)
+                iou = BaseTools.nms_overlap(boxes[kept], areas[kept], tile_boxes, tile_areas)
+                suppress = iou > threshold
+                suppress &= groups[kept].unsqueeze(1) == tile_groups.unsqueeze(0)
+                candidate = ~suppress.any(dim=0)
+
+            iou = BaseTools.nms_overlap(tile_boxes, tile_areas, tile_boxes, tile_areas)
+            suppress = (iou > threshold).triu_(diagonal=1)
+            suppress &= tile_groups.unsqueeze(1) == tile_groups.unsqueeze(0)
+            # suppress[i, j] --> box i(higher score) could suppress box j
+
+            tile_keep = candidate
+            while True:
+                now_keep = candidate & ~(suppress & tile_keep.unsqueeze(1)).any(dim=0)
+                if torch.equal(now_keep, tile_keep):
+                    break
+                tile_keep = now_keep
+            keep[start: end] = tile_keep
+
+        return order[keep]
+
     @staticmethod
     def nms(
             position_abs: torch.Tensor,
             scores: torch.Tensor,
             threshold: float = 0.5
+    ) -> list:
+        keep = BaseTools.batched_nms(
+            position_abs,
+            scores,
+            threshold=threshold
+        )
+        return keep.cpu().tolist()
+
+    @staticmethod
+    def py_nms(
+            position_abs: torch.Tensor,
+            scores: torch.Tensor,
+            threshold: float = 0.5
     ):
         position_abs = position_abs.cpu().detach().numpy().copy()
         scores = scores.cpu().detach().numpy().copy()
@@ -426,34 +616,31 @@ class BaseTools:
             reverse=True
         )
         # sorted score from big to small
-        kind_tp_and_score = []
         gt_num = {
             key: 0 for key in kinds_name
         }
-
-        gt_has_used = []
         for gt_ in gt_kind_name_pos_score:
             gt_kind_name, _, _ = gt_
             gt_num[gt_kind_name] += 1
-            gt_has_used.append(False)
-
-        for pre_ in pre_kind_name_pos_score:
-            pre_kind_name, pre_pos, pre_score = pre_
-            is_tp = 0  # second element represents it tp(or fp)
-            for gt_index, gt_ in enumerate(gt_kind_name_pos_score):
-                gt_kind_name, gt_pos, gt_score = gt_
-                if gt_kind_name == pre_kind_name and not gt_has_used[gt_index]:
-                    iou = BaseTools.compute_iou(
-                        list(pre_pos),
-                        list(gt_pos)
-                    )
-                    if iou[0].item() > iou_th:
-                        gt_has_used[gt_index] = True
-                        is_tp = 1
-
-            kind_tp_and_score.append(
-                [pre_kind_name, is_tp, pre_score]
-            )
+
+        is_tp = np.zeros(shape=(len(pre_kind_name_pos_score), ), dtype=np.int64)
+        for kind_name in set(kps[0] for kps in pre_kind_name_pos_score):
+            gt_pos = [gt_[1] for gt_ in gt_kind_name_pos_score if gt_[0] == kind_name]
+            if len(gt_pos) == 0:
+                continue
+            pre_index = [i for i, pre_ in enumerate(pre_kind_name_pos_score) if pre_[0] == kind_name]
+            pre_pos = [pre_kind_name_pos_score[i][1] for i in pre_index]
+
+            hit = BaseTools.compute_iou_m_to_n(pre_pos, gt_pos).numpy() > iou_th
+            # (P, G)
+            # a prediction takes every unused gt it hits, so each gt is taken by
+            # the first(highest score) prediction hitting it
+            gt_hit = hit.any(axis=0)
+            is_tp[np.array(pre_index)[hit.argmax(axis=0)[gt_hit]]] = 1
+
+        kind_tp_and_score = [
+            [pre_[0], tp, pre_[2]] for pre_, tp in zip(pre_kind_name_pos_score, is_tp.tolist())
+        ]
         return kind_tp_and_score, gt_num
 
     @staticmethod
@@ -647,3 +834,54 @@ class BaseTools:
         # c_iou = iou - (distance_rate + alpha.detach() * v)
         c_iou = iou - (distance_rate + alpha * v)
         return torch.clamp(c_iou, -1, 1)
+
+
+def debug_nms_speed(
+        batch_size: int = 8,
+        candidate_number: int = 5000,
+        kinds_number: int = 20,
+        image_size: int = 608,
+        iou_th: float = 0.5,
+        device: str = 'cuda:0' if torch.cuda.is_available() else 'cpu',
+):
+    '''
+    compare BaseTools.py_nms(for each image, for each kind) with BaseTools.batched_nms(one call)
+    on synthetic candidates(yolo v4 608*608 has 22743 anchors, with score_th=0.001 thousands survive per image)
+    '''
+    import time
+
+    centers = torch.rand(size=(batch_size, candidate_number, 2)) * image_size
+    wh = torch.rand(size=(batch_size, candidate_number, 2)) * image_size * 0.3 + 4
+    position_abs = torch.cat((centers - 0.5 * wh, centers + 0.5 * wh), dim=-1).clamp_(0, image_size).view(-1, 4)
+    scores = torch.rand(size=(batch_size * candidate_number, ))
+    kind_index = torch.randint(0, kinds_number, size=(batch_size * candidate_number, ))
+    image_index = torch.arange(batch_size).repeat_interleave(candidate_number)
+
+    position_abs, scores = position_abs.to(device), scores.to(device)
+    kind_index, image_index = kind_index.to(device), image_index.to(device)
+
+    t0 = time.time()
+    old_keep = set()
+    for i in range(batch_size):
+        for k in range(kinds_number):
+            index = torch.nonzero((image_index == i) & (kind_index == k)).view(-1)
+            keep = BaseTools.py_nms(position_abs[index], scores[index], iou_th)
+            old_keep.update(index[keep].tolist())
+    old_time = time.time() - t0
+
+    BaseTools.batched_nms(position_abs, scores, image_index * kinds_number + kind_index, iou_th)  # warm up
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    t0 = time.time()
+    new_keep = BaseTools.batched_nms(position_abs, scores, image_index * kinds_number + kind_index, iou_th)
+    new_keep = set(new_keep.tolist())
+    new_time = time.time() - t0
+
+    print('device: {}, candidates: {} x {}'.format(device, batch_size, candidate_number))
+    print('py_nms      : {:.4f}s, keep {}'.format(old_time, len(old_keep)))
+    print('batched_nms : {:.4f}s, keep {}'.format(new_time, len(new_keep)))
+    print('same result : {}'.format(old_keep == new_keep))
+
+
+if __name__ == '__main__':
+    debug_nms_speed()
@@ -1,13 +1,19 @@
 '''
 This packet is not important.
 '''
+import contextlib
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
-from typing import Union
+from typing import Union, Callable
 from abc import abstractmethod
 from .model import BaseModel
+from .prefetcher import DevicePrefetcher
+from .dataset_define import BuiltTargets
+from .metrics import TrainMetrics
 
 
 class WarmUpOptimizer:
@@ -16,13 +22,31 @@ class WarmUpOptimizer:
             optimizer: torch.optim.Optimizer,
             base_lr: float = 1e-3,
             warm_up_epoch: int = 1,
+            loss_scale: bool = False,
+            accumulate_steps: int = 1,
     ):
+        '''
+
+        Args:
+            optimizer:
+            base_lr:
+            warm_up_epoch:
+            loss_scale: scale loss (dynamically) before backward, needed by float16 mixed precision
+                        (trainer.amp_dtype = torch.float16), bfloat16 does not need it
+            accumulate_steps: accumulate grads of k micro-batches for one optimizer step,
+                              lr of warm (and of sub classes) is changed per optimizer step
+        '''
+        assert accumulate_steps >= 1
         self.optimizer = optimizer
         self.set_lr(base_lr)
 
         self.warm_up_epoch = warm_up_epoch
         self.base_lr = base_lr
         self.tmp_lr = base_lr
+        self.accumulate_steps = accumulate_steps
+
+        device_type = optimizer.param_groups[0]['params'][0].device.type
+        self.scaler = torch.amp.GradScaler(device_type, enabled=loss_scale)
 
     def set_lr(self, lr):
         self.tmp_lr = lr
@@ -42,11 +66,84 @@ class WarmUpOptimizer:
             self.tmp_lr = self.base_lr
             self.set_lr(self.tmp_lr)
 
+    def micro_batch_info(
+            self,
+            now_batch_ind,
+            max_batch_ind
+    ):
+        '''
+        Returns:
+            step_ind, max_step_ind (give them to warm),
+            micro_ind (index in this step), micro_number (of this step, the last step of an epoch may have fewer)
+        '''
+        step_ind, micro_ind = divmod(now_batch_ind, self.accumulate_steps)
+        max_step_ind = (max_batch_ind + self.accumulate_steps - 1) // self.accumulate_steps
+        micro_number = min(self.accumulate_steps, max_batch_ind - step_ind * self.accumulate_steps)
+        return step_ind, max_step_ind, micro_ind, micro_number
+
+    @staticmethod
+    def get_micro_batch_size(
+            batch_size: int,
+            accumulate_steps: int,
+            world_size: int = 1,
+    ) -> int:
+        '''
+        batch size of a data loader (one micro-batch of one process), so the batch of one optimizer step
+        is still batch_size (the tuned one)
+        '''
+        assert accumulate_steps >= 1 and world_size >= 1
+        assert batch_size % (world_size * accumulate_steps) == 0, \
+            'batch_size({}) should be divisible by world_size({}) * accumulate_steps({})'.format(
+                batch_size, world_size, accumulate_steps
+            )
+        return batch_size // (world_size * accumulate_steps)
+
     def zero_grad(self):
         self.optimizer.zero_grad()
 
+    def backward(
+            self,
+            loss: torch.Tensor
+    ):
+        self.scaler.scale(loss).backward()
+
     def step(self):
-        self.optimizer.step()
+        if self.scaler.is_enabled():
+            # skip the step if grads are inf/nan, then adjust the scale
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            self.optimizer.step()
+
+    def state_dict(self) -> dict:
+        return {
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.scaler.state_dict(),
+        }
+
+    def load_state_dict(
+            self,
+            state_dict: dict
+    ):
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+        self.scaler.load_state_dict(state_dict['scaler'])
+
+
+def to_float(
+        x
+):
+    '''
+    outputs of mixed precision forward --> float32 (losses are computed in float32)
+    This is the only cast of the loss path: decoding (exp/log) and IoU (eps 1e-20, areas of big boxes)
+    would overflow/underflow in float16, they (and the loss) run outside autocast on these float32 outputs.
+    '''
+    if isinstance(x, torch.Tensor):
+        return x.float() if x.is_floating_point() else x
+    if isinstance(x, dict):
+        return type(x)((key, to_float(val)) for key, val in x.items())
+    if isinstance(x, (tuple, list)):
+        return type(x)(to_float(val) for val in x)
+    return x
 
 
 class BaseTrainer:
@@ -75,6 +172,18 @@ class BaseTrainer:
 
         self.iou_th_for_make_target = iou_th_for_make_target
 
+        # BatchAugmentation, augment batches on device (train loader should just resize, see ResizeUInt8)
+        self.batch_augmentation = None
+
+        # mixed precision, None --> float32, torch.float16 (cuda, with WarmUpOptimizer(loss_scale=True))
+        # or torch.bfloat16 (cuda/cpu). Just forward of detector is autocast, losses are computed in float32.
+        self.amp_dtype = None
+
+        # metrics stream of training, metrics_callback(metrics_vec) every metrics_sync_frequency steps
+        # (see TrainMetrics, 0 --> at the end of every epoch), losses are not synced every step
+        self.metrics_callback = None  # type: Callable[[list], None]
+        self.metrics_sync_frequency = 0
+
     @abstractmethod
     def change_image_wh(
             self,
@@ -90,6 +199,64 @@ class BaseTrainer:
     ) -> torch.Tensor:
         pass
 
+    @abstractmethod
+    def target_builder(
+            self
+    ) -> Callable:
+        '''
+        a picklable function: labels --> targets (on cpu).
+        Give it to the train data loader(see TargetCollateFn), then targets are built in DataLoader workers.
+        '''
+        pass
+
+    def targets_to_device(
+            self,
+            targets: Union[torch.Tensor, dict]
+    ) -> Union[torch.Tensor, dict]:
+        if isinstance(targets, dict):
+            return {key: val.to(self.device) for key, val in targets.items()}
+        return targets.to(self.device)
+
+    def forward_detector(
+            self,
+            images: torch.Tensor
+    ):
+        with torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            output = self.detector(images)
+        return to_float(output)
+
+    def grad_sync_context(
+            self,
+            sync: bool
+    ):
+        '''
+        DistributedDataParallel: all_reduce grads just on the last micro-batch of a step,
+        forward and backward of the other micro-batches run in no_sync (grads are accumulated locally)
+        '''
+        if not sync and isinstance(self.detector, DistributedDataParallel):
+            return self.detector.no_sync()
+        return contextlib.nullcontext()
+
+    def new_train_metrics(
+            self,
+            now_epoch: int
+    ) -> TrainMetrics:
+        return TrainMetrics(
+            self.device,
+            now_epoch,
+            self.metrics_sync_frequency,
+            self.metrics_callback
+        )
+
+    @staticmethod
+    def set_sampler_epoch(
+            data_loader: DataLoader,
+            now_epoch: int
+    ):
+        # DistributedSampler shuffles with the epoch as seed (same order in all processes)
+        if isinstance(getattr(data_loader, 'sampler', None), DistributedSampler):
+            data_loader.sampler.set_epoch(now_epoch)
+
     def train_detector_one_epoch(
             self,
             data_loader_train: DataLoader,
@@ -98,40 +265,52 @@ class BaseTrainer:
             now_epoch: int,
             desc: str = '',
     ):
-        loss_dict_vec = {}
+        metrics = self.new_train_metrics(now_epoch)
         max_batch_ind = len(data_loader_train)
+        self.set_sampler_epoch(data_loader_train, now_epoch)
 
-        for batch_id, (images, labels) in enumerate(tqdm(data_loader_train,
-                                                         desc=desc,
-                                                         position=0)):
-            optimizer.warm(
-                now_epoch,
-                batch_id,
-                max_batch_ind
-            )
+        for batch_id, batch in enumerate(metrics.timed(tqdm(DevicePrefetcher(data_loader_train, self.device),
+                                                            desc=desc,
+                                                            position=0))):
+            step_ind, max_step_ind, micro_ind, micro_number = optimizer.micro_batch_info(batch_id, max_batch_ind)
+            if micro_ind == 0:
+                # lr is changed per optimizer step (not per micro-batch)
+                optimizer.warm(
+                    now_epoch,
+                    step_ind,
+                    max_step_ind
+                )
 
             self.detector.train()
+            images, labels = batch[0], batch[1]
             images = images.to(self.device)
-            targets = self.make_targets(labels)
-            output = self.detector(images)
-            loss_res = yolo_loss_func(output, targets)
-            if not isinstance(loss_res, dict):
-                print('You have not use our provided loss func, please overwrite method train_detector_one_epoch')
-                pass
+            if self.batch_augmentation is not None:
+                # boxes are changed here, targets can not be built in DataLoader workers
+                images, labels = self.batch_augmentation.augment_labels(images, labels, self.kinds_name)
+                targets = self.make_targets(labels)
+            elif isinstance(batch[-1], BuiltTargets):
+                # (images, labels, BuiltTargets), targets have been built in DataLoader workers
+                targets = self.targets_to_device(batch[-1].targets)
             else:
-                loss = loss_res['total_loss']
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-                for key, val in loss_res.items():
-                    if key not in loss_dict_vec.keys():
-                        loss_dict_vec[key] = []
-                    loss_dict_vec[key].append(val.item())
-
-        loss_dict = {}
-        for key, val in loss_dict_vec.items():
-            loss_dict[key] = sum(val) / len(val) if len(val) != 0 else 0.0
-        return loss_dict
+                targets = self.make_targets(labels)
+            with self.grad_sync_context(micro_ind == micro_number - 1):
+                output = self.forward_detector(images)
+                loss_res = yolo_loss_func(output, targets)
+                if not isinstance(loss_res, dict):
+                    print('You have not use our provided loss func, please overwrite method train_detector_one_epoch')
+                    pass
+                else:
+                    loss = loss_res['total_loss']
+                    if micro_ind == 0:
+                        optimizer.zero_grad()
+                    # mean of micro-batches --> same as the loss of the whole batch
+                    optimizer.backward(loss / micro_number)
+                    if micro_ind == micro_number - 1:
+                        optimizer.step()
+
+                    # summed up on device, synced every metrics_sync_frequency steps (not every step)
+                    metrics.update(loss_res)
+
+        return metrics.mean()
 
 
@@ -2,6 +2,7 @@ import numpy as np
 from Tool.FCNDesNet101_SS.Predictor import SSPredictor
 from Tool.FCNDesNet101_SS.Tools import SSTools
 from Tool.FCNDesNet101_SS.Model import FCNResnet101
+from Tool.BaseTools import DevicePrefetcher
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
@@ -33,7 +34,7 @@ class SSEvaluator:
     ):
         acc_vec_include_background = []
         acc_vec = []
-        for batch_id, (images, objects_vec, masks_vec) in enumerate(tqdm(data_loader_test,
+        for batch_id, (images, objects_vec, masks_vec) in enumerate(tqdm(DevicePrefetcher(data_loader_test, self.device, keys=(0, )),
                                                                          desc=desc,
                                                                          position=0)):
 
@@ -48,7 +49,7 @@ class SSEvaluator:
             pre_decode = self.predictor.decode_predict(output)  # type: np.ndarray
 
             pre_mask_vec = np.argmax(pre_decode, axis=-1)
-            gt_mask_vec = np.argmax(gt_decode, axis=-1)
+            gt_mask_vec = SSTools.mask_to_kind_index(gt_decode)  # one-hot or index map
 
             acc = np.mean((pre_mask_vec == gt_mask_vec).astype(np.float32))
             acc_vec_include_background.append(acc)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from Tool.FCNDesNet101_SS.Tools import SSTools
 
 
 class FocalLoss(nn.Module):
@@ -18,6 +19,10 @@ class FocalLoss(nn.Module):
             gt: torch.Tensor,
     ):
 
+        if gt.dtype == torch.uint8:
+            # index map --> one-hot (on device)
+            gt = SSTools.index_map_to_one_hot(gt, pred.shape[self.compute_dim]).movedim(-1, self.compute_dim)
+
         pred_softmax = torch.softmax(pred, dim=self.compute_dim)
 
         weight = (1 - pred_softmax) ** self.gama
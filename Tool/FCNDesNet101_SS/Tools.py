@@ -21,6 +21,9 @@ class SSTools(BaseTools):
             **kwargs
     ) -> torch.Tensor:
         # masks_vec = labels
+        if torch.is_tensor(labels):
+            # (N, H, W) uint8 index maps, one-hot is built in loss
+            return labels
         return torch.from_numpy(np.array(labels))
 
     @staticmethod
@@ -29,6 +32,9 @@ class SSTools(BaseTools):
             *args,
             **kwargs
     ) -> torch.Tensor:
+        if target.dtype == torch.uint8:
+            # (N, H, W) index map, keep it
+            return target
         return target.permute(0, 2, 3, 1)
 
     @staticmethod
@@ -1,7 +1,8 @@
 from Tool.FCNDesNet101_SS.Tools import SSTools
 from Tool.FCNDesNet101_SS.Model import FCNResnet101
 from Tool.FCNDesNet101_SS.Loss import FocalLoss
-from Tool.BaseTools import WarmUpOptimizer
+from Tool.BaseTools import WarmUpOptimizer, DevicePrefetcher, TrainMetrics
+from Tool.BaseTools.trainer import to_float
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 import torch
@@ -15,6 +16,11 @@ class SSTrainer:
     ):
         self.detector = model
         self.device = next(model.parameters()).device
+        # mixed precision, see BaseTrainer
+        self.amp_dtype = None
+        # metrics stream of training, see BaseTrainer
+        self.metrics_callback = None
+        self.metrics_sync_frequency = 0
 
     def make_targets(
             self,
@@ -25,6 +31,14 @@ class SSTrainer:
         )
         return targets.to(self.device)
 
+    def forward_detector(
+            self,
+            images: torch.Tensor
+    ):
+        with torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            output = self.detector(images)
+        return to_float(output)
+
     def train_detector_one_epoch(
             self,
             data_loader_train: DataLoader,
@@ -33,40 +47,40 @@ class SSTrainer:
             now_epoch: int,
             desc: str = '',
     ):
-        loss_dict_vec = {}
+        metrics = TrainMetrics(self.device, now_epoch, self.metrics_sync_frequency, self.metrics_callback)
         max_batch_ind = len(data_loader_train)
 
-        for batch_id, (images, objects, masks) in enumerate(tqdm(data_loader_train,
-                                                                 desc=desc,
-                                                                 position=0)):
-            optimizer.warm(
-                now_epoch,
-                batch_id,
-                max_batch_ind
-            )
+        batches = metrics.timed(tqdm(DevicePrefetcher(data_loader_train, self.device), desc=desc, position=0))
+        for batch_id, (images, objects, masks) in enumerate(batches):
+            step_ind, max_step_ind, micro_ind, micro_number = optimizer.micro_batch_info(batch_id, max_batch_ind)
+            if micro_ind == 0:
+                # lr is changed per optimizer step (not per micro-batch)
+                optimizer.warm(
+                    now_epoch,
+                    step_ind,
+                    max_step_ind
+                )
 
             self.detector.train()
             images = images.to(self.device)
 
             targets = self.make_targets(masks)
 
-            output = self.detector(images)
+            output = self.forward_detector(images)
             loss_res = yolo_loss_func(output, targets)
             if not isinstance(loss_res, dict):
                 print('You have not use our provided loss func, please overwrite method train_detector_one_epoch')
                 pass
             else:
                 loss = loss_res['total_loss']
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                if micro_ind == 0:
+                    optimizer.zero_grad()
+                # mean of micro-batches --> same as the loss of the whole batch
+                optimizer.backward(loss / micro_number)
+                if micro_ind == micro_number - 1:
+                    optimizer.step()
 
-                for key, val in loss_res.items():
-                    if key not in loss_dict_vec.keys():
-                        loss_dict_vec[key] = []
-                    loss_dict_vec[key].append(val.item())
+                # summed up on device, synced every metrics_sync_frequency steps (not every step)
+                metrics.update(loss_res)
 
-        loss_dict = {}
-        for key, val in loss_dict_vec.items():
-            loss_dict[key] = sum(val) / len(val) if len(val) != 0 else 0.0
-        return loss_dict
+        return metrics.mean()
@@ -66,6 +66,9 @@ class SSVisualizer:
 
     ):
         image = image.copy().astype(np.float32)
+        if gt_mask_vec.dtype == np.uint8:
+            # index map --> one-hot
+            gt_mask_vec = SSTools.index_map_to_one_hot(gt_mask_vec, len(KIND_NAME_TO_COLOR))
         pre_mask_vec = pre_mask_vec.copy().astype(np.float32)
         gt_mask_vec = gt_mask_vec.copy().astype(np.float32)
 
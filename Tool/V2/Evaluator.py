@@ -28,6 +28,7 @@ class YOLOV2Evaluator(BaseEvaluator):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV2Tools.clear_grid_and_anchor_cache()
 
     def make_targets(
             self,
@@ -13,7 +13,12 @@ class YOLOV2FormalEvaluator(BaseFormalEvaluator):
             transform,
             labelmap: list,
             display=False,
-            use_07: bool = True
+            use_07: bool = True,
+            batch_size: int = 1,
+            num_workers: int = 0,
+            export_txt: bool = False,
+            eval_workers: int = 0,
+            distributed: bool = False,
     ):
         super().__init__(
             predictor,
@@ -23,7 +28,12 @@ class YOLOV2FormalEvaluator(BaseFormalEvaluator):
             transform,
             labelmap,
             display,
-            use_07
+            use_07,
+            batch_size,
+            num_workers,
+            export_txt,
+            eval_workers,
+            distributed
         )
         self.model = model
 
@@ -236,6 +236,7 @@ class YOLOV2Loss(BaseLoss):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV2Tools.clear_grid_and_anchor_cache()
 
     def txtytwth_xyxy(
             self,
@@ -39,12 +39,19 @@ class YOLOV2Predictor(BasePredictor):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV2Tools.clear_grid_and_anchor_cache()
 
     def decode_one_target(
             self,
             x: torch.Tensor,
     ) -> List:
+        return self.decode_target(x)[0]
 
+    def decode_target(
+            self,
+            x: torch.Tensor,
+    ) -> List[List]:
+        batch_size = x.shape[0]
         a_n = len(self.pre_anchor_w_h)
         #####################################################################
 
@@ -66,56 +73,36 @@ class YOLOV2Predictor(BasePredictor):
 
         #####################################################################
 
-        position_abs_ = position_abs.contiguous().view(-1, 4)
-        conf_ = conf.contiguous().view(-1, )  # type: torch.Tensor
-        cls_prob_ = cls_prob.contiguous().view(-1, len(self.kinds_name))
-        scores_ = cls_prob_ * conf_.unsqueeze(-1).expand_as(cls_prob_)
-        # (-1, kinds_num)
-
-        cls_prob_mask = cls_prob_.max(dim=-1)[0] > self.prob_th  # type: torch.Tensor
-        # (-1, )
-
-        conf_mask = conf_ > self.conf_th  # type: torch.Tensor
-        # (-1, )
-
-        scores_max_value, scores_max_index = scores_.max(dim=-1)
-        # (-1, )
-
-        scores_mask = scores_max_value > self.score_th  # type: torch.Tensor
-        # (-1, )
-
-        mask = (conf_mask.float() * cls_prob_mask.float() * scores_mask.float()).bool()
-        # (-1, )
-
-        return self.nms(
-            position_abs_[mask],
-            scores_max_value[mask],
-            scores_max_index[mask]
+        position_abs_ = position_abs.contiguous().view(batch_size, -1, 4)
+        conf_ = conf.contiguous().view(batch_size, -1)  # type: torch.Tensor
+        cls_prob_ = cls_prob.contiguous().view(batch_size, -1, len(self.kinds_name))
+
+        return self.nms_batch(
+            *self.mask_batch(
+                position_abs_,
+                conf_,
+                cls_prob_
+            ),
+            batch_size
         )
 
-    def decode_target(
-            self,
-            x: torch.Tensor,
-    ) -> List[List]:
-        res = []
-        for i in range(x.shape[0]):
-            pre_ = self.decode_one_target(
-                x[i].unsqueeze(dim=0),
-            )
-            res.append(pre_)
-
-        return res
-
     def decode_one_predict(
             self,
             out_put: torch.Tensor,
     ) -> List:
+        return self.decode_predict(out_put)[0]
+
+    def decode_predict(
+            self,
+            x: torch.Tensor,
+    ) -> List[List]:
+        batch_size = x.shape[0]
         a_n = len(self.pre_anchor_w_h)
 
         ##############################################
 
         res_dict = YOLOV2Tools.split_predict(
-            out_put,
+            x,
             a_n
         )
         conf = torch.sigmoid(res_dict.get('conf'))
@@ -130,43 +117,15 @@ class YOLOV2Predictor(BasePredictor):
         # scaled on image
         ###################################################
 
-        position_abs_ = position_abs.contiguous().view(-1, 4)
-        conf_ = conf.contiguous().view(-1, )  # type: torch.Tensor
-        cls_prob_ = cls_prob.contiguous().view(-1, len(self.kinds_name))
-        scores_ = cls_prob_ * conf_.unsqueeze(-1).expand_as(cls_prob_)
-        # (-1, kinds_num)
-
-        cls_prob_mask = cls_prob_.max(dim=-1)[0] > self.prob_th  # type: torch.Tensor
-        # (-1, )
-
-        conf_mask = conf_ > self.conf_th  # type: torch.Tensor
-        # (-1, )
-
-        scores_max_value, scores_max_index = scores_.max(dim=-1)
-        # (-1, )
-
-        scores_mask = scores_max_value > self.score_th  # type: torch.Tensor
-        # (-1, )
-
-        mask = (conf_mask.float() * cls_prob_mask.float() * scores_mask.float()).bool()
-        # (-1, )
-
-        return self.nms(
-            position_abs_[mask],
-            scores_max_value[mask],
-            scores_max_index[mask]
+        position_abs_ = position_abs.contiguous().view(batch_size, -1, 4)
+        conf_ = conf.contiguous().view(batch_size, -1)  # type: torch.Tensor
+        cls_prob_ = cls_prob.contiguous().view(batch_size, -1, len(self.kinds_name))
+
+        return self.nms_batch(
+            *self.mask_batch(
+                position_abs_,
+                conf_,
+                cls_prob_
+            ),
+            batch_size
         )
-
-    def decode_predict(
-            self,
-            x: torch.Tensor,
-    ) -> List[List]:
-        res = []
-        for i in range(x.shape[0]):
-            pre_ = self.decode_one_predict(
-                x[i].unsqueeze(dim=0),
-            )
-            res.append(pre_)
-
-        return res
-
@@ -1,6 +1,6 @@
 import torch
 import numpy as np
-from Tool.BaseTools import BaseTools
+from Tool.BaseTools import BaseTools, PaddedLabels
 
 
 class YOLOV2Tools(BaseTools):
@@ -203,6 +203,292 @@ class YOLOV2Tools(BaseTools):
 
         return gt_tensor
 
+    @staticmethod
+    def flatten_labels(
+            labels: list,
+            kinds_name: list,
+    ) -> tuple:
+        '''
+        all objects of the batch
+        Args:
+            labels: see make_target
+
+        Returns:
+            batch_index (M, ), kind_index (M, ), abs_gt_pos (M, 4)  (np.ndarray)
+        '''
+        if isinstance(labels, PaddedLabels):
+            return labels.flatten()
+        batch_index = []
+        kind_index = []
+        abs_gt_pos = []
+        for b_index, label in enumerate(labels):  # an image label
+            for obj in label:  # many objects
+                batch_index.append(b_index)
+                kind_index.append(kinds_name.index(obj[0]))
+                abs_gt_pos.append(obj[1:5])
+        return (
+            np.array(batch_index, dtype=np.int64),
+            np.array(kind_index, dtype=np.int64),
+            np.array(abs_gt_pos, dtype=np.float64).reshape(-1, 4)
+        )
+
+    @staticmethod
+    def make_targets_1_from_objects(
+            N: int,
+            batch_index: np.ndarray,
+            kind_index: np.ndarray,
+            abs_gt_pos: np.ndarray,
+            anchor_pre_wh: tuple,
+            image_wh: tuple,
+            grid_number: tuple,
+            iou_th: float = 0.6,
+    ) -> torch.Tensor:
+        '''
+        vectorized gt_creator (see generate_txtytwth), all objects at once with the same float64 arithmetic.
+        Later objects overwrite earlier ones exactly as the old loop did, so the result is bit-identical.
+        Args:
+            N: batch size
+            batch_index: (M, ) image index of every object
+            kind_index: (M, )
+            abs_gt_pos: (M, 4) not scaled
+            anchor_pre_wh:
+            image_wh:
+            grid_number:
+            iou_th:
+
+        Returns:
+            same as make_targets_1
+        '''
+        w = h = image_wh[0]
+        s = image_wh[0] // grid_number[0]
+        ws, hs = w // s, h // s
+        anchor_number = len(anchor_pre_wh)
+
+        xyxy = np.asarray(abs_gt_pos, dtype=np.float64).reshape(-1, 4) / np.array(
+            [image_wh[0], image_wh[1], image_wh[0], image_wh[1]], dtype=np.float64
+        )
+        xmin, ymin, xmax, ymax = [xyxy[:, i:i + 1] for i in range(4)]
+        # (M, 1)
+        c_x = (xmax + xmin) / 2 * w
+        c_y = (ymax + ymin) / 2 * h
+        box_w = (xmax - xmin) * w
+        box_h = (ymax - ymin) * h
+        valid = ~((box_w < 1e-4) | (box_h < 1e-4))[:, 0]
+
+        c_x_s, c_y_s = c_x / s, c_y / s
+        box_ws, box_hs = box_w / s, box_h / s
+        grid_x = c_x_s.astype(np.int64)  # int(), towards zero
+        grid_y = c_y_s.astype(np.int64)
+
+        # IoU of anchors and gt boxes, both centered at (0, 0) (see compute_iou_for_build_target)
+        anchor_size = np.array(anchor_pre_wh, dtype=np.float64).reshape(1, -1, 2)
+        w_ab, h_ab = anchor_size[..., 0], anchor_size[..., 1]
+        # (1, A)
+        i_w = np.minimum(box_ws / 2, w_ab / 2) - np.maximum(0 - box_ws / 2, 0 - w_ab / 2)
+        i_h = np.minimum(box_hs / 2, h_ab / 2) - np.maximum(0 - box_hs / 2, 0 - h_ab / 2)
+        s_i = i_h * i_w
+        iou = s_i / (box_ws * box_hs + w_ab * h_ab - s_i + 1e-20)
+        # (M, A)
+
+        # the best anchor is positive (the first max one, np.argmax), others above iou_th are ignored
+        M = iou.shape[0]
+        best_index = iou.argmax(axis=1)
+        is_best = np.zeros(shape=(M, anchor_number), dtype=bool)
+        is_best[np.arange(M), best_index] = True
+        write = (is_best | (iou > iou_th)) & valid[:, None]
+
+        # one write for every (object, anchor), in the order of the loop
+        obj_ind, anchor_ind = np.nonzero(write)
+        is_best = is_best[obj_ind, anchor_ind]
+        weight = 2.0 - (box_w[obj_ind, 0] / w) * (box_h[obj_ind, 0] / h)
+        positive = is_best & (weight > 0.)
+        gx, gy = grid_x[obj_ind, 0], grid_y[obj_ind, 0]
+        # positive boxes out of the grid are skipped
+        keep = ~positive | ((gy < hs) & (gx < ws))
+        obj_ind, anchor_ind, gx, gy = obj_ind[keep], anchor_ind[keep], gx[keep], gy[keep]
+        weight, positive = weight[keep], positive[keep]
+
+        # flat cell id, indexing keeps the semantics of gt_tensor[b, y, x, a] (negative / out of range)
+        cell_id = torch.arange(N * hs * ws * anchor_number).view(N, hs, ws, anchor_number)[
+            torch.from_numpy(np.asarray(batch_index, dtype=np.int64)[obj_ind]),
+            torch.from_numpy(gy),
+            torch.from_numpy(gx),
+            torch.from_numpy(anchor_ind),
+        ]
+        gt_tensor = torch.zeros(size=(N * hs * ws * anchor_number, 1 + 1 + 4 + 1 + 4), dtype=torch.float64)
+
+        # obj(0) and weight(6) are written by every anchor, -1.0 --> ignored
+        last = YOLOV2Tools.last_write_mask(cell_id)
+        positive_t = torch.from_numpy(positive)
+        gt_tensor[cell_id[last], 0] = torch.where(positive_t[last], 1.0, -1.0).double()
+        gt_tensor[cell_id[last], 6] = torch.where(
+            positive_t[last], torch.from_numpy(weight)[last], torch.tensor(-1.0, dtype=torch.float64)
+        )
+
+        # class, txtytwth and xyxy are written by positive anchors
+        obj_ind, anchor_ind = obj_ind[positive], anchor_ind[positive]
+        p_w, p_h = anchor_size[0, anchor_ind, 0], anchor_size[0, anchor_ind, 1]
+        values = np.concatenate([
+            np.asarray(kind_index, dtype=np.float64)[obj_ind, None],
+            c_x_s[obj_ind] - gx[positive, None],
+            c_y_s[obj_ind] - gy[positive, None],
+            np.log(box_ws[obj_ind, 0] / p_w)[:, None],
+            np.log(box_hs[obj_ind, 0] / p_h)[:, None],
+        ], axis=1)
+        positive_cell_id = cell_id[positive_t]
+        last = YOLOV2Tools.last_write_mask(positive_cell_id)
+        gt_tensor[positive_cell_id[last], 1:6] = torch.from_numpy(values)[last]
+        gt_tensor[positive_cell_id[last], 7:] = torch.from_numpy(xyxy[obj_ind])[last]
+
+        gt_tensor = gt_tensor.view(N, hs, ws, anchor_number, -1)
+        gt_tensor = gt_tensor.reshape(N, grid_number[1], grid_number[0], anchor_number, -1).float()
+        # (N, H, W, a_n, 11)
+        return gt_tensor
+
+    @staticmethod
+    def compute_anchor_response_result_batch(
+            anchor_pre_wh: tuple,
+            abs_gt_pos: np.ndarray,
+            grid_number: tuple,
+            image_wh: tuple,
+            iou_th: float = 0.6,
+    ) -> tuple:
+        '''
+        compute_anchor_response_result for many objects at once (same float64 arithmetic)
+        Args:
+            anchor_pre_wh:
+            abs_gt_pos: (M, 4) not scaled
+            grid_number:
+            image_wh:
+            iou_th:
+
+        Returns:
+            weight --> (M, A)
+            best_index --> (M, )
+            valid  --> (M, ) False for objects compute_anchor_response_result returns -1
+        '''
+        anchor_w = np.array(
+            [val[0] / grid_number[0] * image_wh[0] for val in anchor_pre_wh], dtype=np.float64
+        )[None, :]
+        anchor_h = np.array(
+            [val[1] / grid_number[1] * image_wh[1] for val in anchor_pre_wh], dtype=np.float64
+        )[None, :]
+        # (1, A)
+        gt_w = abs_gt_pos[:, 2:3] - abs_gt_pos[:, 0:1]
+        gt_h = abs_gt_pos[:, 3:4] - abs_gt_pos[:, 1:2]
+        # (M, 1)
+        valid = ~((gt_w < 1e-4) | (gt_h < 1e-4))[:, 0]
+
+        s0 = anchor_w * anchor_h
+        s1 = gt_w * gt_h
+        inter = np.minimum(anchor_w, gt_w) * np.minimum(anchor_h, gt_h)
+        union = s0 + s1 - inter
+        iou = inter / (union + 1e-8)
+        # (M, A)
+
+        M, A = iou.shape
+        weight = np.repeat(2.0 - (gt_w / image_wh[0]) * (gt_h / image_wh[1]), A, axis=1)
+        # the last max one, same as "iou >= best_iou" in the loop
+        best_index = A - 1 - iou[:, ::-1].argmax(axis=1)
+        is_best = np.zeros(shape=(M, A), dtype=bool)
+        is_best[np.arange(M), best_index] = True
+        # ignore(-1.0) or negative(0.0) anchor
+        weight = np.where(is_best, weight, np.where(iou >= iou_th, -1.0, 0.0))
+
+        return weight, best_index, valid
+
+    @staticmethod
+    def make_targets_0_from_objects(
+            N: int,
+            batch_index: np.ndarray,
+            kind_index: np.ndarray,
+            abs_gt_pos: np.ndarray,
+            anchor_pre_wh: tuple,
+            image_wh: tuple,
+            grid_number: tuple,
+            kinds_number: int,
+            iou_th: float = 0.6,
+    ) -> torch.Tensor:
+        '''
+        vectorized core of make_targets_0.
+        Later objects overwrite earlier ones exactly as the old loop did, so the result is bit-identical.
+        Args:
+            N: batch size
+            batch_index: (M, ) image index of every object
+            kind_index: (M, )
+            abs_gt_pos: (M, 4) not scaled
+            anchor_pre_wh:
+            image_wh:
+            grid_number:
+            kinds_number:
+            iou_th:
+
+        Returns:
+            same as make_targets_0
+        '''
+        abs_gt_pos = np.asarray(abs_gt_pos, dtype=np.float64).reshape(-1, 4)
+        weight, best_index, valid = YOLOV2Tools.compute_anchor_response_result_batch(
+            anchor_pre_wh,
+            abs_gt_pos,
+            grid_number,
+            image_wh,
+            iou_th
+        )
+        batch_index = np.asarray(batch_index, dtype=np.int64)[valid]
+        kind_index = np.asarray(kind_index, dtype=np.int64)[valid]
+        abs_gt_pos = abs_gt_pos[valid]
+        weight = weight[valid]
+        best_index = best_index[valid]
+
+        a_n, H, W = len(anchor_pre_wh), grid_number[1], grid_number[0]
+        targets = torch.zeros(size=(N * a_n, 5 + kinds_number, H * W))
+        pos = torch.tensor(abs_gt_pos, dtype=torch.float32)
+        # (M, 4)
+
+        grid_size = (
+            image_wh[0] // grid_number[0],
+            image_wh[1] // grid_number[1]
+        )
+        grid_index_x = np.floor_divide((abs_gt_pos[:, 0] + abs_gt_pos[:, 2]) * 0.5, grid_size[0]).astype(np.int64)
+        grid_index_y = np.floor_divide((abs_gt_pos[:, 1] + abs_gt_pos[:, 3]) * 0.5, grid_size[1]).astype(np.int64)
+
+        # one write for every (object, anchor), in the order of the loop
+        obj_ind = np.repeat(np.arange(abs_gt_pos.shape[0]), a_n)
+        anchor_ind = np.tile(np.arange(a_n), abs_gt_pos.shape[0])
+        weight_value = weight[obj_ind, anchor_ind]
+        positive = anchor_ind == best_index[obj_ind]
+
+        # flat cell id, indexing keeps the semantics of targets[b, a, :, y, x] (negative / out of range)
+        cell_id = torch.arange(N * a_n * H * W).view(N, a_n, H, W)[
+            torch.from_numpy(batch_index[obj_ind]),
+            torch.from_numpy(anchor_ind),
+            torch.from_numpy(grid_index_y[obj_ind]),
+            torch.from_numpy(grid_index_x[obj_ind]),
+        ]
+        b_a = cell_id // (H * W)
+        h_w = cell_id % (H * W)
+        weight_value = torch.tensor(weight_value, dtype=torch.float32)
+        positive = torch.from_numpy(positive)
+        obj_ind = torch.from_numpy(obj_ind)
+        # -------------------------------------------------------------------
+        # conf(weight) is written by every object
+        # -1, ignore
+        # 0, negative
+        # >0 [1, 2], positive
+        last = YOLOV2Tools.last_write_mask(cell_id)
+        targets[b_a[last], 4, h_w[last]] = weight_value[last]
+
+        # position is written by the best anchor
+        b_a, h_w, obj_ind = b_a[positive], h_w[positive], obj_ind[positive]
+        last = YOLOV2Tools.last_write_mask(cell_id[positive])
+        targets[b_a[last].unsqueeze(-1), torch.arange(4), h_w[last].unsqueeze(-1)] = pos[obj_ind[last]]
+
+        # kind is never cleared, every positive object sets its one
+        kind_ind = torch.from_numpy(kind_index)[obj_ind]
+        targets[b_a, 5 + kind_ind, h_w] = 1.0
+
+        return targets.view(N, -1, H, W)
+
     @staticmethod
     def make_targets_1(
             labels: list,
@@ -214,6 +500,92 @@ class YOLOV2Tools(BaseTools):
     ) -> torch.Tensor:
         '''
 
+        Args:
+            labels: [
+                [obj, obj, obj, ...],               --> one image
+                ...
+            ]
+                obj = [kind_name: str, x, y, x, y]  --> one obj
+                or PaddedLabels (kind ids, no kind names)
+            anchor_pre_wh: [
+                [w0, h0],
+                [w1, h1],
+                ...
+            ]
+            image_wh: [image_w, image_h]
+            grid_number: [grid_w, grid_h]
+            kinds_name: [kind_name0, kinds_name1, ... ]
+            iou_th:
+        Returns:
+            (N, H, W, a_n, 11)
+        '''
+        batch_index, kind_index, abs_gt_pos = YOLOV2Tools.flatten_labels(labels, kinds_name)
+        return YOLOV2Tools.make_targets_1_from_objects(
+            len(labels),
+            batch_index,
+            kind_index,
+            abs_gt_pos,
+            anchor_pre_wh,
+            image_wh,
+            grid_number,
+            iou_th
+        )
+
+    @staticmethod
+    def make_targets_0(
+            labels: list,
+            anchor_pre_wh: tuple,
+            image_wh: tuple,
+            grid_number: tuple,
+            kinds_name: list,
+            iou_th: float = 0.6,
+    ) -> torch.Tensor:
+        '''
+
+        Args:
+            labels: [
+                [obj, obj, obj, ...],               --> one image
+                ...
+            ]
+                obj = [kind_name: str, x, y, x, y]  --> one obj
+                or PaddedLabels (kind ids, no kind names)
+            anchor_pre_wh: [
+                [w0, h0],
+                [w1, h1],
+                ...
+            ]
+            image_wh: [image_w, image_h]
+            grid_number: [grid_w, grid_h]
+            kinds_name: [kind_name0, kinds_name1, ... ]
+            iou_th:
+
+        Returns:
+            (N, a_n * (5 + kinds_number), H, W)
+        '''
+        batch_index, kind_index, abs_gt_pos = YOLOV2Tools.flatten_labels(labels, kinds_name)
+        return YOLOV2Tools.make_targets_0_from_objects(
+            len(labels),
+            batch_index,
+            kind_index,
+            abs_gt_pos,
+            anchor_pre_wh,
+            image_wh,
+            grid_number,
+            len(kinds_name),
+            iou_th
+        )
+
+    @staticmethod
+    def py_make_targets_1(
+            labels: list,
+            anchor_pre_wh: tuple,
+            image_wh: tuple,
+            grid_number: tuple,
+            kinds_name: list,
+            iou_th: float = 0.6,
+    ) -> torch.Tensor:
+        '''
+
         Args:
             labels: [
                 [obj, obj, obj, ...],               --> one image
@@ -232,6 +604,7 @@ class YOLOV2Tools(BaseTools):
         Returns:
 
         '''
+        # the python loop version of make_targets_1, kept as the reference of it
 
         label_lists = []
         for label in labels:
@@ -257,7 +630,7 @@ class YOLOV2Tools(BaseTools):
         return gt_torch
 
     @staticmethod
-    def make_targets_0(
+    def py_make_targets_0(
             labels: list,
             anchor_pre_wh: tuple,
             image_wh: tuple,
@@ -286,6 +659,7 @@ class YOLOV2Tools(BaseTools):
         Returns:
             (N, a_n * (5 + kinds_number), H, W)
         '''
+        # the python loop version of make_targets_0, kept as the reference of it
 
         kinds_number = len(kinds_name)
         N, a_n, H, W = len(labels), len(anchor_pre_wh), grid_number[1], grid_number[0]
@@ -550,26 +924,13 @@ class YOLOV2Tools(BaseTools):
             grid_number: tuple,
     ) -> torch.Tensor:
         # -1 * H * W * a_n * 4
-        N, _, _, a_n, _ = position.shape
-
-        grid = YOLOV2Tools.get_grid(grid_number)
-        # H * W * 2
-
-        grid = grid.unsqueeze(-2).unsqueeze(0).expand(N,
-                                                      grid_number[0],
-                                                      grid_number[1],
-                                                      a_n,
-                                                      2)
-
-        # -1 * H * W * a_n * 2
-
-        grid_index = grid.to(position.device)
-
-        pre_wh = torch.tensor(
+        grid_index, pre_wh = YOLOV2Tools.get_grid_and_anchor(
+            grid_number,
             anchor_pre_wh,
-            dtype=torch.float32
+            position.device,
+            position.dtype
         )
-        pre_wh = pre_wh.to(position.device)
+        # 1 * H * W * 1 * 2 (cached)
         # a_n * 2
 
         a_b = position[..., 0:2]  # -1 * a_n * 2
@@ -597,27 +958,13 @@ class YOLOV2Tools(BaseTools):
         #     return - torch.log(1.0 / (x + 1e-8) - 1.0)
 
         # -1 * H * W * a_n * 4
-        N, _, _, a_n, _ = position.shape
-
-        grid = YOLOV2Tools.get_grid(grid_number)
-        # H * W * 2
-
-        grid = grid.unsqueeze(-2).unsqueeze(0).expand(N,
-                                                      grid_number[0],
-                                                      grid_number[1],
-                                                      a_n,
-                                                      2)
-
-        # -1 * H * W * a_n * 2
-
-        grid_index = grid.to(position.device)
-
-        pre_wh = torch.tensor(
+        grid_index, pre_wh = YOLOV2Tools.get_grid_and_anchor(
+            grid_number,
             anchor_pre_wh,
-            dtype=torch.float32
+            position.device,
+            position.dtype
         )
-        pre_wh = pre_wh.to(position.device)
-
+        # 1 * H * W * 1 * 2 (cached)
         # a_n * 2
 
         a_b = position[..., 0:2]  # -1 * a_n * 2
@@ -637,3 +984,56 @@ class YOLOV2Tools(BaseTools):
         twh = torch.log(w_h/image_wh[0]*grid_number[0]/pre_wh.expand_as(w_h) + 1e-20)
 
         return torch.cat((txy_s, twh), dim=-1)
+
+
+def debug_make_target_speed(
+        batch_size: int = 8,
+        object_number: int = 60,
+):
+    '''
+    compare YOLOV2Tools.py_make_targets_0/1(python loop) with YOLOV2Tools.make_targets_0/1(vectorized)
+    on synthetic labels
+    '''
+    import time
+    from Tool.V2.Config import YOLOV2DataSetConfig
+
+    config = YOLOV2DataSetConfig()
+    image_size = config.image_size
+    kinds_name = config.kinds_name
+    grid_number, pre_anchor_w_h = YOLOV2Tools.get_grid_number_and_pre_anchor_w_h(
+        image_size,
+        config.image_shrink_rate,
+        config.pre_anchor_w_h_rate
+    )
+
+    labels = []
+    for _ in range(batch_size):
+        label = []
+        for _ in range(object_number):
+            x0, y0 = np.random.rand(2) * image_size[0] * 0.8
+            w, h = np.random.rand(2) * image_size[0] * 0.2 + 2
+            label.append(
+                (kinds_name[np.random.randint(len(kinds_name))], x0, y0, x0 + w, y0 + h)
+            )
+        labels.append(label)
+
+    print('objects: {} x {}'.format(batch_size, object_number))
+    for old_func, new_func in [
+        (YOLOV2Tools.py_make_targets_0, YOLOV2Tools.make_targets_0),
+        (YOLOV2Tools.py_make_targets_1, YOLOV2Tools.make_targets_1),
+    ]:
+        t0 = time.time()
+        old_target = old_func(labels, pre_anchor_w_h, image_size, grid_number, kinds_name)
+        old_time = time.time() - t0
+
+        t0 = time.time()
+        new_target = new_func(labels, pre_anchor_w_h, image_size, grid_number, kinds_name)
+        new_time = time.time() - t0
+
+        print('{:<18}: {:.4f}s'.format(old_func.__name__, old_time))
+        print('{:<18}: {:.4f}s'.format(new_func.__name__, new_time))
+        print('same result       : {}'.format(torch.equal(old_target, new_target)))
+
+
+if __name__ == '__main__':
+    debug_make_target_speed()
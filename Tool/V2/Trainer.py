@@ -1,3 +1,4 @@
+from functools import partial
 import torch.nn as nn
 from .Tools import YOLOV2Tools
 from .Model import YOLOV2Model
@@ -33,18 +34,24 @@ class YOLOV2Trainer(BaseTrainer):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV2Tools.clear_grid_and_anchor_cache()
+
+    def target_builder(
+            self
+    ):
+        return partial(
+            YOLOV2Tools.make_target,
+            anchor_pre_wh=self.pre_anchor_w_h,
+            image_wh=self.image_size,
+            grid_number=self.grid_number,
+            kinds_name=self.kinds_name,
+            iou_th=self.iou_th_for_make_target
+        )
 
     def make_targets(
             self,
             labels,
     ):
-        return YOLOV2Tools.make_target(
-            labels,
-            self.pre_anchor_w_h,
-            self.image_size,
-            self.grid_number,
-            self.kinds_name,
-            self.iou_th_for_make_target,
-        ).to(self.device)
-
-
+        return self.targets_to_device(
+            self.target_builder()(labels)
+        )
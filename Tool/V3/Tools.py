@@ -1,6 +1,6 @@
 import torch
 import numpy as np
-from Tool.BaseTools import BaseTools
+from Tool.BaseTools import BaseTools, PaddedLabels
 from typing import Union
 
 
@@ -150,6 +150,157 @@ class YOLOV3Tools(BaseTools):
 
         return res
 
+    @staticmethod
+    def compute_anchor_response_result_batch(
+            anchor_pre_wh: dict,
+            grid_number_dict: dict,
+            abs_gt_pos: np.ndarray,
+            image_wh: Union[tuple, list],
+            iou_th: float = 0.6,
+    ) -> tuple:
+        '''
+        compute_anchor_response_result for many objects at once (same float64 arithmetic)
+        Args:
+            anchor_pre_wh: scaled on grid
+            grid_number_dict: grid number
+            abs_gt_pos: (M, 4) not scaled
+            image_wh:
+            iou_th:
+
+        Returns:
+            weight --> (M, anchor_total_number) all anchors flattened in key order
+            valid  --> (M, ) False for objects compute_anchor_response_result returns None
+        '''
+        anchor_w_vec = []
+        anchor_h_vec = []
+        for anchor_key, anchor_rate in anchor_pre_wh.items():
+            grid_number = grid_number_dict[anchor_key]
+            for val in anchor_rate:
+                anchor_w_vec.append(val[0] / grid_number[0] * image_wh[0])  # scaled on image
+                anchor_h_vec.append(val[1] / grid_number[1] * image_wh[1])  # scaled on image
+
+        anchor_w = np.array(anchor_w_vec, dtype=np.float64)[None, :]
+        anchor_h = np.array(anchor_h_vec, dtype=np.float64)[None, :]
+        # (1, A)
+        gt_w = abs_gt_pos[:, 2:3] - abs_gt_pos[:, 0:1]
+        gt_h = abs_gt_pos[:, 3:4] - abs_gt_pos[:, 1:2]
+        # (M, 1)
+        valid = ~((gt_w < 1e-4) | (gt_h < 1e-4))[:, 0]
+
+        s0 = anchor_w * anchor_h
+        s1 = gt_w * gt_h
+        inter = np.minimum(anchor_w, gt_w) * np.minimum(anchor_h, gt_h)
+        union = s0 + s1 - inter
+        iou = inter / (union + 1e-8)
+        # (M, A)
+
+        M, A = iou.shape
+        weight = np.repeat(2.0 - (gt_w / image_wh[0]) * (gt_h / image_wh[1]), A, axis=1)
+        # the last max one, same as "iou >= best_iou" in the loop
+        best_index = A - 1 - iou[:, ::-1].argmax(axis=1)
+        is_best = np.zeros(shape=(M, A), dtype=bool)
+        is_best[np.arange(M), best_index] = True
+        # ignore(-1.0) or negative(0.0) anchor
+        weight = np.where(is_best, weight, np.where(iou >= iou_th, -1.0, 0.0))
+
+        return weight, valid
+
+    @staticmethod
+    def make_target_from_objects(
+            N: int,
+            batch_index: np.ndarray,
+            kind_index: np.ndarray,
+            abs_gt_pos: np.ndarray,
+            anchor_pre_wh: dict,
+            image_wh: tuple,
+            grid_number: dict,
+            kinds_number: int,
+            iou_th: float = 0.6,
+    ) -> dict:
+        '''
+        vectorized core of make_target (see YOLOV4Tools.make_target_from_objects, one grid cell per object here).
+        Later objects overwrite earlier ones exactly as the old loop did, so the result is bit-identical.
+        Args:
+            N: batch size
+            batch_index: (M, ) image index of every object
+            kind_index: (M, )
+            abs_gt_pos: (M, 4) not scaled
+            anchor_pre_wh:  key --> "C3", "C4", "C5"
+            image_wh:
+            grid_number: key --> "C3", "C4", "C5"
+            kinds_number:
+            iou_th:
+
+        Returns:
+            same as make_target
+        '''
+        abs_gt_pos = np.asarray(abs_gt_pos, dtype=np.float64).reshape(-1, 4)
+        weight, valid = YOLOV3Tools.compute_anchor_response_result_batch(
+            anchor_pre_wh,
+            grid_number,
+            abs_gt_pos,
+            image_wh,
+            iou_th
+        )
+        batch_index = np.asarray(batch_index, dtype=np.int64)[valid]
+        kind_index = np.asarray(kind_index, dtype=np.int64)[valid]
+        abs_gt_pos = abs_gt_pos[valid]
+        weight = weight[valid]
+
+        pos = torch.tensor(abs_gt_pos / image_wh[0], dtype=torch.float32)  # scaled in [0, 1]
+        # (M, 4)
+
+        res = {}
+        anchor_begin = 0
+        for anchor_key, val in grid_number.items():
+            a_n, H, W = len(anchor_pre_wh[anchor_key]), val[1], val[0]
+            target = torch.zeros(size=(N * a_n, 5 + kinds_number, H * W))
+
+            grid_size = (
+                image_wh[0] // W,
+                image_wh[1] // H
+            )
+            grid_index_x = np.floor_divide((abs_gt_pos[:, 0] + abs_gt_pos[:, 2]) * 0.5, grid_size[0]).astype(np.int64)
+            grid_index_y = np.floor_divide((abs_gt_pos[:, 1] + abs_gt_pos[:, 3]) * 0.5, grid_size[1]).astype(np.int64)
+
+            # one write for every (object, anchor), in the order of the loop
+            obj_ind = np.repeat(np.arange(abs_gt_pos.shape[0]), a_n)
+            anchor_ind = np.tile(np.arange(a_n), abs_gt_pos.shape[0])
+
+            weight_value = weight[obj_ind, anchor_begin + anchor_ind]
+            positive = (weight_value != -1) & (weight_value != 0)
+
+            # flat cell id, indexing keeps the semantics of res[b, a, :, y, x] (negative / out of range)
+            cell_id = torch.arange(N * a_n * H * W).view(N, a_n, H, W)[
+                torch.from_numpy(batch_index[obj_ind]),
+                torch.from_numpy(anchor_ind),
+                torch.from_numpy(grid_index_y[obj_ind]),
+                torch.from_numpy(grid_index_x[obj_ind]),
+            ]
+            b_a = cell_id // (H * W)
+            h_w = cell_id % (H * W)
+            weight_value = torch.tensor(weight_value, dtype=torch.float32)
+            positive = torch.from_numpy(positive)
+            obj_ind = torch.from_numpy(obj_ind)
+            # -------------------------------------------------------------------
+            # conf(weight) is written by every object
+            last = YOLOV3Tools.last_write_mask(cell_id)
+            target[b_a[last], 4, h_w[last]] = weight_value[last]
+
+            # position is written by positive objects
+            b_a, h_w, obj_ind = b_a[positive], h_w[positive], obj_ind[positive]
+            last = YOLOV3Tools.last_write_mask(cell_id[positive])
+            target[b_a[last].unsqueeze(-1), torch.arange(4), h_w[last].unsqueeze(-1)] = pos[obj_ind[last]]
+
+            # kind is never cleared, every positive object sets its one
+            kind_ind = torch.from_numpy(kind_index)[obj_ind]
+            target[b_a, 5 + kind_ind, h_w] = 1.0
+
+            res[anchor_key] = target.view(N, -1, H, W)
+            anchor_begin += a_n
+
+        return res
+
     @staticmethod
     def make_target(
             labels: list,
@@ -165,6 +316,7 @@ class YOLOV3Tools(BaseTools):
             labels: [label0, label1, ...]
                     label --> [obj0, obj1, ...]
                     obj --> [kind_name, x, y, x, y]  not scaled
+                    or PaddedLabels (kind ids, no kind names)
             anchor_pre_wh:  key --> "C3", "C4", "C5"
             image_wh:
             grid_number: key --> "C3", "C4", "C5"
@@ -179,6 +331,60 @@ class YOLOV3Tools(BaseTools):
             }
 
         '''
+        if isinstance(labels, PaddedLabels):
+            batch_index, kind_index, abs_gt_pos = labels.flatten()
+        else:
+            batch_index = []
+            kind_index = []
+            abs_gt_pos = []
+            for b_index, label in enumerate(labels):  # an image label
+                for obj in label:  # many objects
+                    batch_index.append(b_index)
+                    kind_index.append(kinds_name.index(obj[0]))
+                    abs_gt_pos.append(obj[1:5])
+
+        return YOLOV3Tools.make_target_from_objects(
+            len(labels),
+            np.array(batch_index, dtype=np.int64),
+            np.array(kind_index, dtype=np.int64),
+            np.array(abs_gt_pos, dtype=np.float64),
+            anchor_pre_wh,
+            image_wh,
+            grid_number,
+            len(kinds_name),
+            iou_th
+        )
+
+    @staticmethod
+    def py_make_target(
+            labels: list,
+            anchor_pre_wh: dict,
+            image_wh: tuple,
+            grid_number: dict,
+            kinds_name: list,
+            iou_th: float = 0.6,
+    ) -> dict:
+        '''
+
+        Args:
+            labels: [label0, label1, ...]
+                    label --> [obj0, obj1, ...]
+                    obj --> [kind_name, x, y, x, y]  not scaled
+            anchor_pre_wh:  key --> "C3", "C4", "C5"
+            image_wh:
+            grid_number: key --> "C3", "C4", "C5"
+            kinds_name:
+            iou_th:
+
+        Returns:
+            {
+                "C3": (N, a_n, 5+k_n, 52, 52) --> (N, -1, 52, 52)
+                "C4": (N, a_n, 5+k_n, 26, 26) --> (N, -1, 26, 26)
+                "C5": (N, a_n, 5+k_n, 13, 13) --> (N, -1, 13, 13)
+            }
+
+        '''
+        # the python loop version of make_target, kept as the reference of it
         kinds_number = len(kinds_name)
         N = len(labels)
         res = {}
@@ -235,26 +441,13 @@ class YOLOV3Tools(BaseTools):
             grid_number: tuple,
     ) -> torch.Tensor:
         # -1 * H * W * a_n * 4
-        N, _, _, a_n, _ = position.shape
-
-        grid = YOLOV3Tools.get_grid(grid_number)
-        # H * W * 2
-
-        grid = grid.unsqueeze(-2).unsqueeze(0).expand(N,
-                                                      grid_number[0],
-                                                      grid_number[1],
-                                                      a_n,
-                                                      2)
-
-        # -1 * H * W * a_n * 2
-
-        grid_index = grid.to(position.device)
-
-        pre_wh = torch.tensor(
+        grid_index, pre_wh = YOLOV3Tools.get_grid_and_anchor(
+            grid_number,
             anchor_pre_wh_for_single_size,
-            dtype=torch.float32
+            position.device,
+            position.dtype
         )
-        pre_wh = pre_wh.to(position.device)
+        # 1 * H * W * 1 * 2 (cached)
         # a_n * 2
 
         a_b = position[..., 0:2]  # -1 * a_n * 2
@@ -286,27 +479,13 @@ class YOLOV3Tools(BaseTools):
         Returns:
 
         '''
-        N, _, _, a_n, _ = position.shape
-
-        grid = YOLOV3Tools.get_grid(grid_number)
-        # H * W * 2
-
-        grid = grid.unsqueeze(-2).unsqueeze(0).expand(N,
-                                                      grid_number[0],
-                                                      grid_number[1],
-                                                      a_n,
-                                                      2)
-
-        # -1 * H * W * a_n * 2
-
-        grid_index = grid.to(position.device)
-
-        pre_wh = torch.tensor(
+        grid_index, pre_wh = YOLOV3Tools.get_grid_and_anchor(
+            grid_number,
             anchor_pre_wh_for_single_size,
-            dtype=torch.float32
+            position.device,
+            position.dtype
         )
-        pre_wh = pre_wh.to(position.device)
-
+        # 1 * H * W * 1 * 2 (cached)
         # a_n * 2
 
         a_b = position[..., 0:2]  # -1 * a_n * 2
@@ -325,3 +504,54 @@ class YOLOV3Tools(BaseTools):
 
 
 
+
+
+def debug_make_target_speed(
+        batch_size: int = 8,
+        object_number: int = 60,
+):
+    '''
+    compare YOLOV3Tools.py_make_target(python loop) with YOLOV3Tools.make_target(vectorized)
+    on synthetic labels
+    '''
+    import time
+    from Tool.V3.Config import YOLOV3Config
+
+    config = YOLOV3Config()
+    image_size = config.data_config.image_size
+    kinds_name = config.data_config.kinds_name
+    grid_number, pre_anchor_w_h = YOLOV3Tools.get_grid_number_and_pre_anchor_w_h(
+        image_size,
+        config.data_config.image_shrink_rate,
+        config.data_config.pre_anchor_w_h_rate
+    )
+
+    labels = []
+    for _ in range(batch_size):
+        label = []
+        for _ in range(object_number):
+            x0, y0 = np.random.rand(2) * image_size[0] * 0.8
+            w, h = np.random.rand(2) * image_size[0] * 0.2 + 2
+            label.append(
+                (kinds_name[np.random.randint(len(kinds_name))], x0, y0, x0 + w, y0 + h)
+            )
+        labels.append(label)
+
+    t0 = time.time()
+    old_target = YOLOV3Tools.py_make_target(labels, pre_anchor_w_h, image_size, grid_number, kinds_name)
+    old_time = time.time() - t0
+
+    t0 = time.time()
+    new_target = YOLOV3Tools.make_target(labels, pre_anchor_w_h, image_size, grid_number, kinds_name)
+    new_time = time.time() - t0
+
+    print('objects: {} x {}'.format(batch_size, object_number))
+    print('py_make_target : {:.4f}s'.format(old_time))
+    print('make_target    : {:.4f}s'.format(new_time))
+    print('same result    : {}'.format(
+        all(torch.equal(old_target[key], new_target[key]) for key in old_target.keys())
+    ))
+
+
+if __name__ == '__main__':
+    debug_make_target_speed()
@@ -1,3 +1,4 @@
+from functools import partial
 from .Model import YOLOV3Model
 from .Tools import YOLOV3Tools
 from Tool.BaseTools import BaseTrainer
@@ -35,22 +36,24 @@ class YOLOV3Trainer(BaseTrainer):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV3Tools.clear_grid_and_anchor_cache()
+
+    def target_builder(
+            self
+    ):
+        return partial(
+            YOLOV3Tools.make_target,
+            anchor_pre_wh=self.pre_anchor_w_h,
+            image_wh=self.image_size,
+            grid_number=self.grid_number,
+            kinds_name=self.kinds_name,
+            iou_th=self.iou_th_for_make_target
+        )
 
     def make_targets(
             self,
             labels,
     ):
-        targets = YOLOV3Tools.make_target(
-            labels,
-            self.pre_anchor_w_h,
-            self.image_size,
-            self.grid_number,
-            self.kinds_name,
-            self.iou_th_for_make_target,
+        return self.targets_to_device(
+            self.target_builder()(labels)
         )
-        for anchor_key in self.anchor_keys:
-            targets[anchor_key] = targets[anchor_key].to(self.device)
-        return targets
-
-
-
@@ -38,6 +38,7 @@ class YOLOV3Visualizer(BaseVisualizer):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV3Tools.clear_grid_and_anchor_cache()
 
     def make_targets(
             self,
@@ -49,6 +49,8 @@ class YOLOV4TrainConfig:
     num_workers: int = 4
     device: str = 'cuda:0'
     batch_size = 16
+    # train loader uses batch_size // accumulate_steps (micro-batch), grads of them are accumulated
+    accumulate_steps: int = 1
     lr: float = 1e-3
     warm_up_end_epoch: int = 5
     use_mosaic: bool = True
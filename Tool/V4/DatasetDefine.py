@@ -1,8 +1,10 @@
-from Tool.BaseTools import VOCDataSet, SSDAugmentation, BaseAugmentation, XMLTranslate, CV2
-from typing import Union, List
+from Tool.BaseTools import VOCDataSet, SSDAugmentation, BaseAugmentation, ResizeUInt8, CV2, TargetCollateFn, SharedImageCache
+from typing import Union, List, Callable
 import numpy as np
 import random
+import time
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 
 class StrongerVOCDataSet(VOCDataSet):
@@ -15,9 +17,11 @@ class StrongerVOCDataSet(VOCDataSet):
             transform: Union[SSDAugmentation, BaseAugmentation] = None,
             use_mosaic: bool = False,
             use_mixup: bool = False,
-
+            use_image_shard: bool = False,
+            image_cache: SharedImageCache = None,
+            kinds_name: list = None,
     ):
-        super().__init__(root, years, train, image_size, transform)
+        super().__init__(root, years, train, image_size, transform, use_image_shard, image_cache, kinds_name)
         self.use_mixup = use_mixup
         self.use_mosaic = use_mosaic
         self.ids = [i for i in range(len(self.image_and_xml_path_info))]
@@ -26,108 +30,81 @@ class StrongerVOCDataSet(VOCDataSet):
             self,
             index
     ):
-        root_path, xml_file_name = self.image_and_xml_path_info[index]
-        xml_trans = XMLTranslate(root_path=root_path, file_name=xml_file_name)
-        # xml_trans.resize(new_size=self.image_size)
-
-        img, label = xml_trans.img, xml_trans.objects
-        boxes = []
-        classes = []
-
-        for val in label:
-            classes.append(val[0])
-            boxes.append(val[1: 5])
+        return self.get_image_label(index)
 
-        boxes = np.array(boxes, dtype=np.float32)
-        classes = np.array(classes)
-
-        return img, boxes, classes
-
-    def __resize_image(
-            self,
-            image: np.ndarray,
+    @staticmethod
+    def affine_boxes(
             boxes: np.ndarray,
-            new_size: tuple
-    ):
-        old_h, old_w, _ = image.shape
-        new_image = CV2.resize(image, new_size)
-        new_h, new_w, _ = new_image.shape
-        new_boxes = boxes.copy()
-        new_boxes[:, [0, 2]] = boxes[:, [0, 2]] / old_w * new_w
-        new_boxes[:, [1, 3]] = boxes[:, [1, 3]] / old_h * new_h
-        return new_image, new_boxes
+            affine_matrix: np.ndarray
+    ) -> np.ndarray:
+        '''
 
-    def __put_image_on_small_back_ground(
-            self,
-            image: np.ndarray,
-            boxes: np.ndarray
-    ):
-        image, boxes = self.__resize_image(image, boxes, self.image_size)
-        back_ground = np.zeros(shape=image.shape)
-
-        back_ground_h, back_ground_w, _ = image.shape
-        scaled_rate = 0.01 * np.random.randint(50, 100)
+        Args:
+            boxes: (k, 4) x y x y
+            affine_matrix: (2, 3)
 
-        new_w = int(scaled_rate * back_ground_w)
-        new_h = int(scaled_rate * back_ground_h)
-
-        image, boxes = self.__resize_image(image, boxes, (new_w, new_h))
-
-        offset_x = np.random.randint(0, back_ground_w - new_w)
-        offset_y = np.random.randint(0, back_ground_h - new_h)
-
-        back_ground[offset_y:offset_y+new_h, offset_x:offset_x+new_w] = image
-        back_ground_boxes = boxes.copy()
-        back_ground_boxes[:, [0, 2]] = boxes[:, [0, 2]] + offset_x
-        back_ground_boxes[:, [1, 3]] = boxes[:, [1, 3]] + offset_y
-        return back_ground, back_ground_boxes
+        Returns:
+            (k, 4) float32
+        '''
+        points = boxes.reshape(-1, 2)  # (2k, 2)
+        new_points = points @ affine_matrix[:, :2].T + affine_matrix[:, 2]
+        return new_points.reshape(-1, 4).astype(np.float32)
 
     def __get_mosaic(
             self,
             index
     ):
+        '''
+        same distribution as the old mosaic (see debug_mosaic_speed), but every tile is resized once
+        and put on a uint8 image of final size directly (no 2x float64 canvas)
+        '''
         ids_list_ = self.ids[:index] + self.ids[index + 1:]
         # random sample other indexs
         id1 = self.ids[index]
         id2, id3, id4 = random.sample(ids_list_, 3)
         ids = [id1, id2, id3, id4]
+
+        w, h = self.image_size
+        # offsets on the (virtual) 2x canvas, which is scaled by 0.5 at last
         offset_vec = [
             [0, 0],
-            [self.image_size[0], 0],
-            [0, self.image_size[1]],
-            [self.image_size[0], self.image_size[1]],
+            [w, 0],
+            [0, h],
+            [w, h],
         ]
-        four_back_ground = np.zeros(shape=(self.image_size[1] * 2, self.image_size[0] * 2, 3))
+        out = np.zeros(shape=(h, w, 3), dtype=np.uint8)
         boxes_vec = []
         class_vec = []
         for i in range(len(ids)):
-            id = ids[i]
-            offset_x, offset_y = offset_vec[i]
-            img, boxes, classes = self.__get_origin_one(id)
-            img, boxes = self.__put_image_on_small_back_ground(img, boxes)
-            h, w, _ = img.shape
-            # put on four background
-            four_back_ground[offset_y: offset_y + h, offset_x: offset_x+w] = img
-            boxes[:, [0, 2]] += offset_x
-            boxes[:, [1, 3]] += offset_y
+            img, boxes, classes = self.__get_origin_one(ids[i])
+            old_h, old_w, _ = img.shape
+
+            scaled_rate = 0.01 * np.random.randint(50, 100)
+            new_w = int(scaled_rate * w)
+            new_h = int(scaled_rate * h)
+            offset_x = offset_vec[i][0] + np.random.randint(0, w - new_w)
+            offset_y = offset_vec[i][1] + np.random.randint(0, h - new_h)
 
+            # tile on out
+            x0, x1 = int(round(offset_x * 0.5)), int(round((offset_x + new_w) * 0.5))
+            y0, y1 = int(round(offset_y * 0.5)), int(round((offset_y + new_h) * 0.5))
+            x1, y1 = max(x1, x0 + 1), max(y1, y0 + 1)
+
+            out[y0:y1, x0:x1] = CV2.resize(img, (x1 - x0, y1 - y0))
+            affine_matrix = np.array([
+                [(x1 - x0) / old_w, 0, x0],
+                [0, (y1 - y0) / old_h, y0],
+            ])
             boxes_vec.append(
-                boxes
+                self.affine_boxes(boxes, affine_matrix)
             )
             class_vec.append(
                 classes
             )
 
-        img = four_back_ground
         boxes = np.concatenate(boxes_vec, axis=0)
         classes = np.concatenate(class_vec, axis=0)
-
-        img, boxes = self.__resize_image(
-            img,
-            boxes,
-            self.image_size
-        )
-        return img, boxes, classes
+        return out, boxes, classes
 
     def __get_image_label(
             self,
@@ -139,7 +116,7 @@ class StrongerVOCDataSet(VOCDataSet):
 
                 img2, boxes2, classes2 = self.__get_mosaic(index=np.random.randint(0, len(self.ids)))
                 r = np.random.beta(8.0, 8.0)  # mixup ratio, alpha=beta=8.0
-                img = (img * r + img2 * (1 - r)).astype(np.uint8)
+                img = CV2.addWeighted(img, r, img2, 1 - r)  # uint8
                 boxes = np.concatenate((boxes, boxes2), 0)
                 classes = np.concatenate((classes, classes2), 0)
 
@@ -157,12 +134,7 @@ class StrongerVOCDataSet(VOCDataSet):
             boxes,
             classes
         )
-        new_label = []
-        for i in range(new_classes.shape[0]):
-            new_label.append(
-                (new_classes[i], *new_boxes[i].tolist())
-            )
-        return new_img_tensor, new_label
+        return new_img_tensor, self.make_label(new_boxes, new_classes)
 
 
 def get_stronger_voc_data_loader(
@@ -175,15 +147,52 @@ def get_stronger_voc_data_loader(
         mean: List[float] = [0.5, 0.5, 0.5],
         std: List[float] = [0.5, 0.5, 0.5],
         use_mosaic: bool = True,
-        use_mixup: bool = True
+        use_mixup: bool = True,
+        target_builder: Callable = None,
+        use_image_shard: bool = False,
+        image_cache: SharedImageCache = None,
+        fused_augmentation: bool = False,
+        batch_augmentation: bool = False,
+        kinds_name: list = None,
+        distributed: bool = False,
 ):
+    '''
+
+    Args:
+        root_path:
+        years:
+        image_size:
+        batch_size:
+        train:
+        num_workers:
+        mean:
+        std:
+        use_mosaic:
+        use_mixup:
+        target_builder: (only for train) build targets in DataLoader workers, e.g. trainer.target_builder()
+        use_image_shard: read images from packed shards, see VOCDataSet
+        image_cache: decoded images shared by DataLoader workers, see VOCDataSet
+        fused_augmentation: (only for train) use FusedSSDAugmentation, see SSDAugmentation
+        batch_augmentation: (only for train) workers just resize (uint8 images, see ResizeUInt8),
+                            set trainer.batch_augmentation = BatchAugmentation(...) to augment batches on device
+        kinds_name: labels of batches are PaddedLabels (tensors, no kind names), see VOCDataSet
+        distributed: (only for train) DistributedSampler, every process reads its own part of the data set,
+                     batch_size is the batch size of one process (see Tool/BaseTools/distributed.py)
+
+    Returns:
+
+    '''
 
     if train:
-        transform_train = SSDAugmentation(
-            size=image_size[0],
-            mean=mean,
-            std=std,
-        )
+        if batch_augmentation:
+            transform_train = ResizeUInt8(size=image_size[0])
+        else:
+            transform_train = SSDAugmentation(
+                size=image_size[0],
+                mean=mean,
+                std=std,
+                fused=fused_augmentation
+            )
         train_d = StrongerVOCDataSet(
             root=root_path,
             years=years,
@@ -191,13 +200,22 @@ def get_stronger_voc_data_loader(
             image_size=image_size,
             transform=transform_train,
             use_mosaic=use_mosaic,
-            use_mixup=use_mixup
+            use_mixup=use_mixup,
+            use_image_shard=use_image_shard,
+            image_cache=image_cache,
+            kinds_name=kinds_name
         )
 
+        collate_fn = StrongerVOCDataSet.collate_fn
+        if target_builder is not None:
+            collate_fn = TargetCollateFn(collate_fn, target_builder)
+
+        sampler = DistributedSampler(train_d, shuffle=True) if distributed else None
         train_l = DataLoader(train_d,
                              batch_size=batch_size,
-                             collate_fn=StrongerVOCDataSet.collate_fn,
-                             shuffle=True,
+                             collate_fn=collate_fn,
+                             shuffle=sampler is None,
+                             sampler=sampler,
                              num_workers=num_workers)
         return train_l
     else:
@@ -214,7 +232,10 @@ def get_stronger_voc_data_loader(
             image_size=image_size,
             transform=transform_test,
             use_mosaic=use_mosaic,
-            use_mixup=use_mixup
+            use_mixup=use_mixup,
+            use_image_shard=use_image_shard,
+            image_cache=image_cache,
+            kinds_name=kinds_name
         )
 
         test_l = DataLoader(test_d,
@@ -223,3 +244,132 @@ def get_stronger_voc_data_loader(
                             shuffle=False,
                             num_workers=num_workers)
         return test_l
+
+
+def debug_mosaic_speed(
+        root_path: str,
+        years: list = ['2007'],
+        image_size: tuple = (416, 416),
+        samples_number: int = 100,
+):
+    '''
+    samples/sec of mosaic+mixup, the old mosaic(float64 2x canvas, every tile resized twice)
+    vs __get_mosaic(uint8, resize once)
+    Args:
+        root_path: .../VOC/
+        years:
+        image_size:
+        samples_number:
+    '''
+    data_set = StrongerVOCDataSet(
+        root_path,
+        years,
+        train=True,
+        image_size=image_size,
+        use_mosaic=True,
+        use_mixup=True
+    )
+
+    def resize_image(
+            image: np.ndarray,
+            boxes: np.ndarray,
+            new_size: tuple
+    ):
+        old_h, old_w, _ = image.shape
+        new_image = CV2.resize(image, new_size)
+        new_h, new_w, _ = new_image.shape
+        new_boxes = boxes.copy()
+        new_boxes[:, [0, 2]] = boxes[:, [0, 2]] / old_w * new_w
+        new_boxes[:, [1, 3]] = boxes[:, [1, 3]] / old_h * new_h
+        return new_image, new_boxes
+
+    def put_image_on_small_back_ground(
+            image: np.ndarray,
+            boxes: np.ndarray
+    ):
+        image, boxes = resize_image(image, boxes, image_size)
+        back_ground = np.zeros(shape=image.shape)
+
+        back_ground_h, back_ground_w, _ = image.shape
+        scaled_rate = 0.01 * np.random.randint(50, 100)
+
+        new_w = int(scaled_rate * back_ground_w)
+        new_h = int(scaled_rate * back_ground_h)
+
+        image, boxes = resize_image(image, boxes, (new_w, new_h))
+
+        offset_x = np.random.randint(0, back_ground_w - new_w)
+        offset_y = np.random.randint(0, back_ground_h - new_h)
+
+        back_ground[offset_y:offset_y+new_h, offset_x:offset_x+new_w] = image
+        back_ground_boxes = boxes.copy()
+        back_ground_boxes[:, [0, 2]] = boxes[:, [0, 2]] + offset_x
+        back_ground_boxes[:, [1, 3]] = boxes[:, [1, 3]] + offset_y
+        return back_ground, back_ground_boxes
+
+    def py_get_mosaic(
+            index
+    ):
+        # the old mosaic, kept as the reference of __get_mosaic
+        ids_list_ = data_set.ids[:index] + data_set.ids[index + 1:]
+        ids = [data_set.ids[index]] + random.sample(ids_list_, 3)
+        offset_vec = [
+            [0, 0],
+            [image_size[0], 0],
+            [0, image_size[1]],
+            [image_size[0], image_size[1]],
+        ]
+        four_back_ground = np.zeros(shape=(image_size[1] * 2, image_size[0] * 2, 3))
+        boxes_vec = []
+        class_vec = []
+        for i in range(len(ids)):
+            offset_x, offset_y = offset_vec[i]
+            img, boxes, classes = data_set.get_image_label(ids[i])
+            img, boxes = put_image_on_small_back_ground(img, boxes)
+            h, w, _ = img.shape
+            # put on four background
+            four_back_ground[offset_y: offset_y + h, offset_x: offset_x+w] = img
+            boxes[:, [0, 2]] += offset_x
+            boxes[:, [1, 3]] += offset_y
+
+            boxes_vec.append(
+                boxes
+            )
+            class_vec.append(
+                classes
+            )
+
+        img, boxes = resize_image(
+            four_back_ground,
+            np.concatenate(boxes_vec, axis=0),
+            image_size
+        )
+        return img, boxes, np.concatenate(class_vec, axis=0)
+
+    indexes = np.random.randint(0, len(data_set), size=(samples_number, ))
+
+    t0 = time.time()
+    for index in indexes:
+        img, boxes, classes = py_get_mosaic(index)
+        img2, boxes2, classes2 = py_get_mosaic(np.random.randint(0, len(data_set)))
+        r = np.random.beta(8.0, 8.0)
+        (img * r + img2 * (1 - r)).astype(np.uint8)
+    old_time = time.time() - t0
+
+    t0 = time.time()
+    for index in indexes:
+        img, boxes, classes = data_set._StrongerVOCDataSet__get_mosaic(index)
+        img2, boxes2, classes2 = data_set._StrongerVOCDataSet__get_mosaic(np.random.randint(0, len(data_set)))
+        r = np.random.beta(8.0, 8.0)
+        CV2.addWeighted(img, r, img2, 1 - r)
+    new_time = time.time() - t0
+
+    print('image size: {}, samples: {}'.format(image_size, samples_number))
+    print('old mosaic + mixup   : {:.1f} samples/sec'.format(samples_number / old_time))
+    print('__get_mosaic + mixup : {:.1f} samples/sec'.format(samples_number / new_time))
+
+
+if __name__ == '__main__':
+    import sys
+    # python Tool/V4/DatasetDefine.py .../VOC/
+    debug_mosaic_speed(sys.argv[1])
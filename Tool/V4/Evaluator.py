@@ -32,6 +32,7 @@ class YOLOV4Evaluator(BaseEvaluator):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV4Tools.clear_grid_and_anchor_cache()
 
     def make_targets(
             self,
@@ -48,6 +48,7 @@ class YOLOV4Loss(BaseLoss):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV4Tools.clear_grid_and_anchor_cache()
 
     def forward(
             self,
@@ -62,13 +63,15 @@ class YOLOV4Loss(BaseLoss):
             target,
             self.each_size_anchor_number
         )
+        # accumulators are tensors on device (the trainer sums them up without syncing)
+        device = out_put[self.anchor_keys[0]].device
         loss_dict = {
-            'total_loss': 0.0,
-            'position_loss': 0.0,
-            'has_obj_loss': 0.0,
-            'no_obj_loss': 0.0,
-            'cls_prob_loss': 0.0,
-            'iou_loss': 0.0
+            'total_loss': torch.zeros(size=(), device=device),
+            'position_loss': torch.zeros(size=(), device=device),
+            'has_obj_loss': torch.zeros(size=(), device=device),
+            'no_obj_loss': torch.zeros(size=(), device=device),
+            'cls_prob_loss': torch.zeros(size=(), device=device),
+            'iou_loss': torch.zeros(size=(), device=device)
         }
 
         for anchor_key in self.anchor_keys:
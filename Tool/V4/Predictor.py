@@ -40,6 +40,7 @@ class YOLOV4Predictor(BasePredictor):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV4Tools.clear_grid_and_anchor_cache()
 
     def decode_one_target(
             self,
@@ -54,16 +55,32 @@ class YOLOV4Predictor(BasePredictor):
         Returns:
 
         '''
+        return self.decode_target(x)[0]
 
+    def decode_target(
+            self,
+            target: dict,
+    ) -> List[List]:
+        '''
+
+        Args:
+            target: key --> ["for_s", "for_m", "for_l"]
+                    val --> (N, -1, H, W)
+
+        Returns:
+
+        '''
+        batch_size = target[self.anchor_keys[0]].shape[0]
         a_n = self.each_size_anchor_number
         res_target = YOLOV4Tools.split_target(
-            x,
+            target,
             a_n
         )
 
         masked_pos_vec = []
         masked_score_max_value_vec = []
         masked_score_max_index_vec = []
+        masked_image_index_vec = []
 
         for anchor_key in self.anchor_keys:
             res_dict = res_target[anchor_key]
@@ -73,52 +90,28 @@ class YOLOV4Predictor(BasePredictor):
             position_abs = res_dict.get('position')[1]  # scaled in [0, 1]
             position_abs = position_abs * self.image_size[0]   # scaled on image
             # -------------------------------------------------------------------
-            position_abs_ = position_abs.contiguous().view(-1, 4)
-            conf_ = conf.contiguous().view(-1, )  # type: torch.Tensor
-            cls_prob_ = cls_prob.contiguous().view(-1, len(self.kinds_name))
-            scores_ = cls_prob_ * conf_.unsqueeze(-1).expand_as(cls_prob_)
-            # (-1, kinds_num)
-            # -------------------------------------------------------------------
-            cls_prob_mask = cls_prob_.max(dim=-1)[0] > self.prob_th  # type: torch.Tensor
-            # (-1, )
-
-            conf_mask = conf_ > self.conf_th  # type: torch.Tensor
-            # (-1, )
-
-            scores_max_value, scores_max_index = scores_.max(dim=-1)
-            # (-1, )
-
-            scores_mask = scores_max_value > self.score_th  # type: torch.Tensor
-            # (-1, )
-
-            mask = (conf_mask.float() * cls_prob_mask.float() * scores_mask.float()).bool()
-            # (-1, )
+            position_abs_ = position_abs.contiguous().view(batch_size, -1, 4)
+            conf_ = conf.contiguous().view(batch_size, -1)  # type: torch.Tensor
+            cls_prob_ = cls_prob.contiguous().view(batch_size, -1, len(self.kinds_name))
             # -------------------------------------------------------------------
-            masked_pos_vec.append(position_abs_[mask])
-            masked_score_max_value_vec.append(scores_max_value[mask]),
-            masked_score_max_index_vec.append(scores_max_index[mask])
-
-        return self.nms(
+            masked_pos, masked_score_max_value, masked_score_max_index, masked_image_index = self.mask_batch(
+                position_abs_,
+                conf_,
+                cls_prob_
+            )
+            masked_pos_vec.append(masked_pos)
+            masked_score_max_value_vec.append(masked_score_max_value)
+            masked_score_max_index_vec.append(masked_score_max_index)
+            masked_image_index_vec.append(masked_image_index)
+
+        return self.nms_batch(
             torch.cat(masked_pos_vec, dim=0),
             torch.cat(masked_score_max_value_vec, dim=0),
-            torch.cat(masked_score_max_index_vec, dim=0)
+            torch.cat(masked_score_max_index_vec, dim=0),
+            torch.cat(masked_image_index_vec, dim=0),
+            batch_size
         )
 
-    def decode_target(
-            self,
-            target: dict,
-    ) -> List[List]:
-        batch_size = target[self.anchor_keys[0]].shape[0]
-        res = [[] for _ in range(batch_size)]
-        for i in range(batch_size):
-            tmp = {}
-            for anchor_key in self.anchor_keys:
-                tmp[anchor_key] = target[anchor_key][i].unsqueeze(0)
-            pre_ = self.decode_one_target(tmp)
-            res[i] += pre_
-
-        return res
-
     def decode_one_predict(
             self,
             x: dict
@@ -132,15 +125,32 @@ class YOLOV4Predictor(BasePredictor):
                 Returns:
 
                 '''
+        return self.decode_predict(x)[0]
 
+    def decode_predict(
+            self,
+            predict: dict,
+    ) -> List[List]:
+        '''
+        activations, grid decode and masks are applied on the whole batch,
+        objects are split per image only after masking(in nms_batch).
+        Args:
+            predict: key --> ["for_s", "for_m", "for_l"]
+                     val --> (N, -1, H, W)
+
+        Returns:
+
+        '''
+        batch_size = predict[self.anchor_keys[0]].shape[0]
         a_n = self.each_size_anchor_number
         res_out = YOLOV4Tools.split_predict(
-            x,
+            predict,
             a_n
         )
         masked_pos_vec = []
         masked_score_max_value_vec = []
         masked_score_max_index_vec = []
+        masked_image_index_vec = []
 
         for anchor_key in self.anchor_keys:
             res_dict = res_out[anchor_key]
@@ -156,50 +166,24 @@ class YOLOV4Predictor(BasePredictor):
             position_abs = position_abs * self.image_size[0]  # scaled on image
 
             # -------------------------------------------------------------------
-            position_abs_ = position_abs.contiguous().view(-1, 4)
-            conf_ = conf.contiguous().view(-1, )  # type: torch.Tensor
-            cls_prob_ = cls_prob.contiguous().view(-1, len(self.kinds_name))
-            scores_ = cls_prob_ * conf_.unsqueeze(-1).expand_as(cls_prob_)
-            # (-1, kinds_num)
-
+            position_abs_ = position_abs.contiguous().view(batch_size, -1, 4)
+            conf_ = conf.contiguous().view(batch_size, -1)  # type: torch.Tensor
+            cls_prob_ = cls_prob.contiguous().view(batch_size, -1, len(self.kinds_name))
             # -------------------------------------------------------------------
-
-            cls_prob_mask = cls_prob_.max(dim=-1)[0] > self.prob_th  # type: torch.Tensor
-            # (-1, )
-
-            conf_mask = conf_ > self.conf_th  # type: torch.Tensor
-            # (-1, )
-
-            scores_max_value, scores_max_index = scores_.max(dim=-1)
-            # (-1, )
-
-            scores_mask = scores_max_value > self.score_th  # type: torch.Tensor
-            # (-1, )
-
-            mask = (conf_mask.float() * cls_prob_mask.float() * scores_mask.float()).bool()
-            # (-1, )
-
-            # -------------------------------------------------------------------
-            masked_pos_vec.append(position_abs_[mask])
-            masked_score_max_value_vec.append(scores_max_value[mask]),
-            masked_score_max_index_vec.append(scores_max_index[mask])
-
-        return self.nms(
+            masked_pos, masked_score_max_value, masked_score_max_index, masked_image_index = self.mask_batch(
+                position_abs_,
+                conf_,
+                cls_prob_
+            )
+            masked_pos_vec.append(masked_pos)
+            masked_score_max_value_vec.append(masked_score_max_value)
+            masked_score_max_index_vec.append(masked_score_max_index)
+            masked_image_index_vec.append(masked_image_index)
+
+        return self.nms_batch(
             torch.cat(masked_pos_vec, dim=0),
             torch.cat(masked_score_max_value_vec, dim=0),
-            torch.cat(masked_score_max_index_vec, dim=0)
+            torch.cat(masked_score_max_index_vec, dim=0),
+            torch.cat(masked_image_index_vec, dim=0),
+            batch_size
         )
-
-    def decode_predict(
-            self,
-            predict: dict,
-    ) -> List[List]:
-        batch_size = predict[self.anchor_keys[0]].shape[0]
-        res = [[] for _ in range(batch_size)]
-        for i in range(batch_size):
-            tmp = {}
-            for anchor_key in self.anchor_keys:
-                tmp[anchor_key] = predict[anchor_key][i].unsqueeze(0)
-            pre_ = self.decode_one_predict(tmp)
-            res[i] += pre_
-        return res
@@ -1,3 +1,4 @@
+from functools import partial
 from .Tools import YOLOV4Tools
 from .Model import YOLOV4Model
 from Tool.BaseTools import BaseTrainer
@@ -37,23 +38,25 @@ class YOLOV4Trainer(BaseTrainer):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV4Tools.clear_grid_and_anchor_cache()
+
+    def target_builder(
+            self
+    ):
+        return partial(
+            YOLOV4Tools.make_target,
+            anchor_pre_wh=self.pre_anchor_w_h,
+            image_wh=self.image_size,
+            grid_number=self.grid_number,
+            kinds_name=self.kinds_name,
+            iou_th=self.iou_th_for_make_target,
+            multi_gt=self.multi_gt
+        )
 
     def make_targets(
             self,
             labels,
     ):
-        targets = YOLOV4Tools.make_target(
-            labels,
-            self.pre_anchor_w_h,
-            self.image_size,
-            self.grid_number,
-            self.kinds_name,
-            self.iou_th_for_make_target,
-            multi_gt=self.multi_gt
+        return self.targets_to_device(
+            self.target_builder()(labels)
         )
-        for anchor_key in self.anchor_keys:
-            targets[anchor_key] = targets[anchor_key].to(self.device)
-        return targets
-
-
-
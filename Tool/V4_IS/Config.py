@@ -49,10 +49,14 @@ class YOLOV4TrainConfigIS:
     num_workers: int = 4
     device: str = 'cuda:0'
     batch_size = 4
+    # train loader uses batch_size // accumulate_steps (micro-batch), grads of them are accumulated
+    accumulate_steps: int = 1
     lr: float = 1e-4
     warm_up_end_epoch: int = 5
     use_mosaic: bool = True
     use_mixup: bool = True
+    # train loader just resizes (uint8), augmentations are done on device by BatchAugmentation
+    batch_augmentation: bool = False
 
     weight_position: float = 1.0
     weight_conf_has_obj: float = 5.0
@@ -2,10 +2,12 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader
 import albumentations as alb
-from typing import List
+from typing import List, Callable
 import os
+import uuid
+import hashlib
 import xml.etree.ElementTree as ET
-from Tool.BaseTools import CV2
+from Tool.BaseTools import CV2, TargetCollateFn, VOCAnnotationIndex, ImageShard, get_voc_image_shard_path, PaddedLabels
 
 KIND_NAME_TO_COLOR = {
         'background': (0, 0, 0),
@@ -32,6 +34,14 @@ KIND_NAME_TO_COLOR = {
         # 'bordering region': (192, 224, 224),
     }
 
+# colors packed as c0 << 16 | c1 << 8 | c2 (same channel order as KIND_NAME_TO_COLOR)
+PACKED_COLOR_TO_KIND_INDEX = {
+    (color[0] << 16) | (color[1] << 8) | color[2]: i for i, color in enumerate(KIND_NAME_TO_COLOR.values())
+}
+BORDER_PACKED_COLOR = (192 << 16) | (224 << 8) | 224
+# value of index map for pixels without kind/instance (e.g. bordering region)
+MASK_IGNORE_INDEX = 255
+
 
 class VocDataSetForAllTasks(Dataset):
     def __init__(
@@ -45,7 +55,27 @@ class VocDataSetForAllTasks(Dataset):
             transform: alb.Compose = None,
             use_bbox: bool = True,
             use_mask_type: int = 0,
+            use_image_shard: bool = False,
+            kinds_name: list = None,
+            precompute_masks: bool = False,
+            mask_as_index_map: bool = False,
+            uint8_images: bool = False,
     ):
+        '''
+        use_image_shard: read images/masks from packed shards(see build_voc_image_shard),
+                         images in JPEGImages_shard/, masks in SegmentationObject_shard/ or SegmentationClass_shard/
+        precompute_masks: decode every palette mask to an index map once (saved as png in
+                          SegmentationObject_index/ or SegmentationClass_index/), then masks are read from there
+                          instead of being decoded every epoch. An index map is rebuilt when its mask is modified,
+                          all are rebuilt when KIND_NAME_TO_COLOR is changed
+        kinds_name: if given, objects of an image are a (k, 5) array (kind_id, x0, y0, x1, y1),
+                    collate_fn makes PaddedLabels of them. None --> [[x0, y0, x1, y1, kind_name], ...]
+        mask_as_index_map: (semantic masks only) masks of an image are one (H, W) uint8 index map (see decode_mask)
+                           instead of kinds_num + 1 float masks, collate_fn stacks them to (N, H, W) tensor,
+                           one-hot is built in loss (on device)
+        uint8_images: images are (3, H, W) uint8 tensors (BGR, not normalized), use a transform without Normalize,
+                      they are augmented/normalized on device by BatchAugmentation (see get_voc_for_all_tasks_loader)
+        '''
         super().__init__()
         self.root = root
         self.years = years
@@ -68,10 +98,38 @@ class VocDataSetForAllTasks(Dataset):
 
         assert use_mask_type in [-1, 0, 1]
         self.use_mask_type = use_mask_type
+        assert not mask_as_index_map or use_mask_type == -1, 'index map is just for semantic masks'
+        self.mask_as_index_map = mask_as_index_map
+        self.uint8_images = uint8_images
         # -1 mask for semantic, 0 do not use mask, 1 mask for instance
         self.use_bbox = use_bbox
+        self.kinds_name = kinds_name
 
         self.images_objects_masks_path = self.__get_all_path()
+        # pre-parsed xml of every year, key --> .../Annotations
+        self.annotation_index = {}
+        if self.use_bbox:
+            for year in self.years:
+                root_path = os.path.join(self.root, year, self.data_type)
+                self.annotation_index[os.path.join(root_path, 'Annotations')] = VOCAnnotationIndex(root_path)
+        # key --> .../JPEGImages (or .../SegmentationXXX)
+        self.use_image_shard = use_image_shard
+        self.image_shard = {}
+        if self.use_image_shard:
+            for year in self.years:
+                root_path = os.path.join(self.root, year, self.data_type)
+                folders = ['JPEGImages']
+                if self.use_mask_type != 0:
+                    folders.append('SegmentationObject' if self.use_mask_type == 1 else 'SegmentationClass')
+                for folder in folders:
+                    self.image_shard[os.path.join(root_path, folder)] = ImageShard(
+                        get_voc_image_shard_path(root_path, folder),
+                        source_path=os.path.join(root_path, folder)
+                    )
+
+        self.precompute_masks = precompute_masks and self.use_mask_type != 0
+        if self.precompute_masks:
+            self.precompute_index_maps()
 
     def __get_all_path(
             self
@@ -124,15 +182,187 @@ class VocDataSetForAllTasks(Dataset):
             position_kind_name_vec.append([a, b, m, n, kind])
         return position_kind_name_vec
 
+    def read_objects(
+            self,
+            xml_file_name: str
+    ) -> List[List]:
+        '''
+        same as read_xml_objects, but read from pre-parsed annotation index
+        (kind ids instead of kind names if self.kinds_name is given)
+        '''
+        annotation_index = self.annotation_index[os.path.dirname(xml_file_name)]
+        i = annotation_index.index_of(os.path.basename(xml_file_name))
+        if self.kinds_name is None:
+            kinds = annotation_index.kinds_name_of(i)
+        else:
+            kinds = annotation_index.kind_ids_of(i, self.kinds_name).tolist()
+        return [
+            [*box, kind] for box, kind in zip(
+                annotation_index.boxes_of(i).tolist(),
+                kinds
+            )
+        ]
+
+    def read_image(
+            self,
+            image_path: str
+    ) -> np.ndarray:
+        '''
+        same as CV2.imread, but read from image shard if use_image_shard
+        '''
+        if self.use_image_shard:
+            return self.image_shard[os.path.dirname(image_path)].read(os.path.basename(image_path))
+        return CV2.imread(image_path)
+
+    def decode_mask(
+            self,
+            mask: np.ndarray
+    ) -> np.ndarray:
+        '''
+        palette mask --> index map, one lookup for all pixels (no per-kind/per-color pass)
+        Args:
+            mask: (H, W, 3) uint8, as read by read_image
+
+        Returns:
+            (H, W) uint8
+                semantic: index of kind in KIND_NAME_TO_COLOR
+                instance: index of instance (instances are sorted by color)
+                MASK_IGNORE_INDEX: no kind/instance
+        '''
+        packed = (mask[..., 0].astype(np.int32) << 16) | (mask[..., 1].astype(np.int32) << 8) | mask[..., 2]
+        colors, inverse = np.unique(packed.reshape(-1), return_inverse=True)
+        if self.use_mask_type == 1:  # for instance
+            # color (192, 224, 224)  --> bound line (ignore)
+            # color (0, 0, 0)  --> back_ground (ignore)
+            is_instance = (colors != 0) & (colors != BORDER_PACKED_COLOR)
+            if is_instance.sum() > MASK_IGNORE_INDEX:
+                # indexes 0 ... MASK_IGNORE_INDEX - 1, more instances would wrap around in uint8
+                raise ValueError('{} instances in one mask, an index map holds at most {}.'.format(
+                    is_instance.sum(), MASK_IGNORE_INDEX
+                ))
+            lut = np.full(colors.shape, MASK_IGNORE_INDEX, dtype=np.uint8)
+            lut[is_instance] = np.arange(is_instance.sum())
+        else:   # for semantic
+            lut = np.array(
+                [PACKED_COLOR_TO_KIND_INDEX.get(color, MASK_IGNORE_INDEX) for color in colors.tolist()],
+                dtype=np.uint8
+            )
+        return lut[inverse].reshape(mask.shape[:2])
+
+    def get_index_map_path(
+            self,
+            mask_path: str
+    ) -> str:
+        # .../SegmentationClass/xxx.png --> .../SegmentationClass_index/xxx.png
+        return os.path.join(
+            os.path.dirname(mask_path) + '_index',
+            os.path.splitext(os.path.basename(mask_path))[0] + '.png'
+        )
+
+    def get_index_map_stamp(
+            self
+    ) -> np.ndarray:
+        # palette and mask type, index maps decoded with another palette are not used
+        entries = (self.use_mask_type, list(KIND_NAME_TO_COLOR.items()), BORDER_PACKED_COLOR, MASK_IGNORE_INDEX)
+        digest = hashlib.sha1(repr(entries).encode('utf-8')).digest()
+        return np.frombuffer(digest, dtype=np.uint8)
+
+    def get_mask_mtime_ns(
+            self,
+            mask_path: str
+    ) -> int:
+        # modify time of the source of a mask (the png, or the shard it is packed in)
+        if self.use_image_shard:
+            shard_path = self.image_shard[os.path.dirname(mask_path)].shard_path
+            return os.stat(os.path.join(shard_path, 'data.bin')).st_mtime_ns
+        return os.stat(mask_path).st_mtime_ns
+
+    @staticmethod
+    def get_tmp_path(
+            path: str
+    ) -> str:
+        # unique in every process (DDP ranks/datasets precompute at the same time), rename it to path
+        stem, ext = os.path.splitext(path)
+        return '{}.{}.{}.tmp{}'.format(stem, os.getpid(), uuid.uuid4().hex, ext)
+
+    def precompute_index_maps(self):
+        stamp = self.get_index_map_stamp()
+        index_dirs = sorted(set(
+            os.path.dirname(self.get_index_map_path(mask_path)) for _, _, mask_path in self.images_objects_masks_path
+        ))
+        stale_dirs = []
+        for index_dir in index_dirs:
+            stamp_file = os.path.join(index_dir, 'stamp.npy')
+            if os.path.isfile(stamp_file) and np.array_equal(np.load(stamp_file), stamp):
+                continue
+            stale_dirs.append(index_dir)
+            os.makedirs(index_dir, exist_ok=True)
+            # stamp is saved at last (below), so index maps of another palette are never used
+            if os.path.isfile(stamp_file):
+                try:
+                    os.remove(stamp_file)
+                except FileNotFoundError:
+                    pass
+
+        for _, _, mask_path in self.images_objects_masks_path:
+            index_map_path = self.get_index_map_path(mask_path)
+            mtime_ns = self.get_mask_mtime_ns(mask_path)
+            if os.path.dirname(index_map_path) not in stale_dirs and os.path.isfile(index_map_path) \
+                    and os.stat(index_map_path).st_mtime_ns == mtime_ns:
+                continue
+            # write a new file then rename, a half-written index map is never used
+            tmp_path = self.get_tmp_path(index_map_path)
+            CV2.imwrite(tmp_path, self.decode_mask(self.read_image(mask_path)))
+            # same modify time as its mask --> the mask is modified if they are different
+            os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+            os.replace(tmp_path, index_map_path)
+
+        for index_dir in stale_dirs:
+            stamp_file = os.path.join(index_dir, 'stamp.npy')
+            tmp_path = self.get_tmp_path(stamp_file)
+            np.save(tmp_path, stamp)
+            os.replace(tmp_path, stamp_file)
+
+    def read_index_map(
+            self,
+            mask_path: str
+    ) -> np.ndarray:
+        '''
+        Returns:
+            (H, W) uint8, see decode_mask
+        '''
+        if self.precompute_masks:
+            return CV2.imread(self.get_index_map_path(mask_path), CV2.IMREAD_GRAYSCALE)
+        return self.decode_mask(self.read_image(mask_path))
+
     def split_mask(
             self,
             mask_path: str
     ) -> List[np.ndarray]:
-        mask = CV2.imread(mask_path).astype(np.int32)
+        '''
+        eager one-hot, (H, W) float32 0.0/1.0 mask of every kind (semantic) or every instance (instance),
+        all of them are built in the worker (as the masks of alb transform and of the loss).
+        For semantic masks, use mask_as_index_map to keep the (H, W) uint8 index map (one-hot is built on device).
+        '''
+        index_map = self.read_index_map(mask_path)
+        if self.use_mask_type == 1:  # for instance
+            is_instance = index_map != MASK_IGNORE_INDEX
+            number = int(index_map[is_instance].max()) + 1 if is_instance.any() else 0
+        else:   # for semantic
+            number = len(KIND_NAME_TO_COLOR)
+        one_hot = index_map[None] == np.arange(number, dtype=np.uint8)[:, None, None]  # (number, H, W)
+        return list(one_hot.astype(np.float32))
+
+    def py_split_mask(
+            self,
+            mask_path: str
+    ) -> List[np.ndarray]:
+        # the old version of split_mask (one pass for every kind/color), kept as the reference of it
+        mask = self.read_image(mask_path).astype(np.int32)
         if self.use_mask_type == 1:  # for instance
             res = []
             mask_sum = mask[..., 0] * 1000000 + mask[..., 1] * 1000 + mask[..., 2] * 1
-            a = np.reshape(mask_sum, newshape=(-1,)).tolist()
+            a = np.reshape(mask_sum, (-1,)).tolist()
             b = list(set(tuple(a)))
             for val in b:
                 if val == 192224224 or val == 0:
@@ -168,16 +398,26 @@ class VocDataSetForAllTasks(Dataset):
         res = []
         image_path, obj_path, mask_path = self.images_objects_masks_path[index]
 
-        image = CV2.imread(image_path)
+        image = self.read_image(image_path)
         res.append(image)
 
         if self.use_bbox:
-            objects_vec = self.read_xml_objects(obj_path)
+            objects_vec = self.read_objects(obj_path)
+            if self.use_image_shard:
+                # shard may be pre-resized
+                scale_w, scale_h = self.image_shard[os.path.dirname(image_path)].scale_of(
+                    os.path.basename(image_path)
+                )
+                objects_vec = [
+                    [a * scale_w, b * scale_h, m * scale_w, n * scale_h, kind] for a, b, m, n, kind in objects_vec
+                ]
             res.append(objects_vec)
         else:
             res.append([])
 
-        if self.use_mask_type != 0:
+        if self.mask_as_index_map:
+            res.append(self.read_index_map(mask_path))
+        elif self.use_mask_type != 0:
             masks_vec = self.split_mask(mask_path)
             res.append(masks_vec)
         else:
@@ -193,12 +433,21 @@ class VocDataSetForAllTasks(Dataset):
             index
     ):
         image, objects_vec, masks_vec = self.pull_an_image(index)
-        res = self.transform(image=image, bboxes=objects_vec, masks=masks_vec)
+        if self.mask_as_index_map:
+            res = self.transform(image=image, bboxes=objects_vec, mask=masks_vec)
+            new_mask_vec = res.get('mask')  # (H, W) uint8
+        else:
+            res = self.transform(image=image, bboxes=objects_vec, masks=masks_vec)
+            new_mask_vec = res.get('masks')
         new_image = res.get('image')
         new_obj_vec = res.get('bboxes')
-        new_mask_vec = res.get('masks')
         # if len(new_obj_vec) != len(new_mask_vec):
         #     print('wow')
+        if self.kinds_name is not None:
+            # (k, 5) kind_id, x0, y0, x1, y1
+            new_obj_vec = np.array([[obj[4], *obj[:4]] for obj in new_obj_vec], dtype=np.float32).reshape(-1, 5)
+        if self.uint8_images:
+            return torch.from_numpy(np.ascontiguousarray(new_image)).permute(2, 0, 1), new_obj_vec, new_mask_vec
         return torch.tensor(new_image, dtype=torch.float32).permute(2, 0, 1), new_obj_vec, new_mask_vec
 
     @staticmethod
@@ -208,6 +457,12 @@ class VocDataSetForAllTasks(Dataset):
         objects = batch[1]
         masks = batch[2]
         del batch
+        if len(objects) != 0 and isinstance(objects[0], np.ndarray):
+            # (k, 5) arrays --> (N, max_boxes, 5) tensor
+            objects = PaddedLabels.from_arrays(objects)
+        if len(masks) != 0 and isinstance(masks[0], np.ndarray) and masks[0].dtype == np.uint8:
+            # (H, W) index maps --> (N, H, W) uint8 tensor
+            masks = torch.from_numpy(np.stack(masks))
         return torch.stack(imgs), objects, masks
 
 
@@ -222,8 +477,28 @@ def get_voc_for_all_tasks_loader(
         batch_size: int = 8,
         num_workers: int = 4,
         use_bbox: bool = True,
-        use_mask_type: int = -1
+        use_mask_type: int = -1,
+        target_builder: Callable = None,
+        use_image_shard: bool = False,
+        kinds_name: list = None,
+        precompute_masks: bool = False,
+        mask_as_index_map: bool = False,
+        batch_augmentation: bool = False,
 ):
+    '''
+    target_builder: (only for train) build targets in DataLoader workers, e.g. trainer.target_builder()
+    use_image_shard: read images/masks from packed shards, see VocDataSetForAllTasks
+    kinds_name: objects of batches are PaddedLabels (tensors, no kind names), see VocDataSetForAllTasks
+    precompute_masks: decode masks to index maps once, see VocDataSetForAllTasks
+    mask_as_index_map: masks of batches are (N, H, W) uint8 index maps, see VocDataSetForAllTasks
+    batch_augmentation: (only for train) workers just resize (uint8 images/masks, trans_form is not used),
+                        set trainer.batch_augmentation = BatchAugmentation(...) to augment batches on device
+    '''
+    uint8_images = train and batch_augmentation
+    if uint8_images:
+        trans_form = alb.Compose([
+            alb.Resize(image_size, image_size)
+        ], bbox_params=alb.BboxParams(format='pascal_voc'))
     data_set = VocDataSetForAllTasks(
         root,
         years,
@@ -233,14 +508,23 @@ def get_voc_for_all_tasks_loader(
         std,
         trans_form,
         use_bbox=use_bbox,
-        use_mask_type=use_mask_type
+        use_mask_type=use_mask_type,
+        use_image_shard=use_image_shard,
+        kinds_name=kinds_name,
+        precompute_masks=precompute_masks,
+        mask_as_index_map=mask_as_index_map,
+        uint8_images=uint8_images
     )
 
+    collate_fn = data_set.collate_fn
+    if target_builder is not None:
+        collate_fn = TargetCollateFn(collate_fn, target_builder)
+
     data_loader = DataLoader(
         data_set,
         shuffle=True if train else False,
         batch_size=batch_size,
-        collate_fn=data_set.collate_fn,
+        collate_fn=collate_fn,
         num_workers=num_workers
     )
     return data_loader
@@ -315,6 +599,21 @@ def debug_transform():
     debug_for_show(new_image.copy(), new_obj_vec, new_mask_vec, pre_fix='new --> ')
 
 
+def debug_split_mask_speed(
+        root: str = '/home/dell/data/DataSet/VOC/',
+        use_mask_type: int = -1,
+        number: int = 50,
+):
+    import time
+    d = VocDataSetForAllTasks(root, ['2007'], False, 416, use_bbox=False, use_mask_type=use_mask_type)
+    mask_paths = [mask_path for _, _, mask_path in d.images_objects_masks_path[:number]]
+    for func in [d.py_split_mask, d.split_mask]:
+        start = time.time()
+        for mask_path in mask_paths:
+            func(mask_path)
+        print('{}: {:.2f} ms per mask'.format(func.__name__, (time.time() - start) * 1000 / len(mask_paths)))
+
+
 def debug_dataset():
     trans = alb.Compose([
         alb.Rotate(),
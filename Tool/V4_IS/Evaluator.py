@@ -3,6 +3,7 @@ from Tool.V4_IS.Predictor import YOLOV4PredictorIS
 from Tool.V4_IS.Tools import YOLOV4ToolsIS
 from Tool.V4_IS.Model import YOLOV4ForISModel
 from Tool.V4.Evaluator import YOLOV4Evaluator
+from Tool.BaseTools import DevicePrefetcher
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
@@ -32,6 +33,7 @@ class YOLOV4EvaluatorIS(YOLOV4Evaluator):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV4ToolsIS.clear_grid_and_anchor_cache()
 
     def make_targets(
             self,
@@ -57,7 +59,7 @@ class YOLOV4EvaluatorIS(YOLOV4Evaluator):
             desc: str = 'eval semantic segmentation accuracy',
     ):
         acc_vec = []
-        for batch_id, (images, objects_vec, masks_vec) in enumerate(tqdm(data_loader_test,
+        for batch_id, (images, objects_vec, masks_vec) in enumerate(tqdm(DevicePrefetcher(data_loader_test, self.device, keys=(0, )),
                                                                          desc=desc,
                                                                          position=0)):
 
@@ -77,7 +79,7 @@ class YOLOV4EvaluatorIS(YOLOV4Evaluator):
                 pre_mask_vec = pre_decode[image_index][1]  # type: np.ndarray
                 gt_mask_vec = gt_decode[image_index][1]  # type: np.ndarray
                 pre_mask_vec = pre_mask_vec.argmax(axis=-1)
-                gt_mask_vec = gt_mask_vec.argmax(axis=-1)
+                gt_mask_vec = YOLOV4ToolsIS.mask_to_kind_index(gt_mask_vec)  # one-hot or index map
 
                 """
                     do not consider background, it will cause very high accuracy !!
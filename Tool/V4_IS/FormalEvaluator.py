@@ -1,8 +1,7 @@
 from Tool.V4_IS.Predictor import YOLOV4PredictorIS
 from Tool.V4.FormalEvaluator import YOLOV4FormalEvaluator
 from Tool.V4_IS.Model import YOLOV4ForISModel
-import torch
-import numpy as np
+from typing import List
 
 
 class YOLOV4FormalEvaluatorIS(YOLOV4FormalEvaluator):
@@ -16,7 +15,11 @@ class YOLOV4FormalEvaluatorIS(YOLOV4FormalEvaluator):
             transform,
             labelmap: list,
             display=False,
-            use_07: bool = True
+            use_07: bool = True,
+            batch_size: int = 1,
+            num_workers: int = 0,
+            export_txt: bool = False,
+            eval_workers: int = 0,
     ):
         super().__init__(
             model,
@@ -27,42 +30,20 @@ class YOLOV4FormalEvaluatorIS(YOLOV4FormalEvaluator):
             transform,
             labelmap,
             display,
-            use_07
+            use_07,
+            batch_size,
+            num_workers,
+            export_txt,
+            eval_workers
         )
 
-    def get_predict_info(
+    def get_kps_vec_s(
             self,
-            net,
-            x: torch.Tensor,
-
-    ) -> dict:
-        assert len(x.shape) == 4 and x.shape[0] == 1
-
-        out = net(x)
-        kps_vec = self.predictor.decode_one_predict(out)[0]
+            out
+    ) -> List[List]:
         """
-                decode_one_predict(out)[0]   --> kps_vec
-                decode_one_predict(out)[1]   --> mask_vec  (ignore)
-                Please see method --> YOLOV4PredictorIS.decode_one_predict
+                decode_predict(out)[i][0]   --> kps_vec
+                decode_predict(out)[i][1]   --> mask_vec  (ignore)
+                Please see method --> YOLOV4PredictorIS.decode_predict
         """
-
-        bboxes = []
-        scores = []
-        cls_inds = []
-
-        for kps in kps_vec:
-            bboxes.append(kps[1])
-            scores.append(kps[2])
-            cls_inds.append(self.labelmap.index(kps[0]))
-        if len(bboxes) != 0:
-            bboxes = np.array(bboxes) / self.img_size
-        else:
-            bboxes = np.array(bboxes)
-        scores = np.array(scores)
-        cls_inds = np.array(cls_inds)
-
-        return {
-            'bboxes': bboxes,
-            'scores': scores,
-            'cls_inds': cls_inds
-        }
+        return [res[0] for res in self.predictor.decode_predict(out)]
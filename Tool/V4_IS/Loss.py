@@ -50,6 +50,7 @@ class YOLOV4LossIS(BaseLoss):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV4ToolsIS.clear_grid_and_anchor_cache()
 
     def focal_loss(
             self,
@@ -80,18 +81,23 @@ class YOLOV4LossIS(BaseLoss):
             target,
             self.each_size_anchor_number
         )
+        # accumulators are tensors on device (the trainer sums them up without syncing)
+        device = res_out['mask'].device
         loss_dict = {
-            'total_loss': 0.0,
+            'total_loss': torch.zeros(size=(), device=device),
             # for object detection
-            'has_obj_loss': 0.0,
-            'no_obj_loss': 0.0,
-            'cls_prob_loss': 0.0,
-            'iou_loss': 0.0,
+            'has_obj_loss': torch.zeros(size=(), device=device),
+            'no_obj_loss': torch.zeros(size=(), device=device),
+            'cls_prob_loss': torch.zeros(size=(), device=device),
+            'iou_loss': torch.zeros(size=(), device=device),
             # for semantic segmentation
-            'mask_loss': 0.0,
+            'mask_loss': torch.zeros(size=(), device=device),
         }
         pre_mask = res_out['mask']
         gt_mask = res_target['mask']
+        if gt_mask.dtype == torch.uint8:
+            # index map --> one-hot (on device)
+            gt_mask = YOLOV4ToolsIS.index_map_to_one_hot(gt_mask, pre_mask.shape[-1])
         # you could try cross entropy loss, I think bce will be better
 
         loss_dict['mask_loss'] += self.focal_loss(pre_mask, gt_mask)
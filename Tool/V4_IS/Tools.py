@@ -1,4 +1,5 @@
 from Tool.V4 import YOLOV4Tools
+from Tool.BaseTools import PaddedLabels
 import torch
 from typing import *
 import numpy as np
@@ -23,83 +24,47 @@ class YOLOV4ToolsIS(YOLOV4Tools):
         objects_vec = [objects, objects , ...]
             objects = [object, object, ...]
             object  = [x0, y0, x1, y1, kind_name]
+            or PaddedLabels (kind_id, x0, y0, x1, y1)
         
         masks_vec   = [masks, maks, ...]
             masks   = [mask, maks, ...]
+            or (N, H, W) uint8 index maps (see VocDataSetForAllTasks mask_as_index_map),
+            they are kept as index maps, one-hot is built in loss
         """
 
         kinds_number = len(kinds_name)
         N = len(objects_vec)
 
         res = {
-            'mask': torch.from_numpy(np.array(masks_vec))
+            'mask': masks_vec if torch.is_tensor(masks_vec) else torch.from_numpy(np.array(masks_vec))
         }
 
-        for anchor_key, val in grid_number.items():
-            a_n, H, W = len(anchor_pre_wh[anchor_key]), val[1], val[0]
-            res[anchor_key] = torch.zeros(size=(N, a_n, 5 + kinds_number, H, W))
-
-        for batch_index, label in enumerate(objects_vec):  # an image label
-            for obj_index, obj in enumerate(label):  # many objects
-                kind_int = kinds_name.index(obj[-1])
-                abs_pos = obj[:4]
-
-                weight_dict = YOLOV4Tools.compute_anchor_response_result(
-                    anchor_pre_wh,
-                    grid_number,
-                    abs_pos,
-                    image_wh,
-                    iou_th,
-                    multi_gt
-                )
-                # weight_dict : key --> anchor_key, value --> weight of pre_anchor with gt_obj
-                # (3, 3)
-                if weight_dict is None:
-                    continue
-
-                pos = [val / image_wh[0] for val in abs_pos]  # scaled in [0, 1]
-
-                for anchor_key in anchor_pre_wh.keys():
-                    weight_vec = weight_dict[anchor_key]  # weight_vec of one anchor size
-                    grid_size = (
-                        image_wh[0] // grid_number[anchor_key][0],
-                        image_wh[1] // grid_number[anchor_key][1]
-                    )
-
-                    grid_index = (
-                        int((abs_pos[0] + abs_pos[2]) * 0.5 // grid_size[0]),  # w -- on x-axis
-                        int((abs_pos[1] + abs_pos[3]) * 0.5 // grid_size[1])  # h -- on y-axis
-                    )
-                    # this grid_index in top-left index
-                    # in yolo v4, we use top-left, top-right, down-left, down-right, four grid_index(s)
-                    grid_index_vec = [grid_index]
-
-                    if grid_index[0] + 1 < grid_number[anchor_key][0]:
-                        grid_index_vec.append(
-                            (grid_index[0] + 1, grid_index[1])
-                        )
-
-                    if grid_index[1] + 1 < grid_number[anchor_key][1]:
-                        grid_index_vec.append(
-                            (grid_index[0], grid_index[1] + 1)
-                        )
-
-                    if grid_index[0] + 1 < grid_number[anchor_key][0] and grid_index[1] + 1 < grid_number[anchor_key][
-                        1]:
-                        grid_index_vec.append(
-                            (grid_index[0] + 1, grid_index[1] + 1)
-                        )
-
-                    for weight_index, weight_value in enumerate(weight_vec):
-                        for grid_index_x, grid_index_y in grid_index_vec:
-                            res[anchor_key][batch_index, weight_index, 4, grid_index_y, grid_index_x] = weight_value
-                            if weight_value != -1 and weight_value != 0:
-                                res[anchor_key][batch_index, weight_index, 0:4, grid_index_y, grid_index_x] = torch.tensor(pos)
-                                res[anchor_key][batch_index, weight_index, int(5 + kind_int), grid_index_y, grid_index_x] = 1.0
-
-        for anchor_key, val in grid_number.items():
-            H, W = val[1], val[0]
-            res[anchor_key] = res[anchor_key].view(N, -1, H, W)
+        if isinstance(objects_vec, PaddedLabels):
+            batch_index, kind_index, abs_gt_pos = objects_vec.flatten()
+        else:
+            batch_index = []
+            kind_index = []
+            abs_gt_pos = []
+            for b_index, label in enumerate(objects_vec):  # an image label
+                for obj in label:  # many objects
+                    batch_index.append(b_index)
+                    kind_index.append(kinds_name.index(obj[-1]))
+                    abs_gt_pos.append(obj[:4])
+
+        res.update(
+            YOLOV4Tools.make_target_from_objects(
+                N,
+                np.array(batch_index, dtype=np.int64),
+                np.array(kind_index, dtype=np.int64),
+                np.array(abs_gt_pos, dtype=np.float64),
+                anchor_pre_wh,
+                image_wh,
+                grid_number,
+                kinds_number,
+                iou_th,
+                multi_gt
+            )
+        )
 
         return res
 
@@ -113,6 +78,10 @@ class YOLOV4ToolsIS(YOLOV4Tools):
         # val : dict --> {'position': xxx, 'conf': xxx, 'cls_prob': xxx}
         for key, x in target.items():
             if key == 'mask':
+                if x.dtype == torch.uint8:
+                    # (-1, h, w) index map, keep it
+                    res[key] = x
+                    continue
                 # from  (-1, kinds_num + 1, h, w) to (-1, h, w, kinds_num + 1)
                 x = x.permute(0, 2, 3, 1)
                 res[key] = x
@@ -1,7 +1,8 @@
+from functools import partial
 from Tool.V4_IS.Tools import YOLOV4ToolsIS
 from Tool.V4_IS.Model import YOLOV4ForISModel
 from Tool.V4_IS.Loss import YOLOV4LossIS
-from Tool.BaseTools import BaseTrainer, WarmUpOptimizer
+from Tool.BaseTools import BaseTrainer, WarmUpOptimizer, DevicePrefetcher, BuiltTargets
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 import torch
@@ -41,24 +42,28 @@ class YOLOV4TrainerIS(BaseTrainer):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV4ToolsIS.clear_grid_and_anchor_cache()
+
+    def target_builder(
+            self
+    ):
+        return partial(
+            YOLOV4ToolsIS.make_target,
+            anchor_pre_wh=self.pre_anchor_w_h,
+            image_wh=self.image_size,
+            grid_number=self.grid_number,
+            kinds_name=self.kinds_name,
+            iou_th=self.iou_th_for_make_target,
+            multi_gt=self.multi_gt
+        )
 
     def make_targets(
             self,
             labels,
     ):
-        targets = YOLOV4ToolsIS.make_target(
-            labels,
-            self.pre_anchor_w_h,
-            self.image_size,
-            self.grid_number,
-            self.kinds_name,
-            self.iou_th_for_make_target,
-            multi_gt=self.multi_gt
+        return self.targets_to_device(
+            self.target_builder()(labels)
         )
-        targets['mask'] = targets['mask'].to(self.device)
-        for anchor_key in self.anchor_keys:
-            targets[anchor_key] = targets[anchor_key].to(self.device)
-        return targets
 
     def train_detector_one_epoch(
             self,
@@ -68,41 +73,55 @@ class YOLOV4TrainerIS(BaseTrainer):
             now_epoch: int,
             desc: str = '',
     ):
-        loss_dict_vec = {}
+        metrics = self.new_train_metrics(now_epoch)
         max_batch_ind = len(data_loader_train)
+        self.set_sampler_epoch(data_loader_train, now_epoch)
 
-        for batch_id, (images, objects, masks) in enumerate(tqdm(data_loader_train,
-                                                                 desc=desc,
-                                                                 position=0)):
-            optimizer.warm(
-                now_epoch,
-                batch_id,
-                max_batch_ind
-            )
+        for batch_id, batch in enumerate(metrics.timed(tqdm(DevicePrefetcher(data_loader_train, self.device),
+                                                            desc=desc,
+                                                            position=0))):
+            step_ind, max_step_ind, micro_ind, micro_number = optimizer.micro_batch_info(batch_id, max_batch_ind)
+            if micro_ind == 0:
+                # lr is changed per optimizer step (not per micro-batch)
+                optimizer.warm(
+                    now_epoch,
+                    step_ind,
+                    max_step_ind
+                )
 
             self.detector.train()
+            images, objects, masks = batch[0], batch[1], batch[2]
             images = images.to(self.device)
 
-            labels = [objects, masks]
-            targets = self.make_targets(labels)
-
-            output = self.detector(images)
-            loss_res = yolo_loss_func(output, targets)
-            if not isinstance(loss_res, dict):
-                print('You have not use our provided loss func, please overwrite method train_detector_one_epoch')
-                pass
+            if self.batch_augmentation is not None:
+                # boxes/masks are changed here, targets can not be built in DataLoader workers
+                images, objects, masks = self.batch_augmentation.augment_objects_and_masks(
+                    images, objects, masks, self.kinds_name
+                )
+                targets = self.make_targets([objects, masks])
+            elif isinstance(batch[-1], BuiltTargets):
+                # (images, objects, masks, BuiltTargets), targets have been built in DataLoader workers
+                targets = self.targets_to_device(batch[-1].targets)
             else:
-                loss = loss_res['total_loss']
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                labels = [objects, masks]
+                targets = self.make_targets(labels)
+
+            with self.grad_sync_context(micro_ind == micro_number - 1):
+                output = self.forward_detector(images)
+                loss_res = yolo_loss_func(output, targets)
+                if not isinstance(loss_res, dict):
+                    print('You have not use our provided loss func, please overwrite method train_detector_one_epoch')
+                    pass
+                else:
+                    loss = loss_res['total_loss']
+                    if micro_ind == 0:
+                        optimizer.zero_grad()
+                    # mean of micro-batches --> same as the loss of the whole batch
+                    optimizer.backward(loss / micro_number)
+                    if micro_ind == micro_number - 1:
+                        optimizer.step()
 
-                for key, val in loss_res.items():
-                    if key not in loss_dict_vec.keys():
-                        loss_dict_vec[key] = []
-                    loss_dict_vec[key].append(val.item())
+                    # summed up on device, synced every metrics_sync_frequency steps (not every step)
+                    metrics.update(loss_res)
 
-        loss_dict = {}
-        for key, val in loss_dict_vec.items():
-            loss_dict[key] = sum(val) / len(val) if len(val) != 0 else 0.0
-        return loss_dict
+        return metrics.mean()
@@ -48,6 +48,7 @@ class YOLOV4VisualizerIs(BaseVisualizer):
             self.image_shrink_rate,
             self.pre_anchor_w_h_rate
         )
+        YOLOV4ToolsIS.clear_grid_and_anchor_cache()
 
     def make_targets(
             self,
@@ -169,6 +170,9 @@ class YOLOV4VisualizerIs(BaseVisualizer):
 
     ):
         image = image.copy().astype(np.float32)
+        if gt_mask_vec.dtype == np.uint8:
+            # index map --> one-hot
+            gt_mask_vec = YOLOV4ToolsIS.index_map_to_one_hot(gt_mask_vec, len(KIND_NAME_TO_COLOR))
         pre_mask_vec = pre_mask_vec.copy().astype(np.float32)
         gt_mask_vec = gt_mask_vec.copy().astype(np.float32)
 
@@ -17,11 +17,15 @@ class WarmUpCosineAnnealOptimizer(WarmUpOptimizer):
             max_epoch_for_train: int,
             base_lr: float = 1e-3,
             warm_up_end_epoch: int = 1,
+            loss_scale: bool = False,
+            accumulate_steps: int = 1,
     ):
         super().__init__(
             optimizer,
             base_lr,
-            warm_up_end_epoch
+            warm_up_end_epoch,
+            loss_scale,
+            accumulate_steps
         )
         self.max_epoch_for_train = max_epoch_for_train
 
@@ -145,7 +149,8 @@ class Helper:
             sgd_optimizer,
             self.config.train_config.max_epoch_on_detector,
             base_lr=self.config.train_config.lr,
-            warm_up_end_epoch=self.config.train_config.warm_up_end_epoch
+            warm_up_end_epoch=self.config.train_config.warm_up_end_epoch,
+            accumulate_steps=self.config.train_config.accumulate_steps
         )
 
         for epoch in tqdm(range(self.restore_epoch + 1, self.config.train_config.max_epoch_on_detector),
@@ -229,7 +234,10 @@ if __name__ == '__main__':
         mean=config.data_config.mean,
         std=config.data_config.std,
         trans_form=trans_train,
-        batch_size=config.train_config.batch_size,
+        batch_size=WarmUpOptimizer.get_micro_batch_size(
+            config.train_config.batch_size,
+            config.train_config.accumulate_steps
+        ),
         num_workers=config.train_config.num_workers,
         use_bbox=False,
         use_mask_type=-1
@@ -72,6 +72,8 @@ class Helper:
             self.config.train_config.device,
             transform=BaseTransform(self.config.data_config.image_size[0]),
             labelmap=self.config.data_config.kinds_name,
+            batch_size=self.config.train_config.batch_size,
+            num_workers=self.config.train_config.num_workers,
         )
         self.my_evaluator = YOLOV4Evaluator(
             model,
@@ -110,7 +112,8 @@ class Helper:
         warm_optimizer = WarmUpOptimizer(
             sgd_optimizer,
             base_lr=self.config.train_config.lr,
-            warm_up_epoch=self.config.train_config.warm_up_end_epoch
+            warm_up_epoch=self.config.train_config.warm_up_end_epoch,
+            accumulate_steps=self.config.train_config.accumulate_steps
         )
 
         for epoch in tqdm(range(self.config.train_config.max_epoch_on_detector),
@@ -181,13 +184,17 @@ if __name__ == '__main__':
         config.data_config.root_path,
         ['2007', '2012'],
         image_size=config.data_config.image_size,
-        batch_size=config.train_config.batch_size,
+        batch_size=WarmUpOptimizer.get_micro_batch_size(
+            config.train_config.batch_size,
+            config.train_config.accumulate_steps
+        ),
         train=True,
         num_workers=config.train_config.num_workers,
         mean=config.data_config.mean,
         std=config.data_config.std,
         use_mosaic=config.train_config.use_mosaic,
-        use_mixup=config.train_config.use_mixup
+        use_mixup=config.train_config.use_mixup,
+        target_builder=helper.trainer.target_builder()
     )
     voc_test_loader = get_stronger_voc_data_loader(
         config.data_config.root_path,
@@ -0,0 +1,195 @@
+'''
+DistributedDataParallel training of YOLO v4 (one process per GPU, or several cpu processes with gloo for test).
+    python yolo_v4_demo/ddp_train.py  --> WORLD_SIZE local processes (launch_distributed)
+    torchrun --nproc_per_node=4 yolo_v4_demo/ddp_train.py  --> processes started by torchrun
+config.train_config.batch_size is the batch size of one optimizer step (of all processes),
+every process loads batch_size // (world_size * accumulate_steps) images per micro-batch
+(batch_size should be divisible by world_size * accumulate_steps).
+Checkpoint/visualization are just done on rank 0 (with the model itself, not the DDP wrapper),
+formal evaluation is split across all processes (detections are gathered to rank 0).
+'''
+import torch
+import os
+from tqdm import tqdm
+from torch.utils.data import DataLoader
+from Tool.V4 import *
+from Tool.BaseTools import WarmUpOptimizer, init_distributed, launch_distributed, cleanup_distributed, \
+    wrap_ddp, is_main_process, get_world_size, barrier, all_reduce_mean
+from Tool.V4.DatasetDefine import get_stronger_voc_data_loader
+from yolo_v4_demo.csp_dark_net_53_backbone import Helper
+from PIL import ImageFile
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+class DDPHelper(Helper):
+    def __init__(
+            self,
+            model: YOLOV4Model,
+            opt: YOLOV4Config,
+            device: torch.device,
+            sync_bn: bool = True,
+    ):
+        # BatchNorm --> synced BatchNorm (in place, so visualizer/evaluators still use the model itself)
+        self.ddp_detector = wrap_ddp(model, device, sync_bn=sync_bn)
+        super().__init__(model, opt)
+        # just the trainer uses the DDP wrapper (all_reduce of grads)
+        self.trainer.detector = self.ddp_detector
+        # every process detects its part of images
+        self.formal_evaluator.distributed = True
+
+    def go(
+            self,
+            data_loader_train: DataLoader,
+            data_loader_test: DataLoader,
+    ):
+        loss_func = YOLOV4Loss(
+            self.config.data_config.pre_anchor_w_h_rate,
+            self.config.data_config.image_shrink_rate,
+            self.config.data_config.single_an,
+            self.config.train_config.weight_position,
+            self.config.train_config.weight_conf_has_obj,
+            self.config.train_config.weight_conf_no_obj,
+            self.config.train_config.weight_cls_prob,
+            image_size=self.config.data_config.image_size,
+        )
+        sgd_optimizer = torch.optim.SGD(
+            self.ddp_detector.parameters(),
+            lr=self.config.train_config.lr,
+            momentum=0.9,
+            weight_decay=5e-4
+        )
+        warm_optimizer = WarmUpOptimizer(
+            sgd_optimizer,
+            base_lr=self.config.train_config.lr,
+            warm_up_epoch=self.config.train_config.warm_up_end_epoch,
+            accumulate_steps=self.config.train_config.accumulate_steps
+        )
+
+        for epoch in tqdm(range(self.config.train_config.max_epoch_on_detector),
+                          desc='training detector',
+                          position=0,
+                          disable=not is_main_process()):
+
+            if epoch % 50 == 0 and epoch != 0:
+                warm_optimizer.set_lr(warm_optimizer.tmp_lr * 0.1)
+
+            loss_dict = self.trainer.train_detector_one_epoch(
+                data_loader_train,
+                loss_func,
+                warm_optimizer,
+                now_epoch=epoch,
+                desc='train for detector epoch --> {}'.format(epoch)
+            )
+            # mean of all processes
+            loss_dict = {key: all_reduce_mean(val) for key, val in loss_dict.items()}
+
+            if is_main_process():
+                print_info = '\n\nepoch: {} [ now lr:{:.6f} ] , loss info-->\n'.format(
+                    epoch,
+                    warm_optimizer.tmp_lr
+                )
+                for key, val in loss_dict.items():
+                    print_info += '{:^30}:{:^15.6f}.\n'.format(key, val)
+                tqdm.write(print_info)
+
+            if epoch % self.config.eval_config.eval_frequency == 0:
+                if is_main_process():
+                    # save model (the model itself, it could be loaded without DDP)
+                    saved_dir = self.config.ABS_PATH + os.getcwd() + '/model_pth_detector/'
+                    os.makedirs(saved_dir, exist_ok=True)
+                    torch.save(self.detector.state_dict(), '{}/{}.pth'.format(saved_dir, epoch))
+
+                    with torch.no_grad():
+                        # show predict
+                        saved_dir = self.config.ABS_PATH + os.getcwd() + '/eval_images/{}/'.format(epoch)
+                        self.visualizer.show_detect_results(
+                            data_loader_test,
+                            saved_dir
+                        )
+                # other processes wait for rank 0
+                barrier()
+
+                with torch.no_grad():
+                    # eval mAP (all processes)
+                    self.formal_evaluator.eval_detector_mAP()
+
+
+def main_worker(
+        rank: int,
+        world_size: int,
+        config: YOLOV4Config,
+        backend: str = None,
+        pre_trained_path: str = None,
+):
+    device = init_distributed(rank, world_size, backend)
+    config.train_config.device = str(device)
+    # same initial weights in all processes (DDP broadcasts weights of rank 0 anyway)
+    torch.manual_seed(0)
+
+    csp_dark_net_53 = get_backbone_csp_darknet_53(pre_trained_path)
+    net = YOLOV4Model(
+        csp_dark_net_53,
+        config.data_config.single_an,
+        num_classes=len(config.data_config.kinds_name)
+    )
+    helper = DDPHelper(
+        net,
+        config,
+        device
+    )
+
+    voc_train_loader = get_stronger_voc_data_loader(
+        config.data_config.root_path,
+        config.data_config.years,
+        image_size=config.data_config.image_size,
+        batch_size=WarmUpOptimizer.get_micro_batch_size(
+            config.train_config.batch_size,
+            config.train_config.accumulate_steps,
+            get_world_size()
+        ),
+        train=True,
+        num_workers=config.train_config.num_workers,
+        mean=config.data_config.mean,
+        std=config.data_config.std,
+        use_mosaic=config.train_config.use_mosaic,
+        use_mixup=config.train_config.use_mixup,
+        target_builder=helper.trainer.target_builder(),
+        distributed=True
+    )
+    voc_test_loader = get_stronger_voc_data_loader(
+        config.data_config.root_path,
+        ['2007'],
+        image_size=config.data_config.image_size,
+        batch_size=config.train_config.batch_size,
+        train=False,
+        num_workers=config.train_config.num_workers,
+        mean=config.data_config.mean,
+        std=config.data_config.std,
+        use_mosaic=False,
+        use_mixup=False,
+    )
+    helper.go(voc_train_loader, voc_test_loader)
+    cleanup_distributed()
+
+
+if __name__ == '__main__':
+    WORLD_SIZE = 2
+
+    # sub configs are class attributes, they are not pickled to spawned processes --> change them in Config.py
+    config = YOLOV4Config()
+    if 'RANK' in os.environ:
+        # started by torchrun
+        main_worker(
+            int(os.environ['RANK']),
+            int(os.environ['WORLD_SIZE']),
+            config,
+            pre_trained_path='/home/dell/PycharmProjects/YOLO/pre_trained/cspdarknet53.pth'
+        )
+    else:
+        launch_distributed(
+            main_worker,
+            WORLD_SIZE,
+            config,
+            None,
+            '/home/dell/PycharmProjects/YOLO/pre_trained/cspdarknet53.pth'
+        )
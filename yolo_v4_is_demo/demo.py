@@ -4,7 +4,7 @@ from tqdm import tqdm
 import os
 from torch.utils.data import DataLoader
 from Tool.V4_IS import *
-from Tool.BaseTools import WarmUpOptimizer, BaseTransform
+from Tool.BaseTools import WarmUpOptimizer, BaseTransform, BatchAugmentation
 import albumentations as alb
 import math
 from PIL import ImageFile
@@ -22,11 +22,15 @@ class WarmUpCosineAnnealOptimizer(WarmUpOptimizer):
             max_epoch_for_train: int,
             base_lr: float = 1e-3,
             warm_up_end_epoch: int = 1,
+            loss_scale: bool = False,
+            accumulate_steps: int = 1,
     ):
         super().__init__(
             optimizer,
             base_lr,
-            warm_up_end_epoch
+            warm_up_end_epoch,
+            loss_scale,
+            accumulate_steps
         )
         self.max_epoch_for_train = max_epoch_for_train
 
@@ -206,7 +210,8 @@ class Helper:
             sgd_optimizer,
             self.config.train_config.max_epoch_on_detector,
             base_lr=self.config.train_config.lr,
-            warm_up_end_epoch=self.config.train_config.warm_up_end_epoch
+            warm_up_end_epoch=self.config.train_config.warm_up_end_epoch,
+            accumulate_steps=self.config.train_config.accumulate_steps
         )
 
         for epoch in tqdm(range(self.restore_epoch + 1, self.config.train_config.max_epoch_on_detector),
@@ -296,10 +301,14 @@ if __name__ == '__main__':
         mean=config.data_config.mean,
         std=config.data_config.std,
         trans_form=trans_train,
-        batch_size=config.train_config.batch_size,
+        batch_size=WarmUpOptimizer.get_micro_batch_size(
+            config.train_config.batch_size,
+            config.train_config.accumulate_steps
+        ),
         num_workers=config.train_config.num_workers,
         use_bbox=True,
-        use_mask_type=-1
+        use_mask_type=-1,
+        batch_augmentation=config.train_config.batch_augmentation
     )
     voc_test_loader = get_voc_for_all_tasks_loader(
         config.data_config.root_path,
@@ -320,6 +329,12 @@ if __name__ == '__main__':
         config,
         restore_epoch=-1
     )
+    if config.train_config.batch_augmentation:
+        helper.trainer.batch_augmentation = BatchAugmentation(
+            config.data_config.image_size[0],
+            mean=config.data_config.mean,
+            std=config.data_config.std
+        )
 
     # helper.eval_map()
     # helper.show_detect_results(voc_test_loader, 50)